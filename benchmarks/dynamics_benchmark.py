@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for DynamicsEngine on the example models.
+
+For every model this measures graph build time, compile time, cold and warm cached_init,
+p50/p99 latency of simulation_update or estimation_update, and peak RSS. Each model runs in its own
+process so that peak RSS is per model, and loads from a temporary copy of its dynamics.py so that
+the pickle cache of the examples is left alone. Results are written as JSON:
+
+    python benchmarks/dynamics_benchmark.py --output dynamics.json
+"""
+import argparse
+import importlib.util
+import json
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from os.path import dirname, abspath, join
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+EXAMPLES = join(ROOT, "examples", "dynamics")
+MODELS = {
+    "arm": (join(EXAMPLES, "simulations", "arm_simulation", "dynamics.py"), "simulation"),
+    "lift": (join(EXAMPLES, "simulations", "lift_simulation", "dynamics.py"), "simulation"),
+    "shooter": (join(EXAMPLES, "simulations", "shooter_simulation", "dynamics.py"), "simulation"),
+    "drive": (join(EXAMPLES, "simulations", "drive_simulation", "dynamics.py"), "simulation"),
+    "estimation": (join(EXAMPLES, "estimations", "robot_estimation", "dynamics.py"), "estimation"),
+}
+
+
+class NullDevice:
+    """
+    Stands in for wpilib devices so estimation_update can run off-robot. Every getter reads 0.
+    """
+
+    def __getattr__(self, name):
+        return lambda *args: 0.0
+
+
+def load_model_class(path, directory):
+    model_path = join(directory, "dynamics.py")
+    shutil.copy(path, model_path)
+    spec = importlib.util.spec_from_file_location("benchmark_model", model_path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["benchmark_model"] = module
+    spec.loader.exec_module(module)
+    return module.MyRobotDynamics
+
+
+def percentiles(samples):
+    import numpy as np
+    return {
+        "p50": float(np.percentile(samples, 50)),
+        "p99": float(np.percentile(samples, 99)),
+        "mean": float(np.mean(samples)),
+    }
+
+
+def run_model(name, ticks, dt):
+    path, mode = MODELS[name]
+    directory = tempfile.mkdtemp(prefix="int_dynamics_benchmark_")
+    try:
+        cls = load_model_class(path, directory)
+        result = {"model": name, "mode": mode, "ticks": ticks, "dt": dt}
+
+        # Split construction into graph building and compiling by holding off rebuild_functions
+        class Unbuilt(cls):
+            def rebuild_functions(self):
+                return 0
+        engine = Unbuilt(mode)
+        start_time = time.perf_counter()
+        engine.build_prediction_updates()
+        result["build_time"] = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        cls.rebuild_functions(engine)
+        result["compile_time"] = time.perf_counter() - start_time
+        del engine
+
+        start_time = time.perf_counter()
+        cls.cached_init(mode)
+        result["cached_init_cold"] = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        engine = cls.cached_init(mode)
+        result["cached_init_warm"] = time.perf_counter() - start_time
+
+        # Keep telemetry local, and give the estimator something to talk to
+        engine.SINK_TO_NT = False
+        engine.SINK_TO_SIMPLESTREAMER = False
+        for controller in engine.controllers.values():
+            controller.device = NullDevice()
+            controller.set_percent_vbus(.5)
+        for sensor in engine.sensors.values():
+            sensor.device = NullDevice()
+
+        update = engine.simulation_update if mode == "simulation" else engine.estimation_update
+        update(dt)
+        samples = []
+        for _ in range(ticks):
+            start_time = time.perf_counter()
+            update(dt)
+            samples.append(time.perf_counter() - start_time)
+        result["{}_update".format(mode)] = percentiles(samples)
+        # ru_maxrss is in kilobytes on Linux
+        result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+        return result
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--models", nargs="+", default=sorted(MODELS), choices=sorted(MODELS))
+    parser.add_argument("--ticks", type=int, default=1000)
+    parser.add_argument("--dt", type=float, default=.05)
+    parser.add_argument("--output", help="file to write JSON results to, stdout if not given")
+    parser.add_argument("--worker", choices=sorted(MODELS), help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        result = run_model(args.worker, args.ticks, args.dt)
+        with open(args.result_file, 'w') as f:
+            json.dump(result, f)
+        return
+
+    results = []
+    for model in args.models:
+        with tempfile.NamedTemporaryFile(suffix=".json") as result_file:
+            process = subprocess.run(
+                [sys.executable, abspath(__file__), "--worker", model, "--ticks", str(args.ticks),
+                 "--dt", str(args.dt), "--result-file", result_file.name],
+                stdout=subprocess.DEVNULL)
+            if process.returncode != 0:
+                print("{} failed with exit code {}".format(model, process.returncode), file=sys.stderr)
+                results.append({"model": model, "error": process.returncode})
+                continue
+            with open(result_file.name) as f:
+                result = json.load(f)
+        update = result.get("simulation_update", result.get("estimation_update"))
+        print("{model:>10} build {build_time:7.2f}s  compile {compile_time:7.2f}s  "
+              "cached_init cold {cached_init_cold:6.2f}s warm {cached_init_warm:6.3f}s  "
+              "peak {peak_rss_mb:6.0f}MB".format(**result) +
+              "  tick p50 {:.2f}ms p99 {:.2f}ms".format(update["p50"]*1000, update["p99"]*1000), file=sys.stderr)
+        results.append(result)
+
+    report = {
+        "benchmark": "dynamics_engine",
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the scipy_ilqg solver on a set of reference problems.
+
+Each problem is solved at several horizons, recording the wall time of each phase
+(derivatives, backward pass, line-search) from the ilqg() trace, iteration counts and final cost.
+Results are written as JSON, and can be compared against an earlier run to catch regressions:
+
+    python benchmarks/ilqg_benchmark.py --output baseline.json
+    python benchmarks/ilqg_benchmark.py --compare baseline.json
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+from os.path import dirname, abspath
+import numpy as np
+from scipy.linalg import expm
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from int_dynamics.scipy_ilqg import ilqg
+
+
+def sabs(x, p):
+    # smooth absolute-value function (a.k.a pseudo-Huber)
+    return np.sqrt(x*x + p*p) - p
+
+
+def linear_problem(horizon, random):
+    """
+    The control-limited LTI system of examples/ilqg/demo_linear.py, with analytic derivatives.
+    """
+    h, n, m = .01, 3, 2
+    A = random.randn(n, n)
+    A = expm(h*(A - A.T))
+    B = h*random.randn(m, n)
+    Q = h*np.eye(n)
+    R = .1*h*np.eye(m)
+
+    def dynamics(x, u):
+        return np.dot(x, A) + np.dot(u, B)
+
+    def cost(x, u):
+        u = np.where(np.isnan(u), 0, u)
+        return 0.5*np.sum(x*np.dot(x, Q), axis=1) + 0.5*np.sum(u*np.dot(u, R), axis=1)
+
+    def dynamics_derivatives(x, u):
+        K = x.shape[0]
+        return np.tile(A, [K, 1, 1]), np.tile(B, [K, 1, 1]), None, None, None
+
+    def cost_derivatives(x, u):
+        K = x.shape[0]
+        u = np.where(np.isnan(u), 0, u)
+        return np.dot(x, Q), np.dot(u, R), np.tile(Q, [K, 1, 1]), np.zeros((K, n, m)), np.tile(R, [K, 1, 1])
+
+    options = {
+        "lims": np.array([[-.6, .6], [-.6, .6]]),
+        "dynamics_derivatives": dynamics_derivatives,
+        "cost_derivatives": cost_derivatives,
+    }
+    return dynamics, cost, random.randn(n), .1*random.randn(horizon, m), options
+
+
+def car_problem(horizon, random):
+    """
+    The car-parking problem of examples/ilqg/demo_car.py, with finite-differenced derivatives.
+    """
+    def dynamics(x, u):
+        d, h = 2.0, 0.03
+        w = u[:, 0]
+        a = u[:, 1]
+        o = x[:, 2]
+        z = np.vstack((np.cos(o), np.sin(o)))
+        f = h*x[:, 3]
+        b = d + f*np.cos(w) - np.sqrt(d**2 - (f*np.sin(w))**2)
+        dod = np.arcsin(np.sin(w)*f/d)
+        return x + np.vstack([b*z[0], b*z[1], dod, h*a]).T
+
+    def cost(x, u):
+        final = np.isnan(u[:, 0])
+        u = np.where(np.isnan(u), 0, u)
+        lu = np.dot(u**2, 1e-2*np.array([1, .01]))
+        lf = final*np.dot(sabs(x, np.array([.01, .01, .01, 1])), np.array([.1, .1, 1, .3]))
+        lx = np.dot(sabs(x[:, 0:2], np.array([.1, .1])), 1e-3*np.array([1, 1]))
+        return lu + lx + lf
+
+    options = {"lims": np.array([[-.5, .5], [-2, 2]])}
+    return dynamics, cost, np.array([1, 1, np.pi*3/2, 0]), .1*random.randn(horizon, 2), options
+
+
+def drivetrain_problem(horizon, random):
+    """
+    A tank drive with first order motor response driving around cost bumps to a goal,
+    like examples/ilqg/robot.py, with finite-differenced derivatives.
+    """
+    dt, top_speed, time_constant, width = .05, 10.0, .2, 2.0
+    bumps = np.array([[-1, 5], [2.5, 10], [-2, 15], [4, 18]])
+    goal = np.array([0, 20])
+
+    def dynamics(x, u):
+        # x = [x y angle left_speed right_speed], u = [left right]
+        speed = (x[:, 3] + x[:, 4])/2
+        turn = (x[:, 4] - x[:, 3])/width
+        wheel_accel = (u*top_speed - x[:, 3:5])/time_constant
+        dx = np.vstack([-speed*np.sin(x[:, 2]), speed*np.cos(x[:, 2]), turn]).T
+        return np.hstack((x[:, :3] + dt*dx, x[:, 3:5] + dt*wheel_accel))
+
+    def cost(x, u):
+        final = np.isnan(u[:, 0])
+        u = np.where(np.isnan(u), 0, u)
+        distances = np.sum((x[:, None, :2] - bumps[None])**2, axis=2)
+        c = np.sum(5*np.exp(-distances/8), axis=1) + np.dot(u*u, 4e-1*np.array([1, 1]))
+        c += final*3*sabs(np.linalg.norm(x[:, :2] - goal, axis=1), .1)
+        return c
+
+    options = {"lims": np.array([[-1, 1], [-1, 1]])}
+    return dynamics, cost, np.zeros(5), .1*random.randn(horizon, 2), options
+
+
+PROBLEMS = {
+    "linear": linear_problem,
+    "car": car_problem,
+    "drivetrain": drivetrain_problem,
+}
+
+
+def run_benchmark(problem, horizon, max_iter, seed=0):
+    random = np.random.RandomState(seed)
+    dynamics, cost, x0, u0, options = PROBLEMS[problem](horizon, random)
+    options.update({"vectorized": True, "maxIter": max_iter})
+    start_time = time.time()
+    x, u, L, Vx, Vxx, costs, trace = ilqg.ilqg(dynamics, cost, x0, u0, options)
+    wall_time = time.time() - start_time
+    return {
+        "problem": problem,
+        "horizon": horizon,
+        "wall_time": wall_time,
+        "time_derivs": float(trace[:, 8].sum()),
+        "time_backward": float(trace[:, 9].sum()),
+        "time_forward": float(trace[:, 10].sum()),
+        "iterations": int(trace.shape[0]),
+        "accepted": int(np.isfinite(trace[:, 2]).sum()),
+        "final_cost": float(costs.sum()),
+    }
+
+
+def compare(results, baseline, time_tolerance, cost_tolerance):
+    """
+    :return A list of messages describing every result that is slower or worse than its baseline.
+    """
+    regressions = []
+    old_results = {(result["problem"], result["horizon"]): result for result in baseline["results"]}
+    for result in results:
+        old = old_results.get((result["problem"], result["horizon"]))
+        if old is None:
+            continue
+        name = "{} T={}".format(result["problem"], result["horizon"])
+        if result["wall_time"] > old["wall_time"]*time_tolerance:
+            regressions.append("{}: wall time {:.3f}s vs {:.3f}s".format(name, result["wall_time"], old["wall_time"]))
+        if result["final_cost"] > old["final_cost"] + cost_tolerance*abs(old["final_cost"]):
+            regressions.append("{}: final cost {:.6g} vs {:.6g}".format(name, result["final_cost"], old["final_cost"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--problems", nargs="+", default=sorted(PROBLEMS), choices=sorted(PROBLEMS))
+    parser.add_argument("--horizons", nargs="+", type=int, default=[50, 100, 200])
+    parser.add_argument("--max-iter", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=1, help="runs per case, the fastest is kept")
+    parser.add_argument("--output", help="file to write JSON results to, stdout if not given")
+    parser.add_argument("--compare", help="JSON results of an earlier run to check for regressions")
+    parser.add_argument("--time-tolerance", type=float, default=1.25, help="allowed slowdown factor")
+    parser.add_argument("--cost-tolerance", type=float, default=1e-3, help="allowed relative cost increase")
+    args = parser.parse_args()
+
+    results = []
+    for problem in args.problems:
+        for horizon in args.horizons:
+            runs = [run_benchmark(problem, horizon, args.max_iter) for _ in range(args.repeat)]
+            result = min(runs, key=lambda run: run["wall_time"])
+            print("{problem:>10} T={horizon:<4} {wall_time:8.3f}s  derivs {time_derivs:7.3f}s  "
+                  "backward {time_backward:7.3f}s  forward {time_forward:7.3f}s  "
+                  "iterations {iterations:3d}  cost {final_cost:.6g}".format(**result), file=sys.stderr)
+            results.append(result)
+
+    report = {
+        "benchmark": "scipy_ilqg",
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.time_tolerance, args.cost_tolerance)
+        for regression in regressions:
+            print("REGRESSION: " + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
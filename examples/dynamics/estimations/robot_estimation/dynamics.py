@@ -5,7 +5,7 @@ import math
 class MyRobotDynamics(dynamics.DynamicsEngine):
 
     SINK_IN_SIMULATION = True
-    SINK_TO_SIMPLESTREAMER = True
+    SINK_TO_TELEMETRY = True
 
     def build_loads(self):
         # Init drivetrain components (the assembly does this for us)
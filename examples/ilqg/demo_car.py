@@ -1,5 +1,5 @@
 from numpy import *
-from ilqg import ilqg
+from int_dynamics.scipy_ilqg.ilqg import ilqg
 # A demo of iLQG/DDP with car-parking dynamics
 
 def finite_difference(fun, x, h=2e-6):
@@ -198,13 +198,13 @@ T       = 500              # horizon
 x0      = array([1, 1, pi*3/2, 0])   # initial state
 u0      = .1*random.randn(T, 2)  # initial controls
 #u0 = zeros((T, 2))
-options = {}
+options = {"vectorized": True}
 options["lims"]  = array([[-.5, .5],         # wheel angle limits (radians)
                           [ -2,  2]])       # acceleration limits (m/s^2)
 
 # run the optimization
 #options["maxIter"] = 5
-x, u, L, Vx, Vxx, cost = ilqg(DYNCST, x0, u0, options)
+x, u, L, Vx, Vxx, cost, trace = ilqg(car_dynamics, car_cost, x0, u0, options)
 print("done")
 ## ======== graphics functions ========
 #function h = car_plot(x,u)
@@ -0,0 +1,56 @@
+from numpy import *
+import math
+import time
+from int_dynamics import dynamics
+from int_dynamics.scipy_ilqg import ilqg
+"""
+A demo of iLQG optimizing a path for the same drivetrain model that is used for simulation.
+"""
+
+
+class DrivetrainDynamics(dynamics.DynamicsEngine):
+
+    def build_loads(self):
+        # Two CIM
+        left_motor = dynamics.CIMMotor()
+        right_motor = dynamics.CIMMotor()
+        # Two 10:1 gearboxes
+        left_gearbox = dynamics.GearBox([left_motor], 10, 1)
+        right_gearbox = dynamics.GearBox([right_motor], 10, 1)
+
+        left_wheels = dynamics.KOPWheels(left_gearbox, 3, 6, 60)
+        right_wheels = dynamics.KOPWheels(right_gearbox, 3, 6, 60)
+
+        self.loads["drivetrain"] = dynamics.TwoDimensionalLoad(120)
+        self.loads["drivetrain"].add_wheel(left_wheels, x_origin=-.5)
+        self.loads["drivetrain"].add_wheel(right_wheels, x_origin=.5, r_origin=math.pi)
+
+        self.controllers['left_drive'] = dynamics.PWMSpeedController(left_motor, 0)
+        self.controllers['right_drive'] = dynamics.PWMSpeedController(right_motor, 1)
+
+        # Quadratic control cost, and distance to the goal at the end
+        self.costs['effort'] = dynamics.ControlEffortCost(
+            [self.controllers['left_drive'], self.controllers['right_drive']], 4e-1)
+        self.costs['goal'] = dynamics.TerminalPositionalCost(self.loads["drivetrain"], [0, 10, 0], [3, 3, 0])
+
+
+engine = DrivetrainDynamics.cached_init("optimization")
+position = engine.get_state_slice(engine.loads["drivetrain"].position)
+
+dynamics_fun, dynamics_derivatives = engine.get_ilqg_functions(.1)
+cost_func, cost_derivatives = engine.get_ilqg_cost_functions()
+
+T = 50  # horizon
+x0 = engine.get_state_vector()
+u0 = .1*random.randn(T, 2)
+options = {
+    "lims": array([[-1, 1],
+                   [-1, 1]]),
+    "vectorized": True,
+    "dynamics_derivatives": dynamics_derivatives,
+    "cost_derivatives": cost_derivatives,
+}
+
+start_time = time.time()
+x, u, L, Vx, Vxx, cost, trace = ilqg.ilqg(dynamics_fun, cost_func, x0, u0, options)
+print("ilqg took {} seconds, final position {}".format(time.time() - start_time, x[-1, position]))
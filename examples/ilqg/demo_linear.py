@@ -1,6 +1,6 @@
 from numpy import *
 from scipy.linalg import expm
-import ilqg
+from int_dynamics.scipy_ilqg import ilqg
 """
 A demo of iLQG/DDP with a control-limited LTI system.
 """
@@ -63,7 +63,15 @@ R = .1*h*eye(m)
 #Op.lims = ones(m,1)*[-1 1]*.6;
 
 # optimization problem
-dyncst = lambda x, u, i, want_all=False: lin_dyn_cst(x, u, A, B, Q, R, want_all)
+dynamics = lambda x, u: lin_dyn_cst(x, u, A, B, Q, R)[0]
+cost = lambda x, u: lin_dyn_cst(x, u, A, B, Q, R)[1]
+dynamics_derivatives = lambda x, u: lin_dyn_cst(x, u, A, B, Q, R, True)[:5]
+cost_derivatives = lambda x, u: lin_dyn_cst(x, u, A, B, Q, R, True)[5:]
+options = {
+    "vectorized": True,
+    "dynamics_derivatives": dynamics_derivatives,
+    "cost_derivatives": cost_derivatives,
+}
 T = 100  # horizon
 x0 = random.randn(n)  # initial state
 u0 = .1*random.randn(T, m)  # initial controls
@@ -74,5 +82,5 @@ u0 = .1*random.randn(T, m)  # initial controls
 #            [-0.16786378, 0.08034461, -0.23664327, 0.16031643, 0.15972222, 0.00393588, -0.01797945, -0.14965136, 0.13926328, -0.00071236]])
 #u0 = tile(u0, (1, T/10))
 # run the optimization
-x, u, L, Vx, Vxx, cost = ilqg.ilqg(dyncst, x0, u0, {})
+x, u, L, Vx, Vxx, cost, trace = ilqg.ilqg(dynamics, cost, x0, u0, options)
 #print(L[:,:,-1])
\ No newline at end of file
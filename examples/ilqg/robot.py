@@ -109,7 +109,7 @@ class IlqgRobot(wpilib.IterativeRobot):
                                  [-1, 1]])
 
         start_time = time.time()
-        self.x, self.u, L, Vx, Vxx, cost = ilqg.ilqg(lambda x, u: dynamics_func(x, u), cost_func, x0, u0, options)
+        self.x, self.u, L, Vx, Vxx, cost, trace = ilqg.ilqg(lambda x, u: dynamics_func(x, u), cost_func, x0, u0, options)
         self.i = 0
         print(self.x[-1])
         print("ilqg took {} seconds".format(time.time() - start_time))
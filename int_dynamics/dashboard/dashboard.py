@@ -1,79 +1,179 @@
 from bokeh.plotting import figure, curdoc
-from bokeh.models.widgets.tables import TableColumn, DataTable
 from bokeh.models import ColumnDataSource
-from bokeh.io import show, vform
-import simplestreamer
+from bokeh.models.widgets.tables import TableColumn, DataTable
+from bokeh.layouts import column, gridplot
 import numpy as np
+from int_dynamics import telemetry
 
 
-# create a plot and style its properties
-p = figure(x_range=(-100, 100), y_range=(-100, 100), toolbar_location=None)
-p.border_fill_color = 'black'
-p.background_fill_color = 'black'
-p.outline_line_color = None
-p.grid.grid_line_color = None
+SAMPLES_PER_SEC = 100
+SECS_REMEMBERED = 10
+HISTORY = SAMPLES_PER_SEC*SECS_REMEMBERED
+# Only plot channels whose names start with one of these
+PLOTTED_PREFIXES = ("loads/", "controllers/", "sensors/")
+PLOT_COLUMNS = 3
+POSITION_CHANNEL = "loads/drivetrain/position"
+# Frames the divergence statistics average over, and how often the table is refreshed
+DIVERGENCE_WINDOW = 200
+DIVERGENCE_UPDATES_PER_SEC = 5
 
 
-SAMPLES_PER_SEC = 100
-SECS_REMEMBERED = 2
-value_plots = {}
-value_lines = {}
+def style(fig):
+    fig.border_fill_color = 'black'
+    fig.background_fill_color = 'black'
+    fig.outline_line_color = None
+    fig.grid.grid_line_color = None
+    return fig
 
-sim_circle = p.circle([0, 1], [0, -1], size=5, color="blue")
-est_circle = p.circle([0, 1], [0, 1], size=5, color="red")
 
+class ChannelRing:
+    """
+    The last HISTORY frames of one telemetry stream, with a column per element of every field.
+    """
 
-streamer = simplestreamer.SimpleStreamer(5805)
-streamer.subscribe("127.0.0.1", 5803, "simulation", updates_per_sec=SAMPLES_PER_SEC)
-streamer.subscribe("127.0.0.1", 5804, "estimation", updates_per_sec=SAMPLES_PER_SEC)
+    def __init__(self, layout, history=HISTORY):
+        self.layout = layout
+        self.channels = []
+        for name, size in layout.fields:
+            self.channels.extend([name] if size == 1 else ["{}/{}".format(name, i) for i in range(size)])
+        self.buffer = np.zeros((history, layout.size))
+        self.count = 0
+        self.start_time = None
 
+    def extend(self, frames):
+        """
+        Add frames to the ring, and return them as columns ready for ColumnDataSource.stream().
+        """
+        frames = np.array(frames)
+        if self.start_time is None:
+            self.start_time = frames[0, 0]
+        history = self.buffer.shape[0]
+        rows = (self.count + np.arange(len(frames))) % history
+        self.buffer[rows] = frames
+        self.count += len(frames)
+        new_data = {channel: frames[:, i] for i, channel in enumerate(self.channels)}
+        new_data["t"] = frames[:, 0] - self.start_time
+        return new_data
 
-def update():
-    sim_data = streamer.get_data("simulation")
-    if "loads" not in sim_data:
-        return
-    pos_data = sim_data["loads"]["drivetrain"]
-    sim_circle.data_source.data['x'] = [pos_data["position"][0], pos_data["velocity"][0]]
-    sim_circle.data_source.data['y'] = [pos_data["position"][1], pos_data["velocity"][1]]
+    def get_data(self):
+        """
+        :returns the whole ring in chronological order, as columns for a new ColumnDataSource.
+        """
+        history = self.buffer.shape[0]
+        if self.count <= history:
+            frames = self.buffer[:self.count]
+        else:
+            frames = np.roll(self.buffer, -(self.count % history), axis=0)
+        data = {channel: frames[:, i] for i, channel in enumerate(self.channels)}
+        data["t"] = frames[:, 0] - (self.start_time or 0)
+        return data
+
+    def last(self, name):
+        if self.count == 0:
+            return None
+        return self.buffer[(self.count - 1) % self.buffer.shape[0], self.layout.get_slice(name)]
+
+
+class TelemetryStream:
+    """
+    A telemetry subscription and the ring and ColumnDataSource it feeds.
+    """
+
+    def __init__(self, name, port, color):
+        self.name = name
+        self.color = color
+        self.client = telemetry.TelemetryClient("127.0.0.1", port)
+        self.ring = None
+        self.source = None
+        self.frames = []
+
+    def poll(self):
+        """
+        :returns True if the stream's layout is new, and plots need to be made for it.
+        """
+        frames = self.client.poll()
+        self.frames = frames
+        if self.client.layout is None:
+            return False
+        new_layout = self.ring is None or self.ring.layout.layout_id != self.client.layout.layout_id
+        if new_layout:
+            self.ring = ChannelRing(self.client.layout)
+            self.source = ColumnDataSource(data=self.ring.get_data())
+        if len(frames) > 0:
+            self.source.stream(self.ring.extend(frames), rollover=HISTORY)
+        return new_layout
 
-    est_data = streamer.get_data("estimation")
-    if "loads" not in est_data:
+
+streams = [
+    TelemetryStream("simulation", 5813, "#A6CEE3"),
+    TelemetryStream("estimation", 5814, "#FB9A99"),
+]
+
+position_plot = style(figure(x_range=(-100, 100), y_range=(-100, 100), toolbar_location=None))
+position_sources = {stream.name: ColumnDataSource(data={'x': [0], 'y': [0]}) for stream in streams}
+for stream in streams:
+    position_plot.circle('x', 'y', source=position_sources[stream.name], size=5, color=stream.color)
+
+simulation_stream, estimation_stream = streams
+monitor = telemetry.DivergenceMonitor(DIVERGENCE_WINDOW)
+divergence_source = ColumnDataSource(data=monitor.get_summary())
+divergence_table = DataTable(source=divergence_source, width=900, height=300, columns=[
+    TableColumn(field="channel", title="Channel"),
+    TableColumn(field="statistic", title="Statistic"),
+    TableColumn(field="mean_error", title="Mean error"),
+    TableColumn(field="rms_error", title="RMS error"),
+    TableColumn(field="normalized", title="Average (1 is consistent)"),
+    TableColumn(field="lower", title="Lower bound"),
+    TableColumn(field="upper", title="Upper bound"),
+    TableColumn(field="status", title="Filter"),
+])
+update_count = 0
+
+root = column(position_plot, divergence_table)
+curdoc().add_root(root)
+
+
+def rebuild_plots():
+    channels = []
+    for stream in streams:
+        if stream.ring is None:
+            continue
+        for channel in stream.ring.channels:
+            if channel.startswith(PLOTTED_PREFIXES) and channel not in channels:
+                channels.append(channel)
+    plots = []
+    for channel in channels:
+        fig = style(figure(title=channel, width=300, height=150, toolbar_location=None))
+        for stream in streams:
+            if stream.ring is not None and channel in stream.ring.channels:
+                fig.line('t', channel, source=stream.source, color=stream.color)
+        plots.append(fig)
+    root.children = [position_plot, divergence_table, gridplot(plots, ncols=PLOT_COLUMNS)]
+
+
+def update_divergence():
+    global update_count
+    if estimation_stream.ring is None:
         return
-    pos_data = est_data["loads"]["drivetrain"]
-    est_circle.data_source.data['x'] = [pos_data["position"][0], pos_data["velocity"][0]]
-    est_circle.data_source.data['y'] = [pos_data["position"][1], pos_data["velocity"][1]]
-    #update_plots(stream_data)
-
-
-def update_plots(dictionary, prefix=""):
-    for dict_key in dictionary:
-        if isinstance(dictionary[dict_key], dict):
-            update_plots(dictionary[dict_key], "/".join((prefix, dict_key)))
-        elif hasattr(dictionary[dict_key], 'shape') and dictionary[dict_key].size > 1:
-            i = 0
-            for value in np.nditer(dictionary[dict_key]):
-                set_plot("/".join((prefix, dict_key, str(i))), value)
-                i += 1
-        else:
-            set_plot("/".join((prefix, dict_key)), dictionary[dict_key])
-
-def set_plot(key, value):
-    if key not in value_plots:
-        fig = figure(x_range=(0, SAMPLES_PER_SEC), y_range=(-1, 1), toolbar_location=None)
-        fig.border_fill_color = 'black'
-        fig.background_fill_color = 'black'
-        fig.outline_line_color = None
-        fig.grid.grid_line_color = None
-        value_plots[key] = fig
-        value_lines[key] = fig.line(
-                [i for i in range(SAMPLES_PER_SEC*SECS_REMEMBERED)],
-                [0 for _ in range(SAMPLES_PER_SEC*SECS_REMEMBERED)],
-                color='#A6CEE3', legend=key)
-    if value < value_plots[key].data_source.data['y_range'][0]:
-        value_plots[key].data_source.data['y_range'][0] = value
-    if value > value_plots[key].data_source.data['y_range'][1]:
-        value_plots[key].data_source.data['y_range'][1] = value
-    value_lines[key].data_source.data['y'].pop()
-    value_lines[key].data_source.data['y'].append(value)
+    # Without a simulation to compare against, only the innovations can be checked
+    simulation_layout = None if simulation_stream.ring is None else simulation_stream.ring.layout
+    monitor.set_layouts(simulation_layout, estimation_stream.ring.layout)
+    monitor.add_simulation(simulation_stream.frames)
+    monitor.add_estimation(estimation_stream.frames)
+    update_count += 1
+    if update_count % max(1, SAMPLES_PER_SEC//DIVERGENCE_UPDATES_PER_SEC) == 0:
+        divergence_source.data = monitor.get_summary()
+
+
+def update():
+    if any([stream.poll() for stream in streams]):
+        rebuild_plots()
+    update_divergence()
+    for stream in streams:
+        if stream.ring is None or POSITION_CHANNEL not in stream.ring.layout.slices:
+            continue
+        position = stream.ring.last(POSITION_CHANNEL)
+        if position is not None:
+            position_sources[stream.name].data = {'x': [position[0]], 'y': [position[1]]}
 
 curdoc().add_periodic_callback(update, 1000/SAMPLES_PER_SEC)
@@ -21,6 +21,26 @@ class SpeedController:
     def set_from_hal_data(self, hal_data, dt):
         pass
 
+    def set_hal_percent_vbus(self, hal_data, value):
+        """
+        Command a percent vbus through hal_data, as robot code would, so the next set_from_hal_data picks it up.
+        """
+        self.set_percent_vbus(value)
+
+    def init_hal_data(self, hal_data):
+        """
+        Add the entries this controller reads to a stand-in hal_data dictionary.
+        """
+        pass
+
+    def bind_hal_data(self, hal_data):
+        """
+        Resolve the hal_data entries this controller reads, so set_from_hal_data does not have to look them up.
+        pyfrc's reset_hal_data() keeps the hal_data dictionary but replaces its entries, so the containers they were
+        resolved from are kept too, and the entries are resolved again once a container is replaced.
+        """
+        pass
+
     def set_feedback_state_vector(self, state_vector):
         self.feedback_state_vector = state_vector
 
@@ -43,15 +63,31 @@ class PWMSpeedController(SpeedController):
     def __init__(self, motor, channel, noise=0.0001):
         self.channel = channel
         self.wpilib_type = None
+        self.hal_pwms = None
+        self.hal_pwm = None
         super().__init__(motor, noise)
 
     def set_from_hal_data(self, hal_data, dt):
         if hal_data['control']['enabled']:
-            percent_vbus = hal_data['pwm'][self.channel]['value']
+            if hal_data['pwm'] is not self.hal_pwms:
+                self.bind_hal_data(hal_data)
+            percent_vbus = self.hal_pwm['value']
         else:
             percent_vbus = 0
         self.set_percent_vbus(percent_vbus)
 
+    def bind_hal_data(self, hal_data):
+        self.hal_pwms = hal_data['pwm']
+        self.hal_pwm = self.hal_pwms[self.channel]
+
+    def set_hal_percent_vbus(self, hal_data, value):
+        hal_data['pwm'][self.channel]['value'] = value
+
+    def init_hal_data(self, hal_data):
+        pwm = hal_data.setdefault('pwm', [])
+        while len(pwm) <= self.channel:
+            pwm.append({'value': 0})
+
     def init_device(self):
         if self.wpilib_type is None:
             import wpilib
@@ -67,13 +103,16 @@ class CANTalonSpeedController(SpeedController):
     Simulates the dynamics of a Talon SRX speed controller
 
     This simulation currently covers the following modes: percentVbus, voltage, position, and velocity.
+    The closed-loop modes are emulated by a TalonBank, which DynamicsEngine shares between all CAN Talons.
     """
     def __init__(self, motor, can_id, noise=0.0001):
         self.can_id = can_id
         self.mode = 'percent_vbus'
-        self.last_vel = 0
         self.value = 0
         self.sensor = False
+        self.hal_can = None
+        self.hal_talon = None
+        self.talon_bank = None
 
         super().__init__(motor, noise)
 
@@ -81,64 +120,30 @@ class CANTalonSpeedController(SpeedController):
         self.sensor = encoder
         encoder.set_can_id(self.can_id)
 
+    def bind_hal_data(self, hal_data):
+        # The entry only exists once robot code has made the CANTalon
+        self.hal_can = hal_data['CAN']
+        self.hal_talon = self.hal_can.get(self.can_id, None)
+
     def set_from_hal_data(self, hal_data, dt):
-        if self.can_id not in hal_data['CAN']:
-            return
-        import hal
-        class Handle:
-            id = self.can_id
-        sensor_pos = hal.TalonSRX_GetSensorPosition(Handle())
-        sensor_vel = hal.TalonSRX_GetSensorVelocity(Handle())
+        if self.talon_bank is None:
+            self.talon_bank = TalonBank([self])
+        self.talon_bank.set_from_hal_data(hal_data, dt)
+
+    def set_hal_percent_vbus(self, hal_data, value):
         talon = hal_data['CAN'][self.can_id]
-        self.value = talon["value"]
-        percent_vbus = 0
-        if hal_data.get('profile_slot_select', 0) == 0:
-            p_gain = talon['profile0_p']
-            i_gain = talon['profile0_i']
-            d_gain = talon['profile0_d']
-            f_gain = talon['profile0_f']
-            izone = talon['profile0_izone']
-            close_loop_ramp_rate = talon['profile0_closeloopramprate']
-        else:
-            p_gain = talon['profile1_p']
-            i_gain = talon['profile1_i']
-            d_gain = talon['profile1_d']
-            f_gain = talon['profile1_f']
-            izone = talon['profile1_izone']
-            close_loop_ramp_rate = talon['profile1_closeloopramprate']
-        if hal_data['control']['enabled']:
-            if talon['mode_select'] == 0: # Percent vbus mode
-                percent_vbus = talon['value']
-            elif talon['mode_select'] == 1: # Position PID mode
-                if 'pid_iaccum' not in talon:
-                    talon['pid_iaccum'] = 0
-                talon['closeloop_err'] = talon['value'] - sensor_pos
-                talon['pid_iaccum'] += dt*talon['closeloop_err']
-                if izone != 0 and abs(talon['pid_iaccum']) > izone:
-                    talon['pid_iaccum'] = 0
-                output = p_gain*talon['closeloop_err']\
-                         + i_gain*talon['pid_iaccum']\
-                         - d_gain*sensor_vel \
-                         + f_gain*talon['value']
-                # Output is -1023 to 1023
-                percent_vbus = output/1023
-            elif talon['mode_select'] == 2: # Speed PID mode
-                if 'pid_accum' not in talon:
-                    talon['pid_iaccum'] = 0
-                talon['closeloop_err'] = talon['value'] - sensor_vel
-                talon['pid_iaccum'] += dt*talon['closeloop_err']
-                if izone != 0 and abs(['pid_iaccum']) > izone:
-                    talon['pid_iaccum'] = 0
-                output = p_gain*talon['closeloop_err']\
-                         + i_gain*talon['pid_iaccum']\
-                         + d_gain*(sensor_vel - self.last_vel)/dt \
-                         + f_gain*talon['value']
-                # Output is -1023 to 1023
-                percent_vbus = output/1023
-            elif talon['mode_select'] == 4:
-                percent_vbus = talon['value']/12
-        self.set_percent_vbus(percent_vbus)
-        self.last_vel = sensor_vel
+        talon['mode_select'] = 0
+        talon['value'] = value
+
+    def init_hal_data(self, hal_data):
+        talon = hal_data.setdefault('CAN', {}).setdefault(self.can_id, {})
+        talon.setdefault('value', 0)
+        talon.setdefault('mode_select', 0)
+        for profile in ['profile0', 'profile1']:
+            for gain in ['p', 'i', 'd', 'f', 'izone', 'closeloopramprate']:
+                talon.setdefault('{}_{}'.format(profile, gain), 0)
+        for key in ['enc_position', 'enc_velocity', 'sensor_position', 'sensor_velocity']:
+            talon.setdefault(key, 0)
 
     def init_device(self):
         import wpilib
@@ -153,6 +158,133 @@ class CANTalonSpeedController(SpeedController):
         return state
 
 
+class TalonBank:
+    """
+    Emulates the Talon SRX firmware of many CANTalonSpeedControllers at once, with their modes, gains and
+    integrators held in arrays so every closed-loop update is one vectorized step.
+
+    Like the firmware, the closed loop runs every LOOP_PERIOD seconds, so a physics tick of dt seconds runs
+    dt/LOOP_PERIOD loops and the output is averaged over them. Every loop the integrator accumulates the error,
+    unless the error is outside the izone which clears it, the derivative term acts on the change of the error
+    since the last loop, the closed loop ramp rate limits the change of the output and the output is clamped to
+    +/-1023. The sensor values only change at physics ticks, so they are held between loops.
+
+    The gains are in the firmware's units, per loop. The emulation before TalonBank integrated and differentiated
+    the error over seconds instead, gains tuned against it can be kept with per_second_gains.
+    """
+
+    LOOP_PERIOD = .001
+    GAINS = ['p', 'i', 'd', 'f', 'izone', 'closeloopramprate']
+    MODE_PERCENT_VBUS = 0
+    MODE_POSITION = 1
+    MODE_SPEED = 2
+    MODE_VOLTAGE = 4
+
+    def __init__(self, controllers, per_second_gains=False):
+        """
+        :param per_second_gains: Read the i gain as per error second and the d gain as per error per second,
+        and convert them to firmware units.
+        """
+        self.controllers = list(controllers)
+        self.per_second_gains = per_second_gains
+        count = len(self.controllers)
+        self.present = np.zeros(count, dtype=bool)
+        self.mode = np.zeros(count, dtype=int)
+        self.last_mode = np.full(count, -1, dtype=int)
+        self.value = np.zeros(count)
+        self.gains = np.zeros((len(self.GAINS), count))
+        self.sensor_position = np.zeros(count)
+        self.sensor_velocity = np.zeros(count)
+        self.iaccum = np.zeros(count)
+        self.error = np.zeros(count)
+        self.last_error = np.zeros(count)
+        self.output = np.zeros(count)
+        self.percent_vbus = np.zeros(count)
+
+    def read_hal_data(self, hal_data):
+        for i, controller in enumerate(self.controllers):
+            if controller.hal_talon is None or hal_data['CAN'] is not controller.hal_can:
+                controller.bind_hal_data(hal_data)
+            talon = controller.hal_talon
+            self.present[i] = talon is not None
+            if talon is None:
+                continue
+            self.mode[i] = talon['mode_select']
+            self.value[i] = talon['value']
+            profile = 'profile0' if talon.get('profile_slot_select', 0) == 0 else 'profile1'
+            for j, gain in enumerate(self.GAINS):
+                self.gains[j, i] = talon.get('{}_{}'.format(profile, gain), 0)
+            # What hal.TalonSRX_GetSensorPosition and GetSensorVelocity return in simulation
+            self.sensor_position[i] = talon['sensor_position']
+            self.sensor_velocity[i] = talon['sensor_velocity']
+
+    def step(self, dt, enabled=True):
+        """
+        Run the closed loops for the dt/LOOP_PERIOD firmware loops of a physics tick.
+        :returns the percent vbus of every controller, averaged over the loops.
+        """
+        p_gain, i_gain, d_gain, f_gain, izone, ramp_rate = self.gains
+        if self.per_second_gains:
+            i_gain = i_gain*self.LOOP_PERIOD
+            d_gain = d_gain/self.LOOP_PERIOD
+        position_mode = self.mode == self.MODE_POSITION
+        closed_loop = (position_mode | (self.mode == self.MODE_SPEED)) & enabled
+        # The firmware clears the closed loop state when the mode changes or the robot is disabled
+        reset = (self.mode != self.last_mode) | ~closed_loop
+        self.iaccum[reset] = 0
+        self.output[reset] = 0
+        self.last_mode = self.mode.copy()
+
+        measurement = np.where(position_mode, self.sensor_position, self.sensor_velocity)
+        error = self.value - measurement
+        self.last_error[reset] = error[reset]
+        loops = max(1, int(round(dt/self.LOOP_PERIOD)))
+        # Every loop of the tick sees the same error, so the integrator of each loop is known up front
+        # and only the first loop sees a change of the error, size==[loops controllers]
+        in_izone = (izone == 0) | (np.abs(error) <= izone)
+        iaccum = np.where(in_izone, self.iaccum + np.arange(1, loops + 1)[:, None]*error, 0)
+        derivative = np.zeros((loops, len(self.controllers)))
+        derivative[0] = error - self.last_error
+        outputs = p_gain*error + i_gain*iaccum + d_gain*derivative + f_gain*self.value
+        ramped = ramp_rate > 0
+        if (ramped & closed_loop).any():
+            # Each loop's ramp starts from the output of the loop before
+            output = self.output
+            for loop in range(loops):
+                limited = np.clip(outputs[loop], output - ramp_rate, output + ramp_rate)
+                # Output is -1023 to 1023
+                output = outputs[loop] = np.clip(np.where(ramped, limited, outputs[loop]), -1023, 1023)
+        else:
+            outputs = np.clip(outputs, -1023, 1023)
+        self.iaccum = np.where(closed_loop, iaccum[-1], 0)
+        self.output = np.where(closed_loop, outputs[-1], 0)
+        self.last_error = error
+        self.error = error
+
+        percent_vbus = np.zeros(len(self.controllers))
+        if enabled:
+            percent_vbus = np.where(self.mode == self.MODE_PERCENT_VBUS, self.value, percent_vbus)
+            percent_vbus = np.where(self.mode == self.MODE_VOLTAGE, self.value/12, percent_vbus)
+            percent_vbus = np.where(closed_loop, outputs.mean(axis=0)/1023, percent_vbus)
+        self.percent_vbus = np.where(self.present, percent_vbus, 0)
+        return self.percent_vbus
+
+    def write_hal_data(self):
+        for i, controller in enumerate(self.controllers):
+            if not self.present[i]:
+                continue
+            talon = controller.hal_talon
+            talon['closeloop_err'] = self.error[i]
+            talon['pid_iaccum'] = self.iaccum[i]
+            controller.value = self.value[i]
+            controller.set_percent_vbus(self.percent_vbus[i])
+
+    def set_from_hal_data(self, hal_data, dt):
+        self.read_hal_data(hal_data)
+        self.step(dt, hal_data['control']['enabled'])
+        self.write_hal_data()
+
+
 #class CANTalonSpeedControllerFeedback(CANTalonSpeedController):
 #
 #    def __init__(self, motor, can_id, noise=0.0001):
@@ -4,21 +4,85 @@ import numpy as np
 
 
 class Cost:
+    """
+    A term of the cost function that DynamicsEngine compiles for trajectory optimization.
+    get_cost() is charged at every step of a trajectory and get_final_cost() once at its end.
+    """
 
     def get_cost(self):
-        pass
+        return 0
+
+    def get_final_cost(self):
+        return 0
 
 
 class TwoDimensionalGaussianPositionalCost(Cost):
+    """
+    Gaussian bumps of cost (or reward, with negative values) centered on positions of a two dimensional load
+    """
 
-    def __init__(self, load):
-        self.positions = theano.shared(np.array([[0.0, 0.0, 0.0]]), theano.config.floatX)
-        self.values = theano.shared(np.array([0.0]), theano.config.floatX)
-        self.deviations = theano.shared(np.array([0.0]), theano.config.floatX)
+    def __init__(self, load, positions=((0.0, 0.0, 0.0),), values=(0.0,), deviations=(1.0,)):
+        self.positions = theano.shared(np.array(positions, dtype=float), theano.config.floatX)
+        self.values = theano.shared(np.array(values, dtype=float), theano.config.floatX)
+        self.deviations = theano.shared(np.array(deviations, dtype=float), theano.config.floatX)
         self.load = load
 
     def get_cost(self):
-        delta_position = self.positions - self.load.position.dimshuffle(0, 'x')
+        delta_position = self.positions - self.load.position.dimshuffle('x', 0)
         goal_distance = T.sum(delta_position**2, axis=1)
         cost = self.values*T.exp(-goal_distance/(2*self.deviations)**2)
         return T.sum(cost)
+
+
+class ControlEffortCost(Cost):
+    """
+    Quadratic cost on the percent vbus of one or more speed controllers
+    """
+
+    def __init__(self, controllers, weight=1.0):
+        if not isinstance(controllers, list):
+            controllers = [controllers]
+        self.controllers = controllers
+        self.weight = weight
+
+    def get_cost(self):
+        return self.weight*sum(controller.percent_vbus**2 for controller in self.controllers)
+
+
+class TerminalPositionalCost(Cost):
+    """
+    Smooth absolute distance (pseudo-Huber) between a load's final position and a goal
+    """
+
+    def __init__(self, load, goal, weights=1.0, smoothness=.1):
+        self.load = load
+        self.goal = np.array(goal, dtype=float)
+        self.weights = weights
+        self.smoothness = smoothness
+
+    def get_final_cost(self):
+        delta_position = self.load.position - self.goal
+        return T.sum(self.weights*(T.sqrt(delta_position**2 + self.smoothness**2) - self.smoothness))
+
+
+class StateLimitCost(Cost):
+    """
+    Quadratic penalty on a state leaving the range [lower, upper]
+    """
+
+    def __init__(self, state, lower=-np.inf, upper=np.inf, weight=1.0, final=True):
+        self.state = state
+        self.lower = lower
+        self.upper = upper
+        self.weight = weight
+        self.final = final
+
+    def get_cost(self):
+        over = T.maximum(self.state - self.upper, 0)
+        under = T.maximum(self.lower - self.state, 0)
+        return self.weight*T.sum(over**2 + under**2)
+
+    def get_final_cost(self):
+        if self.final:
+            return self.get_cost()
+        return 0
@@ -17,6 +17,20 @@ class Sensor:
         """
         pass
 
+    def init_hal_data(self, hal_data):
+        """
+        Add the entries this sensor writes to a stand-in hal_data dictionary.
+        """
+        pass
+
+    def bind_hal_data(self, hal_data):
+        """
+        Resolve the hal_data entries this sensor writes, so update_hal_data does not have to look them up.
+        Like SpeedController.bind_hal_data, the containers the entries were resolved from are kept as well, so
+        update_hal_data can resolve them again after pyfrc's reset_hal_data() replaces them.
+        """
+        pass
+
     def set_device_object(self, device):
         """
         Set the wpilib device reference for this sensor
@@ -43,6 +57,8 @@ class Encoder(Sensor):
         self.b_channel = b_channel
         self.tics_per_rev = tics_per_rev
         self.variance = variance
+        self.hal_encoders = None
+        self.hal_encoder = None
         super().__init__()
 
     def get_state(self, add_noise=False):
@@ -61,12 +77,29 @@ class Encoder(Sensor):
         }
 
     def update_hal_data(self, hal_data, dt, add_noise=False):
-        state = self.get_state(add_noise)
-        for encoder in hal_data['encoder']:
+        if self.hal_encoder is None or hal_data['encoder'] is not self.hal_encoders:
+            # The encoder is configured once robot code has made it
+            self.bind_hal_data(hal_data)
+            if self.hal_encoder is None:
+                return
+        position = self.position.get_value()
+        if add_noise:
+            position += np.random.normal(0, math.sqrt(self.variance))
+        self.hal_encoder['count'] = position*self.tics_per_rev
+
+    def bind_hal_data(self, hal_data):
+        self.hal_encoders = hal_data['encoder']
+        self.hal_encoder = None
+        for encoder in self.hal_encoders:
             if encoder['config'].get('ASource_Channel', None) == self.a_channel:
-                encoder['count'] = state["position"]*self.tics_per_rev
+                self.hal_encoder = encoder
                 return
 
+    def init_hal_data(self, hal_data):
+        encoders = hal_data.setdefault('encoder', [])
+        if not any(encoder['config'].get('ASource_Channel', None) == self.a_channel for encoder in encoders):
+            encoders.append({'config': {'ASource_Channel': self.a_channel, 'BSource_Channel': self.b_channel}, 'count': 0})
+
     def init_device(self):
         import wpilib
         self.device = wpilib.Encoder(self.a_channel, self.b_channel)
@@ -92,14 +125,27 @@ class CANTalonEncoder(Encoder):
 
     def set_can_id(self, can_id):
         self.can_id = can_id
+        self.hal_can = None
 
     def update_hal_data(self, hal_data, dt, add_noise=False):
+        if self.hal_encoder is None or hal_data['CAN'] is not self.hal_can:
+            self.bind_hal_data(hal_data)
+            if self.hal_encoder is None:
+                return
         state = self.get_state(add_noise)
-        if self.can_id in hal_data['CAN']:
-            hal_data['CAN'][self.can_id]['enc_position'] = state["position"]*self.tics_per_rev
-            hal_data['CAN'][self.can_id]['enc_velocity'] = state["velocity"]*self.tics_per_rev*60
-            hal_data['CAN'][self.can_id]['sensor_position'] = state["position"]*self.tics_per_rev
-            hal_data['CAN'][self.can_id]['sensor_velocity'] = state["velocity"]*self.tics_per_rev*60
+        talon = self.hal_encoder
+        talon['enc_position'] = talon['sensor_position'] = state["position"]*self.tics_per_rev
+        talon['enc_velocity'] = talon['sensor_velocity'] = state["velocity"]*self.tics_per_rev*60
+
+    def bind_hal_data(self, hal_data):
+        # The CAN entry stands in for the encoder entry
+        self.hal_can = hal_data['CAN']
+        self.hal_encoder = self.hal_can.get(self.can_id, None)
+
+    def init_hal_data(self, hal_data):
+        talon = hal_data.setdefault('CAN', {}).setdefault(self.can_id, {})
+        for key in ['enc_position', 'enc_velocity', 'sensor_position', 'sensor_velocity']:
+            talon.setdefault(key, 0)
 
     def poll_sensor(self):
         self.position.set_value(self.device.getPosition()/self.tics_per_rev)
@@ -113,13 +159,26 @@ class AnalogGyro(Sensor):
         self.angle = theano.shared(0.0, theano.config.floatX)
         self.channel = analog_channel
         self.variance = variance
+        self.hal_analog_ins = None
+        self.hal_analog_in = None
         super().__init__()
 
     def update_hal_data(self, hal_data, dt, add_noise=False):
         angle = self.angle.get_value()
         if add_noise:
             angle += np.random.normal(0, math.sqrt(self.variance))
-        hal_data['analog_in'][self.channel]['accumulator_value'] = math.degrees(angle) / 2.7901785714285715e-12
+        if hal_data['analog_in'] is not self.hal_analog_ins:
+            self.bind_hal_data(hal_data)
+        self.hal_analog_in['accumulator_value'] = math.degrees(angle) / 2.7901785714285715e-12
+
+    def bind_hal_data(self, hal_data):
+        self.hal_analog_ins = hal_data['analog_in']
+        self.hal_analog_in = self.hal_analog_ins[self.channel]
+
+    def init_hal_data(self, hal_data):
+        analog_in = hal_data.setdefault('analog_in', [])
+        while len(analog_in) <= self.channel:
+            analog_in.append({'accumulator_value': 0})
 
     def init_device(self):
         import wpilib
@@ -156,6 +215,9 @@ class NavX(Sensor):
             angle += np.random.normal(0, math.sqrt(self.gyro_variance))
         hal_data['robot']['navxmxp_i2c_1_angle'] = math.degrees(self.angle.get_value())
 
+    def init_hal_data(self, hal_data):
+        hal_data.setdefault('robot', {}).setdefault('navxmxp_i2c_1_angle', 0)
+
     def init_sensor(self):
         from robotpy_ext.common_drivers import navx
         self.device = navx.AHRS.create_spi()
@@ -10,10 +10,13 @@ from os import makedirs
 import pickle
 import threading
 import hashlib
+import json
 import sys
-from theano.tensor import slinalg
+from theano.tensor import nlinalg
 
 from int_dynamics import utilities
+from int_dynamics import telemetry
+from int_dynamics.dynamics.components.controllers import CANTalonSpeedController, TalonBank
 
 try:
     import simplestreamer
@@ -28,10 +31,34 @@ class DynamicsEngine:
     SINK_TO_SIMPLESTREAMER = False
     SS_SIM_PORT = 5803
     SS_EST_PORT = 5804
+    # Binary telemetry, see int_dynamics.telemetry
+    SINK_TO_TELEMETRY = False
+    TELEMETRY_SIM_PORT = 5813
+    TELEMETRY_EST_PORT = 5814
+    # Publishes per second and change deadbands for NetworkTables, by telemetry field name prefix
+    NT_PUBLISH_RATES = {}
+    NT_DEFAULT_PUBLISH_RATE = 20
+    NT_DEADBANDS = {}
+    NT_DEFAULT_DEADBAND = 1e-4
+    # Opt in to sending telemetry from a background thread, dropping the oldest frames when more than
+    # SINK_QUEUE_SIZE are waiting, so slow sends cannot stall the control loop
+    SINK_IN_BACKGROUND = False
+    SINK_QUEUE_SIZE = 4
 
     RAM_CLEAN = True
 
+    # Read the emulated Talon SRX i and d gains per second, as the emulation before TalonBank did, instead of
+    # in the firmware's per loop units
+    TALON_PER_SECOND_GAINS = False
+
     DEBUG_VERBOSITY = 0
+    # Check tensors up to this verbosity for nans with a single flag compiled into simulation_func
+    DEBUG_CHECK_VERBOSITY = None
+    # Only run the debug checkup every Nth simulation_update
+    DEBUG_CHECK_INTERVAL = 1
+
+    # Compile simulation_func and estimation_func with theano's op-level profiling, see get_graph_profile()
+    PROFILE_FUNCTIONS = False
 
     def __init__(self, mode="simulation"):
         self.mode = mode
@@ -45,6 +72,9 @@ class DynamicsEngine:
         self.simulation_func = None
 
         self.estimation_func = None
+        self.optimization_func = None
+        self.cost_func = None
+        self.cost_derivatives_func = None
         self.state_flush_func = None
         self.sensor_flush_func = None
 
@@ -61,14 +91,20 @@ class DynamicsEngine:
 
         self.state_estimation_mean_update = None
         self.state_estimation_covariance_update = None
+        # Difference between the sensor values and their prediction, and its variance, as of the last estimation
+        self.innovation = None
+        self.innovation_variance = None
+        self.innovation_updates = []
 
         self.state_flush_updates = []
         self.sensor_flush_updates = []
 
-        self.feedback_gains_clock = theano.shared(np.array([0.0]), theano.config.floatX)
-        self.feedback_gains = theano.shared(np.array([[[0.0]]]), theano.config.floatX)
-        self.feedback_gains_progress_update = None
-        self.feedback_gains_progression_func = None
+        # Time-varying feedback controller followed by feedback_update()
+        self.feedback_gains_clock = 0.0
+        self.feedback_gains_dt = None
+        self.feedback_gains = None
+        self.feedback_controls = None
+        self.feedback_states = None
 
         self.sensor_value_list = []
         self.sensor_prediction_list = []
@@ -76,9 +112,22 @@ class DynamicsEngine:
 
         self.dt = theano.shared(0.0, theano.config.floatX)
         self.tic_time = 0
+        self.profiler = utilities.TickProfiler()
 
         self.sd = None
+        self.nt_publisher = None
         self.streamer = None
+        self.sink_thread = None
+        self.recorder = None
+        self.hal_data = None
+        self.hal_controllers = []
+        self.hal_sensors = []
+        self.talon_bank = None
+        self.telemetry_server = None
+        self.telemetry_layout = None
+        self.telemetry_frame = None
+        self.telemetry_state_size = 0
+        self.telemetry_sensor_fields = None
 
         self.rebuild_functions()
 
@@ -125,16 +174,31 @@ class DynamicsEngine:
         return obj
 
     def rebuild_functions(self):
+        if self.PROFILE_FUNCTIONS:
+            # Keep full creation stack traces on graph variables so profiled ops can be traced to components,
+            # only while this engine's graphs are built
+            with theano.configparser.change_flags(**{"traceback.limit": -1}):
+                return self._rebuild_functions()
+        return self._rebuild_functions()
+
+    def _rebuild_functions(self):
         rebuild_count = 0
-        if self.mode in ["simulation", "estimation"] and self.simulation_func is None:
+        # optimization_update() follows a feedback controller from the estimated state, so it needs both
+        if self.mode in ["simulation", "estimation", "optimization"] and self.simulation_func is None:
             self.build_simulation_function()
             rebuild_count += 1
         if self.mode in ["simulation"] and self.sensor_flush_func is None:
                 self.build_sensor_flush_function()
                 rebuild_count += 1
-        if self.mode in ["estimation"] and self.estimation_func is None:
+        if self.mode in ["estimation", "optimization"] and self.estimation_func is None:
                 self.build_estimation_function()
                 rebuild_count += 1
+        if self.mode in ["optimization"] and self.optimization_func is None:
+            self.build_optimization_function()
+            rebuild_count += 1
+        if self.mode in ["optimization"] and len(self.costs) > 0 and self.cost_func is None:
+            self.build_cost_function()
+            rebuild_count += 1
         if self.state_flush_func is None:
             self.build_state_flush_function()
             rebuild_count += 1
@@ -148,6 +212,7 @@ class DynamicsEngine:
 
         del self.state_estimation_mean_update
         del self.state_estimation_covariance_update
+        del self.innovation_updates
 
         del self.state_flush_updates
         del self.sensor_flush_updates
@@ -155,29 +220,7 @@ class DynamicsEngine:
 
     def build_simulation_function(self):
         if self.state_prediction_mean_update is None:
-            print("Building dynamics engine simulation updates. This may take a while depending on how complex your model is.")
-            self.build_loads()
-            debugger = utilities.DebugTensorLogger(self.DEBUG_VERBOSITY)
-            self.state_prediction_debugger = debugger
-
-            # Build state data
-            self.state_list, state_derivative_list, state_vector = self._build_states_and_derivatives(state_order=self.state_list)
-            debugger.add_tensor(state_vector, "input state prediction mean", 1)
-            previous_state_covariance = ifelse.ifelse(T.eq(self.state_covariance.shape[0], 1), T.zeros((state_vector.shape[0],state_vector.shape[0])), self.state_covariance)
-            debugger.add_tensor(previous_state_covariance, "input state prediction covariance", 1)
-
-            # Run state prediction
-            self.state_prediction_mean_update, \
-            self.state_prediction_derivative_update, \
-            self.state_prediction_covariance_update = self._build_prediction(
-                state_derivative_list,
-                state_vector,
-                previous_state_covariance,
-                debugger=debugger
-            )
-            debugger.add_tensor(self.state_prediction_mean_update, "state prediction mean", 1)
-            debugger.add_tensor(self.state_prediction_derivative_update, "state prediction derivative", 2)
-            debugger.add_tensor(self.state_prediction_covariance_update, "state prediction covariance", 1)
+            self.build_prediction_updates()
 
         print("Building dynamics engine simulation function. This may take a while depending on how complex your model is.")
         # Simulation update function
@@ -187,14 +230,41 @@ class DynamicsEngine:
             (self.state_covariance, self.state_prediction_covariance_update)
         ])
         state_updates.extend(self.state_prediction_debugger.get_updates())
-        self.simulation_func = theano.function([], [], updates=state_updates)
+        self.simulation_func = theano.function([], [], updates=state_updates, profile=self.PROFILE_FUNCTIONS)
+
+    def build_prediction_updates(self):
+        print("Building dynamics engine simulation updates. This may take a while depending on how complex your model is.")
+        self.build_loads()
+        debugger = utilities.DebugTensorLogger(self.DEBUG_VERBOSITY, self.DEBUG_CHECK_VERBOSITY,
+                                               self.DEBUG_CHECK_INTERVAL)
+        self.state_prediction_debugger = debugger
+
+        # Build state data
+        self.state_list, state_derivative_list, state_vector = self._build_states_and_derivatives(state_order=self.state_list)
+        debugger.add_tensor(state_vector, "input state prediction mean", 1)
+        previous_state_covariance = ifelse.ifelse(T.eq(self.state_covariance.shape[0], 1), T.zeros((state_vector.shape[0],state_vector.shape[0])), self.state_covariance)
+        debugger.add_tensor(previous_state_covariance, "input state prediction covariance", 1)
+
+        # Run state prediction
+        self.state_prediction_mean_update, \
+        self.state_prediction_derivative_update, \
+        self.state_prediction_covariance_update = self._build_prediction(
+            state_derivative_list,
+            state_vector,
+            previous_state_covariance,
+            debugger=debugger
+        )
+        debugger.add_tensor(self.state_prediction_mean_update, "state prediction mean", 1)
+        debugger.add_tensor(self.state_prediction_derivative_update, "state prediction derivative", 2)
+        debugger.add_tensor(self.state_prediction_covariance_update, "state prediction covariance", 1)
 
     def build_estimation_function(self):
         if self.state_estimation_mean_update is None:
             print("Building dynamics engine estimation updates. This may take a bit depending on how complex your model is.")
+            self.build_sensor_lists()
             if len(self.sensor_prediction_list) == 0:
                 self.state_estimation_covariance_update = self.state_covariance
-                self.state_estimation_mean_update = T.addbroadcast(self.state_mean, 1)
+                self.state_estimation_mean_update = self.state_mean[:, 0]
             else:
                 # What we think the sensor values should be
                 sensor_prediction = T.stack(self.sensor_prediction_list)
@@ -207,13 +277,23 @@ class DynamicsEngine:
                 )
                 sensor_values = T.stack(self.sensor_value_list)
 
+                # Keep the innovations and their variances for the normalized innovation squared consistency check
+                sensor_count = len(self.sensor_value_list)
+                self.innovation = theano.shared(np.zeros(sensor_count), theano.config.floatX)
+                self.innovation_variance = theano.shared(np.ones(sensor_count), theano.config.floatX)
+                self.innovation_updates = [
+                    (self.innovation, sensor_values - sensor_prediction),
+                    (self.innovation_variance, T.diag(sensor_covariance))
+                ]
+
                 # Run state prediction
                 self.state_estimation_mean_update, self.state_estimation_covariance_update = self._build_estimation(
                     sensor_prediction,
                     sensor_values,
                     sensor_covariance,
                     sensor_state_derivative,
-                    self.state_mean,
+                    # The state mean is a column, the correction is a vector
+                    self.state_mean[:, 0],
                     self.state_covariance
                 )
         print("Building dynamics engine estimation function. This may take a bit depending on how complex your model is.")
@@ -221,106 +301,97 @@ class DynamicsEngine:
         state_updates = ([
             (self.state_mean, T.unbroadcast(self.state_estimation_mean_update.dimshuffle(0, 'x'), 1)),
             (self.state_covariance, self.state_estimation_covariance_update)
-        ])
-        self.estimation_func = theano.function([], [], updates=state_updates)
+        ] + self.innovation_updates)
+        self.estimation_func = theano.function([], [], updates=state_updates, profile=self.PROFILE_FUNCTIONS)
 
     def build_optimization_function(self):
-        if self.feedback_gains_progress_update is None:
-            # Index our controllers into a list
-            for controller in self.controllers:
-                self.controller_list.append(controller)
-            # Step forward in time from the current state over self.feedback_gains_clock
-            result, updates = theano.scan(
-                    fn=self._simulation_scan_func,
-                    sequences=[
-                        dict(input=self.feedback_gains_clock, taps=[-1, 0]),
-                        self.feedback_gains
-                    ],
-            )
-
-    # This inner scan function steps the simulation forward in time from prev_time to new_time each iteration
-    def _simulation_scan_func(self, prev_time, new_time, feedback_gains, state_mean_covariance, state_covariance_covariance):
-        # Hard-set dt
-        self.dt = new_time - prev_time
-
-        feedback_state = T.concatenate((self.state_estimation_mean_update, self.state_estimation_covariance_update.flatten()))
-
-        # Hard-set controllers to respond to feedback gains
+        if self.state_prediction_mean_update is None:
+            self.build_prediction_updates()
+        print("Building dynamics engine optimization function. This may take a while depending on how complex your model is.")
+        # Index our controllers into a list, this is the order of the control vector
+        self.controller_list = list(self.controllers)
+        controls = [self.controllers[controller].percent_vbus for controller in self.controller_list]
+
+        # Derivative of the new state with respect to the controls
+        _, control_derivative = utilities.get_list_derivative(self.state_prediction_mean_update, controls)
+        outputs = [self.state_prediction_mean_update, self.state_prediction_derivative_update, control_derivative]
+
+        # Substitute rows of the state and control batches for the shared state, controls and dt
+        def step(state_row, control_row, dt):
+            return self._clone_with_vectors(outputs, state_row, control_row, dt)
+
+        states = T.dmatrix("states")
+        controls_in = T.dmatrix("controls")
+        dt = T.dscalar("dt")
+        results, _ = theano.map(step, sequences=[states, controls_in], non_sequences=[dt])
+        self.optimization_func = theano.function([states, controls_in, dt], results)
+
+    def build_cost_function(self):
+        print("Building dynamics engine cost function.")
+        self.controller_list = list(self.controllers)
+        state_row = T.dvector("state")
+        control_row = T.dvector("control")
+        running_cost = T.as_tensor_variable(sum(self.costs[cost].get_cost() for cost in self.costs))
+        final_cost = T.as_tensor_variable(sum(self.costs[cost].get_final_cost() for cost in self.costs))
+        running_cost, final_cost = self._clone_with_vectors([running_cost, final_cost], state_row, control_row)
+
+        # Analytic gradients and Hessians of both costs with respect to the state and controls
+        def derivatives(cost):
+            cx = T.grad(cost, state_row, disconnected_inputs='ignore')
+            cu = T.grad(cost, control_row, disconnected_inputs='ignore')
+            cxx = theano.gradient.jacobian(cx, state_row, disconnected_inputs='ignore')
+            cxu = theano.gradient.jacobian(cx, control_row, disconnected_inputs='ignore')
+            cuu = theano.gradient.jacobian(cu, control_row, disconnected_inputs='ignore')
+            return [cx, cu, cxx, cxu, cuu]
+
+        running_outputs = [running_cost] + derivatives(running_cost)
+        final_outputs = [final_cost] + derivatives(final_cost)
+
+        def step(state, control):
+            replacements = {state_row: state, control_row: control}
+            return theano.clone(running_outputs + final_outputs, replace=replacements)
+
+        states = T.dmatrix("states")
+        controls = T.dmatrix("controls")
+        results, _ = theano.map(step, sequences=[states, controls])
+        self.cost_func = theano.function([states, controls], [results[0], results[6]])
+        self.cost_derivatives_func = theano.function([states, controls], results)
+
+    def _clone_with_vectors(self, outputs, state_row, control_row, dt=None):
+        """
+        Rebuild the given expressions of the shared state, controller percent vbus and dt in terms of
+        a state vector ordered as self.state_list and a control vector ordered as self.controller_list.
+        """
+        replacements = {}
+        if dt is not None:
+            replacements[self.dt] = dt
+        index = 0
+        for state in self.state_list:
+            shape = np.shape(state.get_value())
+            size = int(np.prod(shape))
+            replacements[state] = state_row[index:index+size].reshape(shape, ndim=len(shape))
+            index += size
         for i in range(len(self.controller_list)):
-            self.controller_list[i].percent_vbus = T.dot(feedback_gains[i], feedback_state)
-
-        self.state_list, state_derivative_list, state_vector = self._build_states_and_derivatives(state_order=self.state_list)
-
-        # Get new predicted state
-        self.state_prediction_mean_update, \
-        self.state_prediction_derivative_update, \
-        self.state_prediction_covariance_update = self._build_prediction(state_derivative_list, state_vector, self.state_covariance)
-
-        # Get predicted sensor values
-        for sensor in self.sensors:
-            value_predictions = self.sensors[sensor].get_value_prediction()
-            for sensor_value in value_predictions:
-                self.sensor_value_list.append(sensor_value)
-                self.sensor_prediction_list.append(value_predictions[sensor_value])
-
-        # What we think the sensor values should be
-        sensor_prediction = T.stack(self.sensor_prediction_list)
-
-        # Derivative of the sensor prediction with respect to the state prediction
-        _, sensor_state_derivative = utilities.get_list_derivative(self.sensor_prediction_list, self.state_list)
-        # Covariance of the predicted sensor values
-        sensor_covariance = utilities.get_covariance_matrix_from_object_dict(
-            sensor_prediction, self.sensors, {sensor_state_derivative: self.state_prediction_covariance_update}
-        )
-        sensor_values = sensor_prediction + 0
-
-        # Run state estimation, but with substituting the sensor prediction for the sensor value
-        # The reason for this is to simulate the best case scenario, adding in covariance later
-        self.state_estimation_mean_update, self.state_estimation_covariance_update = self._build_estimation(
-            sensor_prediction,
-            sensor_values,
-            sensor_covariance,
-            sensor_state_derivative,
-            self.state_prediction_mean_update,
-            self.state_prediction_covariance_update
-        )
-
-        _, state_estimation_mean_sensor_value_derivative = utilities.get_list_derivative(self.state_estimation_mean_update, sensor_values)
-        _, state_estimation_covariance_sensor_value_derivative = utilities.get_list_derivative(self.state_estimation_covariance_update_update, sensor_values)
-
-        state_mean_covariance = utilities.get_covariance_matrix({
-            state_estimation_mean_sensor_value_derivative: sensor_covariance,
-        })
-        state_covariance_covariance = utilities.get_covariance_matrix({
-            state_estimation_covariance_sensor_value_derivative: sensor_covariance,
-        })
-
-        # Now we update the worst-case scenario, calculating the covariance of both state mean and covariance
-        pesssimistic_state_covariance = utilities.get_covariance_matrix()
-
-        updates = self._build_state_updates(self.state_estimation_mean_update)
-        updates.extend([
-            (self.state_mean, self.state_estimation_mean_update),
-            (self.state_covariance, self.state_estimation_covariance_update)
-        ])
-
-
-
-        previous_cost = T.sum([cost.get_cost() for cost in self.costs])
-        return [self.state_estimation_mean_update, self.state_estimation_covariance_update, previous_cost, feedback_state], updates
+            replacements[self.controllers[self.controller_list[i]].percent_vbus] = control_row[i]
+        return theano.clone(outputs, replace=replacements)
 
     def build_state_flush_function(self):
         if len(self.state_flush_updates) == 0:
             self.state_flush_updates = self._build_state_updates(self.state_mean)
         self.state_flush_func = theano.function([], [], updates=self.state_flush_updates)
 
-    def build_sensor_flush_function(self):
-        if len(self.sensor_flush_updates) < 0:
+    def build_sensor_lists(self):
+        # The shared value of every sensor, and its prediction from the state
+        if len(self.sensor_value_list) == 0:
             for sensor in self.sensors:
                 value_predictions = self.sensors[sensor].get_value_prediction()
                 for sensor_value in value_predictions:
                     self.sensor_value_list.append(sensor_value)
                     self.sensor_prediction_list.append(value_predictions[sensor_value])
+
+    def build_sensor_flush_function(self):
+        if len(self.sensor_flush_updates) == 0:
+            self.build_sensor_lists()
             # Sensor value update function
             self.sensor_flush_updates = [(value, prediction) for value, prediction in zip(self.sensor_value_list, self.sensor_prediction_list)]
         self.sensor_flush_func = theano.function([], [], updates=self.sensor_flush_updates)
@@ -379,23 +450,17 @@ class DynamicsEngine:
             debugger.add_tensor(A, "ODE A matrix")
             debugger.add_tensor(b, "ODE b matrix")
 
-        # Equation given by http://math.stackexchange.com/a/1567806/294141
-        # Taylor series method
-        init_term = T.identity_like(A)*self.dt
-
-        def series_advance(i, last_term, A, wrt):
-            next_term = T.dot(last_term, A)*wrt/i
-            next_term = T.unbroadcast(next_term, 0, 1)
-            return next_term, theano.scan_module.until(T.all(abs(next_term) < 10e-6))
-        terms, _ = theano.scan(series_advance,
-                               sequences=[T.arange(2, 150)],
-                               non_sequences=[A, self.dt],
-                               outputs_info=init_term,
-                               )
-        integral = T.sum(terms, axis=0) + init_term
+        # The exact solution of x' = Ax + b over dt, from the exponential of the augmented matrix [[A, b], [0, 0]]:
+        # its top left block is expm(A*dt) and its top right block the integral of expm(A*s) over s from 0 to dt,
+        # times b. Unlike summing the integral's Taylor series in a scan that stops on convergence, this has an
+        # exact gradient.
+        augmented = T.concatenate([T.concatenate([A, b], axis=1), T.zeros((1, A.shape[1] + 1))], axis=0)
+        transition = utilities.expm(augmented*self.dt)
+        state_count = A.shape[0]
 
         # The mean prediction of the new state
-        prediction_mean = (T.dot(slinalg.expm(A*self.dt), state_vector) + T.dot(integral, b)).flatten()
+        prediction_mean = (T.dot(transition[:state_count, :state_count], state_vector) +
+                           transition[:state_count, state_count:]).flatten()
 
         # Derivative of the new state with respect to last state
         _,  prediction_derivative = utilities.get_list_derivative(prediction_mean, self.state_list)
@@ -410,7 +475,7 @@ class DynamicsEngine:
 
     def _build_estimation(self, sensor_prediction, sensor_values, sensor_covariance, sensor_derivative, state_mean, state_covariance):
         # From the state prediction and the sensor data, we get the state estimation via a kalman filter
-        kalman = T.dot(T.dot(state_covariance, sensor_derivative.T), T.inv(sensor_covariance))
+        kalman = T.dot(T.dot(state_covariance, sensor_derivative.T), nlinalg.matrix_inverse(sensor_covariance))
         estimation_mean = state_mean + T.dot(kalman, sensor_values - sensor_prediction)
         estimation_covariance = \
             T.dot(
@@ -441,20 +506,51 @@ class DynamicsEngine:
         pass
 
     def sink_state_data(self):
-        state_data = {
-            "sensors": {},
-            "controllers": {},
-            "loads": {},
-            "tic_time": self.tic_time
-        }
-        for load in self.loads:
-            state_data["loads"][load] = self.loads[load].get_state()
-        for controller in self.controllers:
-            state_data["controllers"][controller] = self.controllers[controller].get_state()
-        for sensor in self.sensors:
-            state_data["sensors"][sensor] = self.sensors[sensor].get_state()
+        if not (self.SINK_TO_TELEMETRY or self.SINK_TO_NT or self.SINK_TO_SIMPLESTREAMER):
+            return
+        # Snapshot the state here, the sinks may run on another thread
+        frame = None
+        state_data = None
+        if self.SINK_TO_TELEMETRY or self.SINK_TO_NT:
+            frame = self.get_telemetry_frame().copy()
+        if self.SINK_TO_SIMPLESTREAMER:
+            state_data = {
+                "sensors": {},
+                "controllers": {},
+                "loads": {},
+                "tic_time": self.tic_time,
+                "profile": self.profiler.get_state()
+            }
+            for load in self.loads:
+                state_data["loads"][load] = self.loads[load].get_state()
+            for controller in self.controllers:
+                state_data["controllers"][controller] = self.controllers[controller].get_state()
+            for sensor in self.sensors:
+                state_data["sensors"][sensor] = self.sensors[sensor].get_state()
+            if self.sink_thread is not None:
+                state_data["sink"] = self.sink_thread.get_state()
+        if self.SINK_IN_BACKGROUND:
+            if self.sink_thread is None:
+                self.sink_thread = telemetry.BackgroundSink(self._send_state_data, self.SINK_QUEUE_SIZE)
+            self.sink_thread.put((frame, state_data))
+        else:
+            self._send_state_data((frame, state_data))
+
+    def _send_state_data(self, snapshot):
+        frame, state_data = snapshot
+        if self.SINK_TO_TELEMETRY:
+            if self.telemetry_server is None:
+                port = self.TELEMETRY_SIM_PORT if self.mode == "simulation" else self.TELEMETRY_EST_PORT
+                self.telemetry_server = telemetry.TelemetryServer(port, self.get_telemetry_layout())
+            self.telemetry_server.send_frame(frame)
         if self.SINK_TO_NT:
-            self._publish_dictionary_to_nt(state_data, "integrated_dynamics")
+            if self.nt_publisher is None:
+                from networktables import NetworkTable
+                self.sd = NetworkTable.getTable('SmartDashboard')
+                self.nt_publisher = telemetry.NetworkTablesPublisher(
+                    self.sd, self.get_telemetry_layout(), "integrated_dynamics",
+                    self.NT_PUBLISH_RATES, self.NT_DEFAULT_PUBLISH_RATE, self.NT_DEADBANDS, self.NT_DEFAULT_DEADBAND)
+            self.nt_publisher.publish(frame, frame[0])
         if self.SINK_TO_SIMPLESTREAMER:
             if self.streamer is None:
                 if self.mode == "simulation":
@@ -465,63 +561,374 @@ class DynamicsEngine:
                     self.streamer = simplestreamer.SimpleStreamer(5801)
             self.streamer.send_data(state_data)
 
-    def _publish_dictionary_to_nt(self, dictionary, nt_prefix):
-        if self.sd is None:
-            from networktables import NetworkTable
-            self.sd = NetworkTable.getTable('SmartDashboard')
-        for dict_key in dictionary:
-            if isinstance(dictionary[dict_key], dict):
-                self._publish_dictionary_to_nt(dictionary[dict_key], "/".join((nt_prefix, dict_key)))
-            elif hasattr(dictionary[dict_key], 'shape') and dictionary[dict_key].size > 1:
-                i = 0
-                for value in np.nditer(dictionary[dict_key]):
-                    self.sd.putNumber("/".join((nt_prefix, dict_key, str(i))), value)
-                    i += 1
-            else:
-                self.sd.putNumber("/".join((nt_prefix, dict_key)), dictionary[dict_key])
+    def get_sink_state(self):
+        """
+        :returns the queue length and the sent, dropped and failed frame counts of the background sink,
+        or None if it has not started.
+        """
+        if self.sink_thread is None:
+            return None
+        return self.sink_thread.get_state()
+
+    def get_state_names(self):
+        """
+        :returns a name for every state in self.state_list, the "/" separated path of the load attribute holding it.
+        """
+        state_indices = {id(state): i for i, state in enumerate(self.state_list)}
+        names = [None]*len(self.state_list)
+        seen = set()
+        # Breadth first, so a state shared between components is named after the shallowest one
+        pending = [("loads/" + name, self.loads[name]) for name in sorted(self.loads)]
+        while len(pending) > 0:
+            prefix, component = pending.pop(0)
+            if id(component) in seen:
+                continue
+            seen.add(id(component))
+            for attribute, value in sorted(vars(component).items(), key=lambda item: item[0]):
+                index = state_indices.get(id(value))
+                if index is not None and names[index] is None:
+                    names[index] = "/".join((prefix, attribute))
+                    continue
+                if isinstance(value, dict):
+                    value = list(value.values())
+                if not isinstance(value, list):
+                    value = [value]
+                for i, item in enumerate(value):
+                    candidates = item.values() if isinstance(item, dict) else [item]
+                    for candidate in candidates:
+                        if hasattr(candidate, "get_state_derivatives"):
+                            path = attribute if len(value) == 1 else "{}{}".format(attribute, i)
+                            pending.append(("/".join((prefix, path)), candidate))
+        return [name if name is not None else "states/{}".format(i) for i, name in enumerate(names)]
+
+    def get_telemetry_layout(self):
+        """
+        :returns the telemetry.TelemetryLayout of the frames from get_telemetry_frame(). The frame holds the time,
+        tic_time, dt, the state mean and covariance diagonal, the percent vbus of every controller and the value of
+        every shared variable of every sensor, as used by the estimator. When estimating with sensors, it also holds
+        the innovation and innovation variance of every sensor value.
+        """
+        if self.telemetry_layout is not None:
+            return self.telemetry_layout
+        fields = [("time", 1), ("tic_time", 1), ("dt", 1)]
+        state_names = self.get_state_names()
+        state_sizes = [int(np.size(state.get_value())) for state in self.state_list]
+        fields.extend(zip(state_names, state_sizes))
+        fields.extend(("variances/" + name, size) for name, size in zip(state_names, state_sizes))
+        fields.extend(("controllers/{}/percentVbus".format(name), 1) for name in sorted(self.controllers))
+        self.telemetry_state_size = sum(state_sizes)
+        self.telemetry_sensor_fields = []
+        sensor_field_names = {}
+        for name in sorted(self.sensors):
+            for attribute, value in sorted(vars(self.sensors[name]).items(), key=lambda item: item[0]):
+                if isinstance(value, theano.compile.SharedVariable):
+                    field_name = "sensors/{}/{}".format(name, attribute)
+                    fields.append((field_name, int(np.size(value.get_value()))))
+                    self.telemetry_sensor_fields.append(value)
+                    sensor_field_names[value] = field_name
+        if self.innovation is not None:
+            innovation_names = [sensor_field_names[value] for value in self.sensor_value_list]
+            fields.extend(("innovations/" + name, 1) for name in innovation_names)
+            fields.extend(("innovation_variances/" + name, 1) for name in innovation_names)
+        self.telemetry_layout = telemetry.TelemetryLayout(fields)
+        self.telemetry_frame = self.telemetry_layout.new_frame()
+        return self.telemetry_layout
+
+    def get_telemetry_frame(self):
+        """
+        Fill the telemetry frame with the current state of the engine. The frame is reused between calls,
+        so copy it to keep it.
+        :returns the frame, laid out by get_telemetry_layout()
+        """
+        self.get_telemetry_layout()
+        frame = self.telemetry_frame
+        frame[0] = time.time()
+        frame[1] = self.tic_time
+        frame[2] = self.dt.get_value()
+        state_size = self.telemetry_state_size
+        state_mean = self.state_mean.get_value(borrow=True)
+        if state_mean.shape[0] == state_size:
+            frame[3:3+state_size] = state_mean[:, 0]
+        state_covariance = self.state_covariance.get_value(borrow=True)
+        if state_covariance.shape[0] == state_size:
+            frame[3+state_size:3+2*state_size] = np.diag(state_covariance)
+        index = 3+2*state_size
+        for name in sorted(self.controllers):
+            frame[index] = self.controllers[name].percent_vbus.get_value()
+            index += 1
+        for sensor_value in self.telemetry_sensor_fields:
+            value = np.ravel(sensor_value.get_value(borrow=True))
+            frame[index:index+value.size] = value
+            index += value.size
+        if self.innovation is not None:
+            sensor_count = len(self.sensor_value_list)
+            frame[index:index+sensor_count] = self.innovation.get_value(borrow=True)
+            frame[index+sensor_count:index+2*sensor_count] = self.innovation_variance.get_value(borrow=True)
+        return frame
+
+    def get_telemetry_groups(self):
+        """
+        :returns the fields of get_telemetry_layout() grouped into time, state_mean, covariance_diagonal, controls,
+        sensors and innovations, as an ordered dictionary of group names to lists of field names.
+        """
+        names = [name for name, size in self.get_telemetry_layout().fields]
+        state_count = len(self.state_list)
+        groups = OrderedDict()
+        groups["time"] = names[:3]
+        groups["state_mean"] = names[3:3+state_count]
+        groups["covariance_diagonal"] = names[3+state_count:3+2*state_count]
+        groups["controls"] = [name for name in names if name.startswith("controllers/")]
+        groups["sensors"] = [name for name in names if name.startswith("sensors/")]
+        groups["innovations"] = [name for name in names if name.startswith(("innovations/", "innovation_variances/"))]
+        return groups
+
+    def start_recording(self, directory, capacity=65536):
+        """
+        Record the telemetry frame of every simulation_update and estimation_update into memory-mapped ring files
+        in directory, keeping the last capacity frames. Load them with telemetry.Recording(directory).
+        """
+        self.stop_recording()
+        self.recorder = telemetry.StateRecorder(directory, self.get_telemetry_layout(), self.get_telemetry_groups(), capacity)
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def bind_hal_data(self, hal_data):
+        """
+        Resolve the hal_data entries of every controller and sensor once, instead of looking them up every tick.
+        Called by simulation_update whenever it is given a different hal_data. pyfrc's reset_hal_data() refills
+        the same dictionary with new entries instead, which the controllers and sensors detect and bind again
+        themselves, see SpeedController.bind_hal_data.
+        """
+        self.hal_data = hal_data
+        controllers = [self.controllers[name] for name in sorted(self.controllers)]
+        # Every CAN Talon is emulated by one vectorized TalonBank
+        talons = [controller for controller in controllers if isinstance(controller, CANTalonSpeedController)]
+        self.talon_bank = TalonBank(talons, self.TALON_PER_SECOND_GAINS) if len(talons) > 0 else None
+        self.hal_controllers = [controller for controller in controllers if controller not in talons]
+        self.hal_sensors = [self.sensors[name] for name in sorted(self.sensors)]
+        for component in controllers + self.hal_sensors:
+            component.bind_hal_data(hal_data)
 
     def simulation_update(self, dt, hal_data=None, resolve_error=True):
+        profiler = self.profiler
+        profiler.start()
         start_time = time.time()
         if hal_data is not None:
-            for controller in self.controllers:
-                self.controllers[controller].set_from_hal_data(hal_data, dt)
+            if hal_data is not self.hal_data:
+                self.bind_hal_data(hal_data)
+            for controller in self.hal_controllers:
+                controller.set_from_hal_data(hal_data, dt)
+            if self.talon_bank is not None:
+                self.talon_bank.set_from_hal_data(hal_data, dt)
+        profiler.mark("hal_ingest")
         self.dt.set_value(dt)
         self.simulation_func()
+        profiler.mark("prediction")
         self.state_prediction_debugger.do_checkup()
+        profiler.mark("debugger_checkup")
         if resolve_error:
             covariance = self.state_covariance.get_value()
             new_state = utilities.sample_covariance_numpy(self.state_mean.get_value()[:, 0], covariance)
             self.state_mean.set_value(new_state[:, None])
             self.state_covariance.set_value(np.zeros_like(covariance))
+        profiler.mark("covariance_sampling")
         self.state_flush_func()
+        profiler.mark("state_flush")
         self.sensor_flush_func()
         if hal_data is not None:
-            for sensor in self.sensors:
-                self.sensors[sensor].update_hal_data(hal_data, dt)
+            for sensor in self.hal_sensors:
+                sensor.update_hal_data(hal_data, dt)
+        profiler.mark("sensor_flush")
         self.tic_time = time.time() - start_time
+        if self.recorder is not None:
+            self.recorder.record(self.get_telemetry_frame())
+            profiler.mark("record")
         if self.SINK_IN_SIMULATION:
             self.sink_state_data()
+            profiler.mark("sink")
 
-    def estimation_update(self, dt):
+    def estimation_update(self, dt, use_devices=True):
+        """
+        Predict the state dt seconds ahead and correct it with the sensor values.
+        :param use_devices: Poll the wpilib sensors and update the wpilib controllers. Without them the
+        sensor values and percent vbus already set are used, as by replay.LogReplay.
+        """
+        profiler = self.profiler
+        profiler.start()
         start_time = time.time()
         self.dt.set_value(dt)
         self.simulation_func()
+        profiler.mark("prediction")
 
-        self.poll_sensors()
+        if use_devices:
+            self.poll_sensors()
+        profiler.mark("sensor_poll")
         self.estimation_func()
+        profiler.mark("estimation")
         self.state_flush_func()
-        self.update_controllers()
+        profiler.mark("state_flush")
+        if use_devices:
+            self.update_controllers()
+        profiler.mark("controller_update")
 
         self.tic_time = time.time() - start_time
+        if self.recorder is not None:
+            self.recorder.record(self.get_telemetry_frame())
+            profiler.mark("record")
         self.sink_state_data()
+        profiler.mark("sink")
 
-    def optimization_update(self):
-        start_time = time.time()
+    def get_profile(self):
+        """
+        :returns statistics of the time spent in each phase of simulation_update and estimation_update,
+        as given by utilities.TickProfiler.get_summary()
+        """
+        return self.profiler.get_summary()
 
-        self.feedback_gain_progression_func()
+    def load_feedback_gains(self, u, L, x, dt, controller_list=None):
+        """
+        Load a time-varying feedback controller, such as the u, L and x outputs of ilqg(), and restart its clock.
+        :param u: The nominal controls, size(u)==[N m]
+        :param L: The feedback gains, size(L)==[N m n]
+        :param x: The nominal states, size(x)==[N+1 n] in the order of self.state_list
+        :param dt: The time between steps of the schedule in seconds
+        :param controller_list: Names of the controllers in the order of the columns of u, defaults to self.controllers' order
+        """
+        if controller_list is not None:
+            self.controller_list = controller_list
+        elif len(self.controller_list) == 0:
+            self.controller_list = list(self.controllers)
+        # Repeat the last step so that interpolation off the end of the schedule holds it
+        self.feedback_controls = np.concatenate((u, u[-1:]))
+        self.feedback_gains = np.concatenate((L, L[-1:]))
+        self.feedback_states = np.array(x)
+        self.feedback_gains_dt = dt
+        self.feedback_gains_clock = 0.0
+
+    def feedback_update(self, dt):
+        """
+        Set every controller in self.controller_list to u + L(x_est - x_nom), linearly interpolated
+        at the current time of the loaded schedule, then advance the schedule's clock by dt.
+        :return The controls that were applied.
+        """
+        if self.feedback_gains is None:
+            raise ValueError("No feedback controller is loaded, call load_feedback_gains() first.")
+        last = self.feedback_controls.shape[0] - 2
+        position = self.feedback_gains_clock/self.feedback_gains_dt
+        i = min(int(position), last)
+        fraction = min(position - i, 1.0)
+
+        controls = self.feedback_controls[i] + fraction*(self.feedback_controls[i+1] - self.feedback_controls[i])
+        gains = self.feedback_gains[i] + fraction*(self.feedback_gains[i+1] - self.feedback_gains[i])
+        nominal_state = self.feedback_states[i] + fraction*(self.feedback_states[i+1] - self.feedback_states[i])
+        controls = controls + np.dot(gains, self.get_state_vector() - nominal_state)
+
+        for j in range(len(self.controller_list)):
+            self.controllers[self.controller_list[j]].set_percent_vbus(controls[j])
+        self.feedback_gains_clock += dt
+        return controls
+
+    def optimization_update(self, dt=None):
+        """
+        Follow the loaded feedback controller from the estimated state for one tick.
+        :param dt: The time since the last tick, defaults to the time step of the loaded schedule.
+        """
+        if dt is None:
+            dt = self.feedback_gains_dt
+        self.feedback_update(dt)
+        self.estimation_update(dt)
 
-        self.tic_time = time.time() - start_time
-        self.sink_state_data()
+    def discrete_dynamics(self, x, u, dt):
+        """
+        Predict the state dt seconds after each row of x with controls held at each row of u.
+        Requires the engine to be built in "optimization" mode.
+        :param x: States, size(x)==[K n] in the order of self.state_list.
+        :param u: Percent vbus of each controller, size(u)==[K m] in the order of self.controller_list.
+        :param dt: The time step in seconds.
+
+        :return The new states, size==[K n]
+        """
+        new_x, _, _ = self.optimization_func(np.atleast_2d(x), np.atleast_2d(u), dt)
+        return new_x.reshape(np.shape(x))
+
+    def discrete_dynamics_derivatives(self, x, u, dt):
+        """
+        Derivatives of discrete_dynamics() in the layout ilqg() expects.
+        NaN controls (the final step of an ilqg trajectory) are treated as zero.
+
+        :return fx, the derivative with respect to x, size==[K n n]
+        :return fu, the derivative with respect to u, size==[K m n]
+        """
+        u = np.where(np.isnan(u), 0, u)
+        _, fx, fu = self.optimization_func(x, u, dt)
+        return fx.transpose(0, 2, 1), fu.transpose(0, 2, 1)
+
+    def get_ilqg_functions(self, dt):
+        """
+        Build the dynamics and dynamics_derivatives functions for ilqg(), for use with the
+        options {"vectorized": True, "dynamics_derivatives": dynamics_derivatives}.
+        """
+        def dynamics(x, u):
+            return self.discrete_dynamics(x, u, dt)
+
+        def dynamics_derivatives(x, u):
+            fx, fu = self.discrete_dynamics_derivatives(x, u, dt)
+            return fx, fu, None, None, None
+        return dynamics, dynamics_derivatives
+
+    def cost(self, x, u):
+        """
+        Evaluate the compiled cost of self.costs for each row of x and u. Rows whose controls are NaN
+        (the end of an ilqg trajectory) are charged the final cost instead of the running cost.
+        Requires the engine to be built in "optimization" mode with at least one cost.
+
+        :return The cost of each row, size==[K]
+        """
+        x = np.atleast_2d(x)
+        u = np.atleast_2d(u)
+        final = np.isnan(u).any(axis=1)
+        running_cost, final_cost = self.cost_func(x, np.where(final[:, None], 0, u))
+        return np.where(final, final_cost, running_cost)
+
+    def cost_derivatives(self, x, u):
+        """
+        Analytic derivatives of cost() in the layout ilqg() expects.
+
+        :return cx, cu, cxx, cxu, cuu, of sizes [K n], [K m], [K n n], [K n m] and [K m m]
+        """
+        final = np.isnan(u).any(axis=1)
+        results = self.cost_derivatives_func(x, np.where(final[:, None], 0, u))
+        running = results[1:6]
+        terminal = results[7:12]
+        return [np.where(final.reshape((-1,) + (1,)*(r.ndim-1)), t, r) for r, t in zip(running, terminal)]
+
+    def get_ilqg_cost_functions(self):
+        """
+        Build the cost and cost_derivatives functions for ilqg(), for use with the
+        options {"vectorized": True, "cost_derivatives": cost_derivatives}.
+        """
+        return self.cost, self.cost_derivatives
+
+    def get_state_vector(self):
+        """
+        :return The current value of every state, flattened into one vector in the order of self.state_list.
+        """
+        return np.concatenate([np.ravel(state.get_value()) for state in self.state_list])
+
+    def get_state_slice(self, state):
+        """
+        :return The slice of the state vector occupied by the given shared state variable.
+        """
+        index = 0
+        for other in self.state_list:
+            size = np.size(other.get_value())
+            if other is state:
+                return slice(index, index+size)
+            index += size
+        raise ValueError("{} is not a state of this dynamics engine.".format(state))
 
     def init_wpilib_devices(self):
         for controller in self.controllers:
@@ -531,12 +938,57 @@ class DynamicsEngine:
 
     def poll_sensors(self):
         for sensor in self.sensors:
-            sensor.poll_sensor()
+            self.sensors[sensor].poll_sensor()
 
     def update_controllers(self):
         for controller in self.controllers:
             self.controllers[controller].update_device()
 
+    def get_graph_profile(self, top=20):
+        """
+        Summarize the op-level profiles of simulation_func and estimation_func, which are only
+        collected when PROFILE_FUNCTIONS is set. Times are averaged over every call so far and each
+        op is attributed to the component whose methods built it.
+        :returns the report of utilities.summarize_function_profiles()
+        """
+        functions = {
+            "simulation_func": self.simulation_func,
+            "estimation_func": self.estimation_func
+        }
+        return utilities.summarize_function_profiles(functions, self._get_component_classes(), top)
+
+    def dump_graph_profile(self, filename, top=20):
+        """
+        Write get_graph_profile() to filename as JSON.
+        """
+        with open(filename, 'w') as f:
+            json.dump(self.get_graph_profile(top), f, indent=2)
+
+    def _get_component_classes(self):
+        """
+        :returns every class of load, sensor, controller and cost reachable from this engine, including base classes.
+        """
+        classes = set()
+        seen = set()
+        pending = list(self.loads.values()) + list(self.sensors.values()) + \
+            list(self.controllers.values()) + list(self.costs.values())
+        while len(pending) > 0:
+            component = pending.pop()
+            if id(component) in seen:
+                continue
+            seen.add(id(component))
+            classes.update(cls for cls in type(component).__mro__ if cls is not object)
+            for value in vars(component).values():
+                if isinstance(value, dict):
+                    value = list(value.values())
+                if not isinstance(value, list):
+                    value = [value]
+                for item in value:
+                    candidates = item.values() if isinstance(item, dict) else [item]
+                    pending.extend(candidate for candidate in candidates
+                                   if hasattr(candidate, "get_state_derivatives") or hasattr(candidate, "get_variance_sources"))
+        return classes
+
     def get_state(self):
         state = {}
         for component in self.loads:
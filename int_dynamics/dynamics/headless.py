@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Run a DynamicsEngine simulation headless and as fast as it will go, without pyfrc or wall-clock pacing.
+
+The controls come from a script, a table of per-tick values or a recording made with start_recording().
+Optionally the engine exchanges them through a local stand-in for pyfrc's hal_data, so the controllers'
+and sensors' hal_data handling is exercised too:
+
+    python -m int_dynamics.dynamics.headless examples/dynamics/simulations/drive_simulation/dynamics.py \
+        --duration 15 --controls left_cim=1 right_cim=-1 --record drive_run
+"""
+import argparse
+import importlib.util
+import sys
+import time
+import numpy as np
+from int_dynamics import telemetry
+
+
+def make_hal_data(engine):
+    """
+    :returns a minimal stand-in for hal_impl.data.hal_data with an entry for every controller and sensor of the engine.
+    """
+    hal_data = {
+        'control': {'enabled': True},
+        'pwm': [],
+        'CAN': {},
+        'encoder': [],
+        'analog_in': [],
+        'robot': {}
+    }
+    for controller in engine.controllers.values():
+        controller.init_hal_data(hal_data)
+    for sensor in engine.sensors.values():
+        sensor.init_hal_data(hal_data)
+    return hal_data
+
+
+class HeadlessSimulation:
+    """
+    Steps a DynamicsEngine in simulation mode through a control sequence as fast as possible.
+    """
+
+    def __init__(self, engine, controls=None, hal_data=None, dt=.05, resolve_error=False, seed=None):
+        """
+        :param engine: A DynamicsEngine in simulation mode.
+        :param controls: The percent vbus of each controller, as one of
+            - a callable(t, hal_data) returning a dictionary of controller names to percent vbus, or None if it
+              commanded the controllers itself,
+            - a dictionary of controller names to a value per tick, or a constant value,
+            - a telemetry.Recording, or its directory, replaying the recorded percent vbus with the recorded dt.
+        :param hal_data: A hal_data dictionary to exchange controls and sensor values through, True for a local
+            stand-in from make_hal_data(), or None to set the controllers directly.
+        :param dt: The time step, unless the controls are a recording.
+        :param resolve_error: Sample the state from its covariance every tick, as simulation_update does by default.
+        :param seed: Seed numpy's random generator, so runs that resolve error are repeatable.
+        """
+        self.engine = engine
+        self.dt = dt
+        self.dts = None
+        self.resolve_error = resolve_error
+        self.wall_time = 0
+        if seed is not None:
+            np.random.seed(seed)
+        if hal_data is True:
+            hal_data = make_hal_data(engine)
+        self.hal_data = hal_data
+
+        if isinstance(controls, str):
+            controls = telemetry.Recording(controls)
+        if isinstance(controls, telemetry.Recording):
+            self.dts = controls.get("dt")
+            controls = {name: controls.get("controllers/{}/percentVbus".format(name)) for name in engine.controllers}
+        self.controls = controls
+
+    def _get_controls(self, tick, t):
+        if self.controls is None:
+            return None
+        if callable(self.controls):
+            return self.controls(t, self.hal_data)
+        values = {}
+        for name, value in self.controls.items():
+            value = np.asarray(value)
+            values[name] = value if value.ndim == 0 else value[min(tick, len(value) - 1)]
+        return values
+
+    def run(self, ticks=None, duration=None, record_directory=None, callback=None):
+        """
+        Run for a number of ticks, a duration in simulated seconds, or to the end of a recording.
+        :param record_directory: Record the run there with start_recording().
+        :param callback: Called with the tick, the time and the engine after every tick, returns True to stop early.
+        :returns the telemetry frame after every tick, size==[ticks len(layout)]
+        """
+        engine = self.engine
+        if ticks is None:
+            if duration is not None:
+                ticks = int(round(duration/self.dt))
+            elif self.dts is not None:
+                ticks = len(self.dts)
+            else:
+                raise ValueError("Give a number of ticks or a duration to run for.")
+        frames = np.zeros((ticks, engine.get_telemetry_layout().size))
+        if record_directory is not None:
+            engine.start_recording(record_directory, max(1, ticks))
+        start_time = time.time()
+        t = 0.0
+        for tick in range(ticks):
+            dt = self.dt if self.dts is None else self.dts[min(tick, len(self.dts) - 1)]
+            controls = self._get_controls(tick, t)
+            if controls is not None:
+                for name, value in controls.items():
+                    if self.hal_data is None:
+                        engine.controllers[name].set_percent_vbus(value)
+                    else:
+                        engine.controllers[name].set_hal_percent_vbus(self.hal_data, value)
+            engine.simulation_update(dt, self.hal_data, self.resolve_error)
+            t += dt
+            frames[tick] = engine.get_telemetry_frame()
+            if callback is not None and callback(tick, t, engine):
+                frames = frames[:tick + 1]
+                break
+        self.wall_time = time.time() - start_time
+        if record_directory is not None:
+            engine.stop_recording()
+        return frames
+
+
+def load_engine(path, class_name="MyRobotDynamics"):
+    """
+    Import a dynamics.py and build its engine in simulation mode with cached_init.
+    """
+    spec = importlib.util.spec_from_file_location("headless_dynamics", path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["headless_dynamics"] = module
+    spec.loader.exec_module(module)
+    return getattr(module, class_name).cached_init("simulation")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("dynamics", help="the dynamics.py defining the engine")
+    parser.add_argument("--class-name", default="MyRobotDynamics")
+    parser.add_argument("--dt", type=float, default=.05)
+    parser.add_argument("--duration", type=float, help="simulated seconds to run for")
+    parser.add_argument("--controls", nargs="*", default=[], help="constant controls, as controller=percent_vbus")
+    parser.add_argument("--replay", help="a recording to take the controls and time steps from")
+    parser.add_argument("--hal-data", action="store_true", help="exchange controls and sensors through a local hal_data")
+    parser.add_argument("--resolve-error", action="store_true")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--record", help="directory to record the run to")
+    args = parser.parse_args()
+
+    engine = load_engine(args.dynamics, args.class_name)
+    engine.SINK_IN_SIMULATION = False
+    if args.replay is not None:
+        controls = args.replay
+    else:
+        controls = {}
+        for control in args.controls:
+            name, value = control.split("=")
+            controls[name] = float(value)
+    simulation = HeadlessSimulation(engine, controls, args.hal_data or None, args.dt, args.resolve_error, args.seed)
+    frames = simulation.run(duration=args.duration, record_directory=args.record)
+    simulated_time = frames[:, 2].sum()
+    print("Simulated {:.2f}s in {} ticks in {:.2f}s, {:.1f}x real time.".format(
+        simulated_time, len(frames), simulation.wall_time, simulated_time/max(simulation.wall_time, 1e-9)))
+    print(engine.get_state())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import time
+import numpy as np
+from int_dynamics import telemetry
+
+
+class LogReplay:
+    """
+    Replays a recording made with DynamicsEngine.start_recording() through estimation_update, without wpilib devices.
+
+    Every tick sets the recorded percent vbus of each controller and the recorded value of each sensor, then runs
+    estimation_update with the recorded dt, as fast as it will go. The same recording replayed into the same engine
+    always gives the same states, so the results can be compared against a golden run to catch estimator changes.
+    """
+
+    def __init__(self, engine, recording):
+        """
+        :param engine: A DynamicsEngine in estimation mode, fresh from cached_init so it starts where the recording did.
+        :param recording: A telemetry.Recording, or the directory of one.
+        """
+        if not isinstance(recording, telemetry.Recording):
+            recording = telemetry.Recording(recording)
+        self.engine = engine
+        self.recording = recording
+        self.wall_time = 0
+
+        layout = engine.get_telemetry_layout()
+        self.dts = recording.get("dt")
+        self.controls = []
+        for name in sorted(engine.controllers):
+            self.controls.append((engine.controllers[name], self._get_field("controllers/{}/percentVbus".format(name))))
+        self.sensor_values = []
+        sensor_names = [name for name, size in layout.fields if name.startswith("sensors/")]
+        for name, sensor_value in zip(sensor_names, engine.telemetry_sensor_fields):
+            values = self._get_field(name)
+            self.sensor_values.append((sensor_value, values.reshape((len(values),) + np.shape(sensor_value.get_value()))))
+        # The state mean follows time, tic_time and dt in the frame
+        self.state_slice = slice(3, 3+engine.telemetry_state_size)
+
+    def __len__(self):
+        return len(self.recording)
+
+    def _get_field(self, name):
+        try:
+            return self.recording.get(name)
+        except KeyError:
+            raise ValueError("The recording has no field '{}', was it made with this engine?".format(name))
+
+    def run(self, start=0, stop=None, record_directory=None):
+        """
+        Replay ticks start to stop of the recording.
+        :param record_directory: If given, record the replay there so it can be used as a golden run later.
+        :returns the telemetry frame after every tick, size==[stop-start len(layout)]
+        """
+        if stop is None:
+            stop = len(self.recording)
+        engine = self.engine
+        frames = np.zeros((stop - start, engine.get_telemetry_layout().size))
+        if record_directory is not None:
+            engine.start_recording(record_directory, max(1, stop - start))
+        start_time = time.time()
+        for i in range(start, stop):
+            for controller, values in self.controls:
+                controller.set_percent_vbus(values[i])
+            for sensor_value, values in self.sensor_values:
+                sensor_value.set_value(values[i])
+            engine.estimation_update(self.dts[i], use_devices=False)
+            frames[i - start] = engine.get_telemetry_frame()
+        self.wall_time = time.time() - start_time
+        if record_directory is not None:
+            engine.stop_recording()
+        return frames
+
+    def compare(self, frames, golden=None, start=0, tolerance=1e-9):
+        """
+        Compare the states of replayed frames against a golden run.
+        :param frames: The output of run().
+        :param golden: A telemetry.Recording, its directory, or frames from an earlier run(). Defaults to the
+        states recorded along with the replayed inputs.
+        :param start: The tick of the recording that frames starts at.
+        :returns a dictionary with the largest absolute error of every state, the worst state and whether
+        every error is within tolerance.
+        """
+        if golden is None:
+            golden = self.recording
+        elif isinstance(golden, str):
+            golden = telemetry.Recording(golden)
+        if isinstance(golden, telemetry.Recording):
+            golden_states = golden["state_mean"][start:start + len(frames)]
+        else:
+            golden_states = golden[:, self.state_slice]
+        states = frames[:len(golden_states), self.state_slice]
+        errors = np.abs(states - golden_states).max(axis=0) if len(states) > 0 else np.zeros(states.shape[1])
+        layout = self.engine.get_telemetry_layout()
+        state_errors = {}
+        for name, size in layout.fields[3:3+len(self.engine.state_list)]:
+            field_slice = layout.get_slice(name)
+            state_errors[name] = float(errors[field_slice.start - self.state_slice.start:
+                                              field_slice.stop - self.state_slice.start].max())
+        worst = max(state_errors, key=state_errors.get) if len(state_errors) > 0 else None
+        return {
+            "ticks": len(states),
+            "max_errors": state_errors,
+            "worst_state": worst,
+            "passed": all(error <= tolerance for error in state_errors.values())
+        }
@@ -0,0 +1,151 @@
+from numpy import *
+from builtins import min, max
+from .ilqg import ilqg, func_serializer
+import logging
+import time
+logger = logging.getLogger("iLQG")
+
+
+def box_obstacle_constraint(obstacles, margin=0.0, position_indices=(0, 1)):
+    """
+    Build a vectorized constraint function that keeps a point out of axis-aligned boxes,
+    such as the field objects in a pyfrc sim/config.json.
+
+    :param obstacles: A list of (lower_corner, upper_corner) pairs.
+    :param margin: The clearance to keep from every box.
+    :param position_indices: The indices of the point's coordinates in the state vector.
+
+    :return constraint_fun(x) -> size==[K len(obstacles)], positive inside the boxes plus margin.
+    """
+    lower = array([obstacle[0] for obstacle in obstacles], dtype=float)
+    upper = array([obstacle[1] for obstacle in obstacles], dtype=float)
+    center = (lower + upper)/2
+    half_size = (upper - lower)/2
+    position_indices = list(position_indices)
+
+    def constraint_fun(x):
+        # signed distance from each point to each box
+        q = abs(x[:, None, position_indices] - center[None]) - half_size[None]
+        outside = sqrt(sum(maximum(q, 0)**2, axis=2))
+        inside = minimum(q.max(axis=2), 0)
+        return margin - (outside + inside)
+    return constraint_fun
+
+
+def ilqg_constrained(dynamics_fun, cost_fun, constraint_fun, x0, u0, options_in={}):
+    """
+    Solve the optimal control problem of ilqg() subject to constraint_fun(x) <= 0 at every step,
+    with an augmented Lagrangian outer loop around ilqg().
+
+    Each outer iteration runs ilqg() on the cost plus the augmented Lagrangian penalty, warm started
+    from the previous controls, and then updates the per-step multipliers. The penalty parameter mu
+    grows whenever the worst violation does not shrink by muProgress. The time step of each state is
+    carried through ilqg() as an extra state so the penalty can use that step's multipliers.
+
+    :param dynamics_fun: The dynamics function, as for ilqg().
+    :param cost_fun: The cost function, as for ilqg().
+    :param constraint_fun: A vectorized function of states, size(x)==[K n], returning size==[K p].
+    :param x0: The initial state.
+    :param u0: The initial control sequence.
+    :param options_in: ilqg() options, plus the outer loop options below.
+        Analytic cost derivatives are not used, the augmented cost is finite-differenced.
+        maxTime is the budget of the whole outer loop; each ilqg() gets what is left of it.
+
+    :return The ilqg() outputs for the final outer iteration, with cost being the unpenalized cost.
+    """
+    options = {
+        'muInit':         1.0,  # initial penalty parameter
+        'muFactor':       10.0,  # penalty parameter scaling factor
+        'muMax':          1e8,  # penalty parameter maximum value
+        'muProgress':     0.25,  # required relative reduction of the violation before mu is increased
+        'tolConstraint':  1e-4,  # largest acceptable constraint violation
+        'maxOuterIter':   20,  # maximum outer iterations
+    }
+    options.update(options_in)
+    ilqg_options = dict(options)
+    for key in ['muInit', 'muFactor', 'muMax', 'muProgress', 'tolConstraint', 'maxOuterIter', 'cost_derivatives']:
+        ilqg_options.pop(key, None)
+    vectorized = ilqg_options.get("vectorized", False)
+
+    N = u0.shape[0]
+    n = x0.shape[-1]
+    p = constraint_fun(x0[None]).shape[1]
+    multipliers = zeros((N+1, p))
+    mu = options["muInit"]
+
+    def dynamics_aug(x, u):
+        if vectorized:
+            return hstack((dynamics_fun(x[:, :n], u), x[:, n:] + 1))
+        return append(dynamics_fun(x[:n], u), x[n] + 1)
+
+    def cost_aug(x, u):
+        x = atleast_2d(x)
+        if vectorized:
+            cost = cost_fun(x[:, :n], u)
+        else:
+            cost = func_serializer(x[:, :n], atleast_2d(u), cost_fun)
+        step = clip(rint(x[:, n]).astype(int), 0, N)
+        g = constraint_fun(x[:, :n])
+        penalty = sum(maximum(0, multipliers[step] + mu*g)**2 - multipliers[step]**2, axis=1)/(2*mu)
+        cost = cost + penalty
+        return cost if vectorized else cost[0]
+
+    if ilqg_options.get("dynamics_derivatives") is not None:
+        dynamics_derivatives = ilqg_options["dynamics_derivatives"]
+
+        def dynamics_derivatives_aug(x, u):
+            fx, fu, fxx, fxu, fuu = dynamics_derivatives(x[:, :n], u)
+            K = x.shape[0]
+            fx_aug = zeros((K, n+1, n+1))
+            fx_aug[:, :n, :n] = fx
+            fx_aug[:, n, n] = 1
+            fu_aug = concatenate((fu, zeros((K, fu.shape[1], 1))), axis=2)
+            return fx_aug, fu_aug, None, None, None
+        ilqg_options["dynamics_derivatives"] = dynamics_derivatives_aug
+
+    x0_aug = append(x0, 0)
+    u = u0
+    traces = []
+    worst_violation = inf
+    start_time = time.time()
+    for outer_iter in range(options["maxOuterIter"]):
+        if options.get("maxTime") is not None:
+            ilqg_options["maxTime"] = max(options["maxTime"] - (time.time() - start_time), 0)
+        x, u, L, Vx, Vxx, cost, trace = ilqg(dynamics_aug, cost_aug, x0_aug, u.copy(), ilqg_options)
+        traces.append(trace)
+        if L is None:
+            logger.info("\nEXIT: constrained iLQG diverged\n")
+            break
+
+        g = constraint_fun(x[:, :n])
+        violation = maximum(g, 0).max()
+        logger.info("outer iter: {} violation: {} mu: {}".format(outer_iter, violation, mu))
+        if violation < options["tolConstraint"]:
+            logger.info("\nSUCCESS: constraint violation < tolConstraint")
+            break
+        if options.get("maxTime") is not None and time.time() - start_time > options["maxTime"]:
+            logger.info("\nEXIT: time budget of {} seconds exceeded".format(options["maxTime"]))
+            break
+
+        # first order multiplier update, and a stiffer penalty if the violation is not shrinking
+        multipliers = maximum(0, multipliers + mu*g)
+        if violation > options["muProgress"]*worst_violation:
+            mu = min(mu*options["muFactor"], options["muMax"])
+        worst_violation = violation
+    else:
+        logger.warn("\nEXIT: Maximum outer iterations reached.\n")
+
+    if L is None:
+        return x, u, L, Vx, Vxx, cost, vstack(traces)
+
+    # Drop the time step from the outputs, and report the cost without the penalty
+    u_final = vstack((u, full([1, u.shape[1]], nan)))
+    if vectorized:
+        cost = cost_fun(x[:, :n], u_final)
+    else:
+        cost = func_serializer(x[:, :n], u_final, cost_fun)
+    # Vx and Vxx are None if the time budget ran out before ilqg() finished a backward pass
+    if Vx is not None:
+        Vx = Vx[:, :n]
+        Vxx = Vxx[:, :n, :n]
+    return x[:, :n], u, L[:, :, :n], Vx, Vxx, cost, vstack(traces)
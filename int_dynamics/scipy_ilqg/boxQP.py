@@ -1,7 +1,75 @@
 from numpy import *
+from scipy.linalg import cholesky, cho_solve, solve_triangular
 import logging
 logger = logging.getLogger("boxQP")
 
+
+def cholupdate(R, x, sign=1):
+    """
+    Rank one update of an upper cholesky factor, like MATLAB's cholupdate().
+    :returns R1 with R1.T*R1 == R.T*R + sign*x*x.T, raises LinAlgError if a downdate loses definiteness
+    """
+    R = R.copy()
+    x = x.copy()
+    for k in range(x.size):
+        r2 = R[k, k]**2 + sign*x[k]**2
+        if not r2 > 0:
+            raise linalg.LinAlgError("Downdated matrix is not positive definite")
+        r = sqrt(r2)
+        c = r/R[k, k]
+        s = x[k]/R[k, k]
+        R[k, k] = r
+        R[k, k+1:] = (R[k, k+1:] + sign*s*x[k+1:])/c
+        x[k+1:] = c*x[k+1:] - s*R[k, k+1:]
+    return R
+
+
+def choldelete(R, j):
+    """
+    :returns the upper cholesky factor of the matrix factored by R, with row and column j removed
+    """
+    keep = arange(R.shape[0]) != j
+    R1 = R[keep, :][:, keep]
+    R1[j:, j:] = cholupdate(R1[j:, j:], R[j, j+1:])
+    return R1
+
+
+def cholinsert(R, j, a):
+    """
+    :returns the upper cholesky factor of the matrix factored by R, with row and column a inserted at j
+    """
+    p = R.shape[0]
+    R1 = zeros((p+1, p+1))
+    R1[:j, :j] = R[:j, :j]
+    R1[:j, j+1:] = R[:j, j:]
+    s = solve_triangular(R[:j, :j], a[:j], trans='T', check_finite=False) if j > 0 else zeros(0)
+    d2 = a[j] - dot(s, s)
+    if not d2 > 0:
+        raise linalg.LinAlgError("Bordered matrix is not positive definite")
+    d = sqrt(d2)
+    t = (a[j+1:] - dot(R[:j, j:].T, s))/d
+    R1[:j, j] = s
+    R1[j, j] = d
+    R1[j, j+1:] = t
+    R1[j+1:, j+1:] = cholupdate(R[j:, j:], t, -1)
+    return R1
+
+
+def cho_solve_batch(R, b):
+    """
+    cho_solve() for a stack of upper cholesky factors, size(R)==[B n n], size(b)==[B n] or [B n k].
+    Substitutes one row at a time, vectorized over the stack.
+    """
+    n = b.shape[1]
+    diagonal = lambda i: R[:, i, i].reshape((-1,) + (1,)*(b.ndim - 2))
+    y = zeros(b.shape)
+    for i in range(n):
+        y[:, i] = (b[:, i] - einsum('bj,bj...->b...', R[:, :i, i], y[:, :i]))/diagonal(i)
+    x = zeros(b.shape)
+    for i in reversed(range(n)):
+        x[:, i] = (y[:, i] - einsum('bj,bj...->b...', R[:, i, i+1:], x[:, i+1:]))/diagonal(i)
+    return x
+
 #function [x,result,Hfree,free,trace] = boxQP(H,g,lower,upper,x0,options)
 # Minimize 0.5*x'*H*x + x'*g  s.t. lower<=x<=upper
 #
@@ -20,6 +88,10 @@ logger = logging.getLogger("boxQP")
 #     result       - result type (roughly, higher is better, see below)
 #     Hfree        - subspace cholesky factor   (n_free * n_free)
 #     free         - set of free dimensions     (n)
+#
+# When the clamped set changes between iterations, Hfree is brought up to
+# date with rank one updates that drop the newly clamped dimensions and
+# border in the newly freed ones, instead of factorizing from scratch.
 
 def boxQP(H, g, lower, upper, x0=None, options_in={}):
     
@@ -29,7 +101,9 @@ def boxQP(H, g, lower, upper, x0=None, options_in={}):
     result = 0
     gnorm = 0
     nfactor = 0
+    nupdate = 0
     Hfree = zeros(n)
+    factored = zeros(n, dtype=bool)
 
     # initial state
     if x0 is not None and x0.size == n:
@@ -85,12 +159,25 @@ def boxQP(H, g, lower, upper, x0=None, options_in={}):
         else:
             factorize = (old_clamped != clamped).any()
         
+        if factorize and factored.any():
+            try:
+                # positions are counted in the factor, which holds the dimensions in order
+                for j in reversed(flatnonzero(factored & clamped)):
+                    Hfree = choldelete(Hfree, sum(factored[:j]))
+                    factored[j] = False
+                for j in flatnonzero(free & ~factored):
+                    factored[j] = True
+                    Hfree = cholinsert(Hfree, sum(factored[:j]), H[j, factored])
+                nupdate += 1
+                factorize = False
+            except linalg.LinAlgError:
+                # lost to rounding, or H is not positive definite, which cholesky() will tell
+                factorize = True
+
         if factorize:
             val = H[free, :][:, free]
-            try:
-                Hfree = linalg.cholesky(val).T
-            except Exception as e:
-                raise e
+            Hfree = cholesky(val, check_finite=False)
+            factored = free.copy()
             nfactor += 1
         
         # check gradient norm
@@ -102,7 +189,7 @@ def boxQP(H, g, lower, upper, x0=None, options_in={}):
         # get search direction
         grad_clamped = g + dot(H, (x*clamped))
         search = zeros(n)
-        search[free] = linalg.solve(-Hfree, linalg.solve(Hfree.T, grad_clamped[free])) - x[free]
+        search[free] = -cho_solve((Hfree, False), grad_clamped[free], check_finite=False) - x[free]
         
         # check for descent direction
         sdotg = sum(search*grad)
@@ -144,7 +231,173 @@ def boxQP(H, g, lower, upper, x0=None, options_in={}):
     #            }                  # result = 6
 
     if options["verbose"] > 0:
-        print('RESULT: {}\niterations {}  gradient {} final value {}  factorizations {}\n'.format(
-            result, iter, gnorm, value, nfactor))
+        print('RESULT: {}\niterations {}  gradient {} final value {}  factorizations {}  updates {}\n'.format(
+            result, iter, gnorm, value, nfactor, nupdate))
+
+    return x, result, Hfree, free
+
+
+#function [x,result,Hfree,free] = boxQP_batch(H,g,lower,upper,x0,options)
+# Solve B independent box QPs of the form solved by boxQP() at once.
+# All problems share a single iteration loop. Problems that have converged
+# are masked out of the remaining iterations, and clamped dimensions are
+# masked out of each problem's Newton step by replacing their rows and
+# columns of H with the identity. The steps are solved with the masked
+# cholesky factors, which are recomputed only for the problems whose
+# clamped set has changed.
+#
+#  inputs:
+#     H            - positive definite matrices (B * n * n)
+#     g            - bias vectors               (B * n)
+#     lower        - lower bounds               (B * n)
+#     upper        - upper bounds               (B * n)
+#
+#   optional inputs:
+#     x0           - initial states             (B * n)
+#     options      - same as boxQP()
+#
+#  outputs:
+#     x            - solutions                  (B * n)
+#     result       - result types, see below    (B)
+#     Hfree        - masked cholesky factors    (B * n * n)
+#     free         - sets of free dimensions    (B * n)
+#
+#  result types:
+#     -1 Hessian is not positive definite
+#      0 No descent direction found
+#      1 Maximum main iterations exceeded
+#      2 Maximum line-search iterations exceeded
+#      4 Improvement smaller than tolerance
+#      5 Gradient norm smaller than tolerance
+#      6 All dimensions are clamped
+
+def boxQP_batch(H, g, lower, upper, x0=None, options_in={}):
+
+    B, n = g.shape
+    lower = broadcast_to(lower, (B, n))
+    upper = broadcast_to(upper, (B, n))
+    result = ones(B, dtype=int)
+    active = ones(B, dtype=bool)
+    clamped = zeros((B, n), dtype=bool)
+    free = ones((B, n), dtype=bool)
+    Hfree = tile(eye(n), (B, 1, 1))
+
+    # initial state
+    if x0 is not None and x0.shape == (B, n):
+        x = clip(x0, lower, upper)
+    else:
+        with errstate(invalid='ignore'):
+            x = 0.5*(lower + upper)
+    x[~isfinite(x)] = 0
+
+    # options
+    options = {
+        "maxIter": 100,     # maximum number of iterations
+        "minGrad": 1e-8,     # minimum norm of non-fixed gradient
+        "minRelImprove": 1e-8,     # minimum relative improvement
+        "stepDec": 0.6,     # factor for decreasing stepsize
+        "minStep": 1e-22,     # minimal stepsize for linesearch
+        "Armijo": 0.1, 	# Armijo parameter (fraction of linear improvement required)
+        "verbose":  0, # verbosity
+    }
+
+    options.update(options_in)
+
+    objective = lambda x: sum(x*g, 1) + 0.5*einsum('bi,bij,bj->b', x, H, x)
+
+    # initial objective value
+    value = objective(x)
+    oldvalue = value.copy()
+
+    # main loop
+    for iter in range(options["maxIter"]):
+
+        # check relative improvement
+        if iter > 0:
+            done = active & ((oldvalue - value) < options["minRelImprove"]*abs(oldvalue))
+            result[done] = 4
+            active &= ~done
+        if not active.any():
+            break
+        oldvalue[active] = value[active]
+
+        # get gradient
+        grad = g + einsum('bij,bj->bi', H, x)
+
+        # find clamped dimensions of the problems still running
+        old_clamped = clamped
+        clamped = where(active[:, None], (x == lower) & (grad > 0) | (x == upper) & (grad < 0), old_clamped)
+        free = ~clamped
+
+        # check for all clamped
+        done = active & clamped.all(1)
+        result[done] = 6
+        active &= ~done
+        if not active.any():
+            break
+
+        # factorize the problems whose clamped set has changed
+        factorize = active & ((old_clamped != clamped).any(1) | (iter == 0))
+        if factorize.any():
+            mask = free[factorize][:, :, None] & free[factorize][:, None, :]
+            Hmasked = where(mask, H[factorize], eye(n))
+            try:
+                Hfree[factorize] = linalg.cholesky(Hmasked).transpose(0, 2, 1)
+            except linalg.LinAlgError:
+                # find the offending problems and drop them
+                indices = flatnonzero(factorize)
+                for j in range(indices.size):
+                    try:
+                        Hfree[indices[j]] = linalg.cholesky(Hmasked[j]).T
+                    except linalg.LinAlgError:
+                        Hfree[indices[j]] = eye(n)
+                        result[indices[j]] = -1
+                        active[indices[j]] = False
+                if not active.any():
+                    break
+
+        # check gradient norm
+        gnorm = linalg.norm(grad*free, axis=1)
+        done = active & (gnorm < options["minGrad"])
+        result[done] = 5
+        active &= ~done
+        if not active.any():
+            break
+
+        # get search direction
+        grad_clamped = where(free, g + einsum('bij,bj->bi', H, x*clamped), 0)
+        search = where(free, -cho_solve_batch(Hfree, grad_clamped) - x, 0)
+
+        # check for descent direction
+        sdotg = sum(search*grad, 1)
+        done = active & (sdotg >= 0)
+        result[done] = 0
+        active &= ~done
+        if not active.any():
+            break
+
+        # armijo linesearch, each problem backtracking on its own step
+        step = ones(B)
+        xc = clip(x + step[:, None]*search, lower, upper)
+        vc = objective(xc)
+        with errstate(divide='ignore', invalid='ignore'):
+            searching = active & ((vc - oldvalue)/(step*sdotg) < options["Armijo"])
+        while searching.any():
+            step[searching] *= options["stepDec"]
+            xc[searching] = clip(x[searching] + step[searching, None]*search[searching], lower[searching], upper[searching])
+            vc[searching] = objective(xc)[searching]
+            with errstate(divide='ignore', invalid='ignore'):
+                searching &= (vc - oldvalue)/(step*sdotg) < options["Armijo"]
+            exhausted = searching & (step < options["minStep"])
+            result[exhausted] = 2
+            active &= ~exhausted
+            searching &= ~exhausted
+
+        # accept candidates
+        x = where(active[:, None], xc, x)
+        value = where(active, vc, value)
+
+    if options["verbose"] > 0:
+        print('RESULT: {}\niterations {}  final value {}\n'.format(result, iter, value))
 
     return x, result, Hfree, free
@@ -1,6 +1,9 @@
 from numpy import *
-from .boxQP import boxQP
+from builtins import min, max
+from scipy.linalg import cholesky, cho_solve
+from .boxQP import boxQP, boxQP_batch, cho_solve_batch
 import logging
+import time
 logger = logging.getLogger("iLQG")
 
 def finite_difference(fun, x, h=2e-6):
@@ -55,7 +58,11 @@ def function_derivatives(x, u, func, second=False):
 
     return dx, du, dxx, dxu, duu
 
-def func_serializer(x, u, func):
+def func_serializer(x, u, func, pool=None):
+    # evaluate a per-sample function over the K rows of x and u,
+    # optionally spread across an executor's workers
+    if pool is not None:
+        return array(list(pool.map(func, x, u)))
     out = []
     for i in range(x.shape[0]):
         out.append(func(x[i], u[i]))
@@ -83,6 +90,13 @@ def ilqg(dynamics_fun_in, cost_fun_in, x0, u0, options_in={}):
       If Op.parallel==true (the default) then DYNCST(x,u,i) is be
       assumed to accept vectorized inputs: size(x,2)==size(u,2)==K
 
+    In this port the dynamics and cost are two separate functions of a
+    single state and control. If Op.vectorized is true they are instead
+    called with size(x)==[K n] and size(u)==[K m] and must return one row
+    per sample, so each step of the parallel line-search evaluates every
+    Alpha in one call. Otherwise the K rows are evaluated one at a time, or
+    mapped over Op.pool (any executor with a map() method) if one is given.
+
      2) final:
       [~,cnew] = DYNCST(x,nan) is called at the end the forward pass to compute
       the final cost. The nans indicate that no controls are applied.
@@ -120,14 +134,33 @@ def ilqg(dynamics_fun_in, cost_fun_in, x0, u0, options_in={}):
     lambda - the final value of the regularization parameter
     trace - a trace of various convergence-related values. One row for each
             iteration, the columns of trace are
-            [iter lambda alpha g_norm dcost z sum(cost) dlambda]
-            see below foe details.
+            [iter lambda alpha g_norm dcost z sum(cost) dlambda
+             time_derivs time_backward time_forward]
+            alpha is nan for iterations where the line-search was rejected.
+            The last three columns are the wall time in seconds spent that
+            iteration differentiating, in the backward pass and line-searching.
+
+    If Op.maxTime is set, the optimization stops once that many seconds of
+    wall time have elapsed and returns the last accepted trajectory, which
+    is always the best one found so far. The budget is checked before every
+    phase, each retry of the backward pass and each step of the serial
+    line-search, so it is a soft limit: it can be overrun by one
+    differentiation, backward pass or forward pass, but no more.
+
+    Op.callback, if given, is called after every accepted iteration and
+    can stop the optimization early by returning True.
+
+    Op.dynamics_derivatives and Op.cost_derivatives may supply analytic
+    derivatives for a whole trajectory in the same layout as
+    function_derivatives(); the second order dynamics terms may be None.
     """
 
     # user-adjustable parameters
     options = {
         'lims':           None,  # control limits
         'parallel':       True,  # use parallel line-search?
+        'vectorized':     False,  # dynamics and cost accept [K n] and [K m] inputs?
+        'pool':           None,  # executor to evaluate non-vectorized functions with
         'Alpha':          10**linspace(0, -3, 8),  # backtracking coefficients
         'tolFun':         1e-7,  # reduction exit criterion
         'tolGrad':        1e-5,  # gradient exit criterion
@@ -142,12 +175,12 @@ def ilqg(dynamics_fun_in, cost_fun_in, x0, u0, options_in={}):
         'plot':           1,  # 0: no;  k>0: every k iters; k<0: every k iters, with derivs window
         'print':          2,  # 0: no;  1: final; 2: iter; 3: iter, detailed
         'cost':           None,  # initial cost for pre-rolled trajectory
+        'maxTime':        None,  # wall time budget in seconds, None for no limit
+        'callback':       None,  # f(iter, x, u, cost) after each accepted step, return True to stop
+        'dynamics_derivatives': None,  # f(x, u) -> fx, fu, fxx, fxu, fuu, None for finite differences
+        'cost_derivatives': None,  # f(x, u) -> cx, cu, cxx, cxu, cuu, None for finite differences
     }
 
-    # serialize dynamics and cost function calls
-    dynamics_fun = lambda x, u: func_serializer(x, u, dynamics_fun_in)
-    cost_fun = lambda x, u: func_serializer(x, u, cost_fun_in)
-
     # --- initial sizes and controls
     n = x0.shape[-1]          # dimension of state vector
     m = u0.shape[1]          # dimension of control vector
@@ -157,6 +190,16 @@ def ilqg(dynamics_fun_in, cost_fun_in, x0, u0, options_in={}):
     # -- process options
     options.update(options_in)
 
+    # serialize dynamics and cost function calls
+    if options["vectorized"]:
+        dynamics_fun = dynamics_fun_in
+        cost_fun = cost_fun_in
+    else:
+        dynamics_fun = lambda x, u: func_serializer(x, u, dynamics_fun_in, options["pool"])
+        cost_fun = lambda x, u: func_serializer(x, u, cost_fun_in, options["pool"])
+    start_time = time.time()
+    trace = []
+
     lamb = options["lambdaInit"]
     dlamb = options["dlambdaInit"]
 
@@ -172,7 +215,7 @@ def ilqg(dynamics_fun_in, cost_fun_in, x0, u0, options_in={}):
                 cost = costn[:, 0]
             else:
                 logger.info("\nEXIT: Initial control sequence caused divergence\n")
-                return xn, un, None, None, None, costn
+                return xn, un, None, None, None, costn, zeros((0, 11))
 
     elif x0.shape[0] == N+1: # already did initial fpass
         x = x0
@@ -185,21 +228,41 @@ def ilqg(dynamics_fun_in, cost_fun_in, x0, u0, options_in={}):
     dcost = 0
     z = 0
     expected = 0
-    L = zeros((N, n, m))
+    L = zeros((N, m, n))
+    Vx = None
+    Vxx = None
 
     logger.info("\n============== begin iLQG ===============\n")
 
+    out_of_time = lambda: options["maxTime"] is not None and time.time() - start_time > options["maxTime"]
+
     for alg_iter in range(options["maxIter"]):
 
+        # ==== STEP 0: check the time budget
+        if out_of_time():
+            logger.info("\nEXIT: time budget of {} seconds exceeded".format(options["maxTime"]))
+            break
+
         # ==== STEP 1: differentiate dynamics along new trajectory
+        phase_start = time.time()
         if flgChange:
-            fx, fu, fxx, fxu, fuu = function_derivatives(x, vstack((u, full([1, m], nan))), dynamics_fun, second=True)
-            cx, cu, cxx, cxu, cuu = function_derivatives(x, vstack((u, full([1, m], nan))), cost_fun, second=True)
+            if options["dynamics_derivatives"] is not None:
+                fx, fu, fxx, fxu, fuu = options["dynamics_derivatives"](x, vstack((u, full([1, m], nan))))
+            else:
+                fx, fu, fxx, fxu, fuu = function_derivatives(x, vstack((u, full([1, m], nan))), dynamics_fun, second=True)
+            if options["cost_derivatives"] is not None:
+                cx, cu, cxx, cxu, cuu = options["cost_derivatives"](x, vstack((u, full([1, m], nan))))
+            else:
+                cx, cu, cxx, cxu, cuu = function_derivatives(x, vstack((u, full([1, m], nan))), cost_fun, second=True)
             flgChange = 0
+        time_derivs = time.time() - phase_start
 
         # ==== STEP 2: backward pass, compute optimal control law and cost-to-go
+        phase_start = time.time()
         backPassDone = 0
         while not backPassDone:
+            if out_of_time():
+                break
             diverge, Vx, Vxx, l, L, dV = back_pass(cx, cu, cxx, cxu, cuu, fx, fu, fxx, fxu, fuu, lamb, options["regType"], options["lims"], u)
 
             if diverge:
@@ -210,6 +273,10 @@ def ilqg(dynamics_fun_in, cost_fun_in, x0, u0, options_in={}):
                     break
                 continue
             backPassDone = 1
+        time_backward = time.time() - phase_start
+        if out_of_time():
+            logger.info("\nEXIT: time budget of {} seconds exceeded".format(options["maxTime"]))
+            break
 
         #Check for termination due to small gradient
         g_norm = mean((abs(l) / (abs(u)+1)).max(1))
@@ -220,6 +287,7 @@ def ilqg(dynamics_fun_in, cost_fun_in, x0, u0, options_in={}):
             break
 
         # ==== STEP 3: line-search to find new control sequence, trajectory, cost
+        phase_start = time.time()
         fwdPassDone = 0
         if backPassDone:
             if options["parallel"]: # parallel line-search
@@ -242,23 +310,32 @@ def ilqg(dynamics_fun_in, cost_fun_in, x0, u0, options_in={}):
 
             else: # serial backtracking line-search
                 for alpha in options["Alpha"]:
-                    xnew, unew, costnew = forward_pass(dynamics_fun, cost_fun, x0, u+l*alpha, L, x[:N], None, array([]), options["lims"])
+                    if out_of_time():
+                        break
+                    xnew, unew, costnew = forward_pass(dynamics_fun, cost_fun, x0, u, L, x[:N], l, array([alpha]), options["lims"])
+                    xnew = xnew[:, 0]
+                    unew = unew[:, 0]
+                    costnew = costnew[:, 0]
                     dcost = cost.sum(axis=0) - costnew.sum(axis=0)
                     expected = -alpha*(dV[0] + alpha*dV[1])
-                if expected > 0:
-                    z = dcost/expected
-                else:
-                    z = sign(dcost)
-                    logger.info("WARNING: non-positive expected reduction: should not occur")
-                if z > options["zMin"]:
-                    fwdPassDone = 1
-                    break
+                    if expected > 0:
+                        z = dcost/expected
+                    else:
+                        z = sign(dcost)
+                        logger.info("WARNING: non-positive expected reduction: should not occur")
+                    if z > options["zMin"]:
+                        fwdPassDone = 1
+                        break
+        time_forward = time.time() - phase_start
+        if not fwdPassDone and out_of_time():
+            logger.info("\nEXIT: time budget of {} seconds exceeded".format(options["maxTime"]))
+            break
 
         # ==== STEP 4: accept (or not)
         if fwdPassDone:
 
             # print status
-            logger.info('iter: {} cost: {} reduction: {} gradient: {} log10lam: {}'.format(alg_iter, sum(cost.flatten(1)), dcost, g_norm, nan if lamb == 0 else log10(lamb)))
+            logger.info('iter: {} cost: {} reduction: {} gradient: {} log10lam: {}'.format(alg_iter, cost.sum(), dcost, g_norm, nan if lamb == 0 else log10(lamb)))
 
             # decrease lambda
             dlamb = min(dlamb / options["lambdaFactor"], 1/options["lambdaFactor"])
@@ -269,12 +346,17 @@ def ilqg(dynamics_fun_in, cost_fun_in, x0, u0, options_in={}):
             x = xnew
             cost = costnew
             flgChange = 1
+            trace.append([alg_iter, lamb, alpha, g_norm, dcost, z, cost.sum(), dlamb, time_derivs, time_backward, time_forward])
 
             # terminate ?
             if dcost < options["tolFun"]:
                 logger.info("\nSUCCESS: cost change < tolFun")
                 break
 
+            if options["callback"] is not None and options["callback"](alg_iter, x, u, cost):
+                logger.info("\nEXIT: stopped by callback")
+                break
+
         else: # No cost improvement
 
             # increase lambda
@@ -283,6 +365,7 @@ def ilqg(dynamics_fun_in, cost_fun_in, x0, u0, options_in={}):
 
             # print status
             logger.info('iter: {} REJECTED expected: {} actual: {} log10lam: {}'.format(alg_iter, expected, dcost, log10(dlamb)))
+            trace.append([alg_iter, lamb, nan, g_norm, dcost, z, cost.sum(), dlamb, time_derivs, time_backward, time_forward])
 
             # terminate ?
             if lamb > options["lambdaMax"]:
@@ -291,7 +374,7 @@ def ilqg(dynamics_fun_in, cost_fun_in, x0, u0, options_in={}):
     else:
         logger.warn("\nEXIT: Maximum iterations reached.\n")
 
-    return x, u, L, Vx, Vxx, cost
+    return x, u, L, Vx, Vxx, cost, array(trace).reshape(-1, 11)
 
 
 def forward_pass(dynamics_fun, cost_fun, x0, u, L, x, du, alpha, lims):
@@ -380,14 +463,14 @@ def back_pass(cx, cu, cxx, cxu, cuu, fx, fu, fxx, fxu, fuu, lamb, regType, lims,
         if lims is None or lims[0,0] > lims[0, 1]:
             # no control limits: Cholesky decomposition, check for non-PD
             try:
-                R = linalg.cholesky(QuuF).T
+                R = cholesky(QuuF, check_finite=False)
             except linalg.LinAlgError as e:
                 #print(e)
                 diverge = i
                 return diverge, Vx, Vxx, k, K, dV
 
             # find control law
-            kK = linalg.solve(-R, linalg.solve(R.T, concatenate((Qu[:, None], Qux_reg), axis=1)))
+            kK = -cho_solve((R, False), concatenate((Qu[:, None], Qux_reg), axis=1), check_finite=False)
             k_i = kK[:,0]
             K_i = kK[:,1:n+1]
 
@@ -404,7 +487,7 @@ def back_pass(cx, cu, cxx, cxu, cuu, fx, fu, fxx, fxu, fuu, lamb, regType, lims,
 
             K_i = zeros((m, n))
             if free.any():
-                K_i[free,:] = linalg.solve(-R, linalg.solve(R.T, Qux_reg[free,:]))
+                K_i[free,:] = -cho_solve((R, False), Qux_reg[free,:], check_finite=False)
 
         # update cost-to-go approximation
         v1 = dot(k_i.T, Qu)
@@ -418,4 +501,132 @@ def back_pass(cx, cu, cxx, cxu, cuu, fx, fu, fxx, fxu, fuu, lamb, regType, lims,
         k[i] = k_i
         K[i] = K_i
 
-    return diverge, Vx, Vxx, k, K, dV
\ No newline at end of file
+    return diverge, Vx, Vxx, k, K, dV
+
+def forward_pass_batch(dynamics_fun, cost_fun, x0, u, L, x, du, alpha, lims):
+    """
+    forward_pass() for B trajectories at once, each line-searched over every alpha.
+    size(u)==[B N m], size(L)==[B N m n], size(x)==[B N n], size(du)==[B N m].
+    The dynamics and cost functions are called once per timestep with all B*K samples.
+    """
+
+    n = x0.shape[0]
+    B = u.shape[0]
+    K = alpha.shape[0]
+    N = u.shape[1]
+    m = u.shape[2]
+
+    xnew = zeros((N+1, B, K, n))
+    xnew[0] = x0
+    unew = zeros((N, B, K, m))
+    cnew = zeros((N+1, B, K))
+    for i in range(N):
+        unew[i] = u[:, None, i] + alpha[None, :, None]*du[:, None, i]
+        dx = xnew[i] - x[:, None, i]
+        unew[i] = unew[i] + matmul(dx, L[:, i].transpose(0, 2, 1))
+
+        if lims is not None:
+            unew[i] = clip(unew[i], lims[:, 0], lims[:, 1])
+
+        xnew[i+1] = dynamics_fun(xnew[i].reshape(B*K, n), unew[i].reshape(B*K, m)).reshape(B, K, n)
+        cnew[i] = cost_fun(xnew[i].reshape(B*K, n), unew[i].reshape(B*K, m)).reshape(B, K)
+
+    cnew[N] = cost_fun(xnew[N].reshape(B*K, n), full([B*K, m], nan)).reshape(B, K)
+
+    return xnew, unew, cnew
+
+
+def back_pass_batch(cx, cu, cxx, cxu, cuu, fx, fu, fxx, fxu, fuu, lamb, regType, lims, u):
+    """
+    back_pass() for B independent trajectories at once. Every argument has a
+    leading axis of size B, including lamb. The control QPs of all B
+    trajectories at each timestep are solved with one boxQP_batch() call.
+
+    Instead of the timestep at which Cholesky failed, diverge is a boolean
+    array marking the trajectories whose backward pass failed. Their outputs
+    are left partially computed.
+    """
+
+    # sum over the output dimension of second order dynamics terms, weighted by Vx
+    tensor = lambda Vx, f: einsum('zk,zbak->zab', Vx, f)
+    transpose = lambda a: a.transpose(0, 2, 1)
+
+    B = cx.shape[0]
+    N = cx.shape[1]
+    n = cx.shape[2]
+    m = cu.shape[2]
+
+    k = zeros((B, N-1, m))
+    K = zeros((B, N-1, m, n))
+    Vx = zeros((B, N, n))
+    Vxx = zeros((B, N, n, n))
+    dV = zeros((B, 2))
+
+    Vx[:, N-1] = cx[:, N-1]
+    Vxx[:, N-1] = cxx[:, N-1]
+
+    if lims is None or lims[0, 0] > lims[0, 1]:
+        lims = array([[-inf, inf]]*m)
+
+    diverge = zeros(B, dtype=bool)
+    for i in reversed(range(N-1)):
+        # drop the trajectories that have already failed
+        z = flatnonzero(~diverge)
+        if z.size == 0:
+            break
+        fu_i = fu[z, i]
+        fx_i = fx[z, i]
+        Vx_next = Vx[z, i+1]
+        Vxx_next = Vxx[z, i+1]
+
+        Qu = cu[z, i] + einsum('zmn,zn->zm', fu_i, Vx_next)
+        Qx = cx[z, i] + einsum('zmn,zn->zm', fx_i, Vx_next)
+
+        Quu = transpose(cuu[z, i]) + matmul(matmul(fu_i, Vxx_next), transpose(fu_i))
+        if fuu is not None:
+            fuuVx = tensor(Vx_next, fuu[z, i])
+            Quu = Quu + fuuVx
+
+        Qux = transpose(cxu[z, i]) + matmul(matmul(fu_i, Vxx_next), transpose(fx_i))
+        if fxu is not None:
+            fxuVx = tensor(Vx_next, fxu[z, i])
+            Qux = Qux + fxuVx
+
+        Qxx = transpose(cxx[z, i]) + matmul(matmul(fx_i, Vxx_next), transpose(fx_i))
+        if fxx is not None:
+            Qxx = Qxx + tensor(Vx_next, fxx[z, i])
+
+        Vxx_reg = Vxx_next + lamb[z, None, None]*eye(n)*(regType == 2)
+
+        Qux_reg = transpose(cxu[z, i]) + matmul(matmul(fu_i, Vxx_reg), transpose(fx_i))
+        if fxu is not None:
+            Qux_reg = Qux_reg + fxuVx
+
+        QuuF = cuu[z, i] + matmul(matmul(fu_i, Vxx_reg), transpose(fu_i)) + lamb[z, None, None]*eye(m)*(regType == 1)
+        if fuu is not None:
+            QuuF = QuuF + fuuVx
+
+        # Solve the Quadratic Programs of every trajectory
+        lower = lims[:, 0] - u[z, i]
+        upper = lims[:, 1] - u[z, i]
+        k_i, result, R, free = boxQP_batch(QuuF, Qu, lower, upper, k[z, min((i+1, N-2))])
+
+        failed = result == -1
+        diverge[z[failed]] = True
+
+        # the gains of the free controls from the masked factors, clamped controls get none
+        K_i = -cho_solve_batch(R, where(free[:, :, None], Qux_reg, 0))
+
+        # update cost-to-go approximation
+        dV[z, 0] += einsum('zm,zm->z', k_i, Qu)
+        dV[z, 1] += .5*einsum('zm,zmj,zj->z', k_i, Quu, k_i)
+        KT = transpose(K_i)
+        Vx[z, i] = Qx + einsum('znm,zm->zn', matmul(KT, Quu), k_i) + einsum('znm,zm->zn', KT, Qu) + einsum('zmn,zm->zn', Qux, k_i)
+        Vxx_i = Qxx + matmul(matmul(KT, Quu), K_i) + matmul(KT, Qux) + matmul(transpose(Qux), K_i)
+        Vxx[z, i] = .5*(Vxx_i + transpose(Vxx_i))
+
+        # save controls/gains
+        k[z, i] = k_i
+        K[z, i] = K_i
+
+    return diverge, Vx, Vxx, k, K, dV
@@ -0,0 +1,326 @@
+from numpy import *
+from multiprocessing import Pool, Value
+from builtins import min, max
+from .ilqg import ilqg, forward_pass, forward_pass_batch, back_pass_batch, function_derivatives, func_serializer
+import logging
+import time
+logger = logging.getLogger("iLQG")
+
+# Best total cost seen by any start, shared between worker processes
+_best_cost = None
+
+
+def _init_worker(best_cost):
+    global _best_cost
+    _best_cost = best_cost
+
+
+def _prune_callback(options):
+    # Record accepted costs in the shared best, and give up on a start once
+    # it is still far behind the best after a few iterations, or when the
+    # user's own callback says so
+    user_callback = options.get("callback")
+
+    def callback(alg_iter, x, u, cost):
+        total = cost.sum()
+        with _best_cost.get_lock():
+            if total < _best_cost.value:
+                _best_cost.value = total
+            best = _best_cost.value
+        prune = alg_iter >= options["pruneIter"] and total > best + options["pruneMargin"]*abs(best)
+        if user_callback is not None and user_callback(alg_iter, x, u, cost):
+            return True
+        return prune
+    return callback
+
+
+def _run_start(args):
+    dynamics_fun, cost_fun, x0, u0, options = args
+    ilqg_options = dict(options)
+    for key in ["pruneIter", "pruneMargin"]:
+        ilqg_options.pop(key)
+    ilqg_options["callback"] = _prune_callback(options)
+    return ilqg(dynamics_fun, cost_fun, x0, u0, ilqg_options)
+
+
+def ilqg_multistart(dynamics_fun, cost_fun, x0, u0s, options_in={}, processes=None, lockstep=False):
+    """
+    Run ilqg() from each of several initial control sequences and keep the best.
+
+    Starts are spread over a pool of worker processes, which share the best
+    accepted cost so far. A start that is still more than pruneMargin*|best|
+    worse than the best after pruneIter iterations is abandoned early.
+
+    With lockstep, every start is instead run in this process by ilqg_lockstep(),
+    which is faster than a pool when the dynamics and cost are vectorized and cheap.
+
+    :param dynamics_fun: The dynamics function, as for ilqg(). Must be picklable (e.g. module-level).
+    :param cost_fun: The cost function, as for ilqg(). Must be picklable.
+    :param x0: The initial state.
+    :param u0s: The initial control sequences to start from, size(u0s)==[S N m].
+    :param options_in: ilqg() options, plus pruneIter and pruneMargin. A callback is called for every start
+    and must be picklable too, each worker process calls its own copy.
+    :param processes: Number of worker processes, None for one per cpu. 1 runs every start in this process.
+    :param lockstep: Run the starts together with ilqg_lockstep() instead of one ilqg() each.
+
+    :return The ilqg() outputs for the start that reached the lowest total cost.
+    """
+    options = {
+        'pruneIter':      5,  # iterations before a start may be pruned
+        'pruneMargin':    0.5,  # relative distance from the best cost at which starts are pruned
+    }
+    options.update(options_in)
+
+    if lockstep:
+        results = ilqg_lockstep(dynamics_fun, cost_fun, x0, u0s, options)
+        return _best_result(results)
+
+    best_cost = Value('d', inf)
+    jobs = [(dynamics_fun, cost_fun, x0, u0, options) for u0 in u0s]
+    if processes == 1:
+        _init_worker(best_cost)
+        results = [_run_start(job) for job in jobs]
+    else:
+        with Pool(processes, initializer=_init_worker, initargs=(best_cost,)) as pool:
+            results = pool.map(_run_start, jobs)
+    return _best_result(results)
+
+
+def _best_result(results):
+    totals = array([result[5].sum() for result in results])
+    totals[isnan(totals)] = inf
+    best = argmin(totals)
+    logger.info("multistart: best of {} starts is #{} with cost {}".format(len(results), best, totals[best]))
+    return results[best]
+
+
+def ilqg_lockstep(dynamics_fun_in, cost_fun_in, x0, u0s, options_in={}):
+    """
+    Run ilqg() from each of several initial control sequences together in this process.
+
+    Every iteration differentiates each start's trajectory, then runs the backward
+    passes of all starts with back_pass_batch(), which solves the control QPs of every
+    start at each timestep with a single boxQP_batch() call, and line-searches every
+    start and Alpha in one forward_pass_batch(). Each start keeps its own regularization
+    and stops on its own; without pruning the results match running ilqg() on each start.
+    Only the parallel line-search is supported. The callback is called after every accepted
+    iteration of each start, and stops that start when it returns True.
+
+    The time budget is checked as in ilqg(). When it runs out, every running start whose
+    trajectory has moved since its last backward pass gets one more differentiation and
+    backward pass, so the returned L is the feedback gain about the returned x, or zero
+    if that pass diverged.
+
+    :param u0s: The initial control sequences to start from, size(u0s)==[S N m].
+    :param options_in: ilqg() options, plus pruneIter and pruneMargin as for
+    ilqg_multistart(). Starts are only pruned if pruneIter is given.
+
+    :return A list of the ilqg() outputs of every start.
+    """
+    options = {
+        'lims':           None,  # control limits
+        'vectorized':     False,  # dynamics and cost accept [K n] and [K m] inputs?
+        'pool':           None,  # executor to evaluate non-vectorized functions with
+        'Alpha':          10**linspace(0, -3, 8),  # backtracking coefficients
+        'tolFun':         1e-7,  # reduction exit criterion
+        'tolGrad':        1e-5,  # gradient exit criterion
+        'maxIter':        500,  # maximum iterations
+        'lambdaInit':     1,  # initial value for lambda
+        'dlambdaInit':    1,  # initial value for dlambda
+        'lambdaFactor':   1.6,  # lambda scaling factor
+        'lambdaMax':      1e10,  # lambda maximum value
+        'lambdaMin':      1e-6,  # below this value lambda = 0
+        'regType':        1,  # regularization type 1: q_uu+lambda*eye(); 2: V_xx+lambda*eye()
+        'zMin':           0,  # minimal accepted reduction ratio
+        'maxTime':        None,  # wall time budget in seconds, None for no limit
+        'callback':       None,  # f(iter, x, u, cost) after each accepted step of a start, return True to stop it
+        'dynamics_derivatives': None,  # f(x, u) -> fx, fu, fxx, fxu, fuu, None for finite differences
+        'cost_derivatives': None,  # f(x, u) -> cx, cu, cxx, cxu, cuu, None for finite differences
+        'pruneIter':      None,  # iterations before a start may be pruned, None to never prune
+        'pruneMargin':    0.5,  # relative distance from the best cost at which starts are pruned
+    }
+    options.update(options_in)
+
+    if options["vectorized"]:
+        dynamics_fun = dynamics_fun_in
+        cost_fun = cost_fun_in
+    else:
+        dynamics_fun = lambda x, u: func_serializer(x, u, dynamics_fun_in, options["pool"])
+        cost_fun = lambda x, u: func_serializer(x, u, cost_fun_in, options["pool"])
+    start_time = time.time()
+
+    S, N, m = u0s.shape
+    n = x0.shape[0]
+    f = options["lambdaFactor"]
+    Alpha = options["Alpha"]
+
+    results = [None]*S
+    traces = [[] for s in range(S)]
+    x = zeros((S, N+1, n))
+    u = array(u0s, dtype=float)
+    cost = zeros((S, N+1))
+    lamb = full(S, float(options["lambdaInit"]))
+    dlamb = full(S, float(options["dlambdaInit"]))
+    running = ones(S, dtype=bool)
+
+    # Initial trajectories, as in ilqg()
+    for s in range(S):
+        for alpha in Alpha:
+            xn, un, costn = forward_pass(dynamics_fun, cost_fun, x0, alpha*u[s], None, None, None, array([1]), options["lims"])
+            if (abs(xn) < 1e8).all():
+                u[s] = un[:, 0]
+                x[s] = xn[:, 0]
+                cost[s] = costn[:, 0]
+            else:
+                logger.info("lockstep: initial control sequence of start #{} caused divergence".format(s))
+                results[s] = (xn[:, 0], un[:, 0], None, None, None, costn[:, 0], zeros((0, 11)))
+                running[s] = False
+                break
+
+    derivatives = [None]*S
+    changed = running.copy()
+    L = zeros((S, N, m, n))
+    l = zeros((S, N, m))
+    dV = zeros((S, 2))
+    Vx = [None]*S
+    Vxx = [None]*S
+    # whether L of each start was computed about its current trajectory
+    fresh = zeros(S, dtype=bool)
+    out_of_budget = False
+    best = inf
+    out_of_time = lambda: options["maxTime"] is not None and time.time() - start_time > options["maxTime"]
+
+    def differentiate(starts):
+        for s in starts:
+            xu = vstack((u[s], full([1, m], nan)))
+            if options["dynamics_derivatives"] is not None:
+                dynamics_derivatives = options["dynamics_derivatives"](x[s], xu)
+            else:
+                dynamics_derivatives = function_derivatives(x[s], xu, dynamics_fun, second=True)
+            if options["cost_derivatives"] is not None:
+                cost_derivatives = options["cost_derivatives"](x[s], xu)
+            else:
+                cost_derivatives = function_derivatives(x[s], xu, cost_fun, second=True)
+            derivatives[s] = tuple(cost_derivatives) + tuple(dynamics_derivatives)
+            changed[s] = False
+
+    def backward(todo, final=False):
+        # backward passes of the starts in todo, raising lambda for the starts whose pass diverged,
+        # a final pass is neither retried nor limited by the budget
+        # :returns the starts whose lambda went past lambdaMax
+        exhausted_all = []
+        while todo.any():
+            if not final and out_of_time():
+                break
+            z = flatnonzero(todo)
+            stacked = [None if derivatives[z[0]][j] is None else array([derivatives[s][j] for s in z]) for j in range(10)]
+            diverge, Vx_z, Vxx_z, l_z, L_z, dV_z = back_pass_batch(*stacked, lamb[z], options["regType"], options["lims"], u[z])
+            for j, s in enumerate(z):
+                Vx[s] = Vx_z[j]
+                Vxx[s] = Vxx_z[j]
+            done = z[~diverge]
+            l[done] = l_z[~diverge]
+            L[done] = L_z[~diverge]
+            dV[done] = dV_z[~diverge]
+            fresh[done] = True
+            todo[done] = False
+
+            diverged = z[diverge]
+            dlamb[diverged] = maximum(dlamb[diverged]*f, f)
+            lamb[diverged] = maximum(lamb[diverged]*dlamb[diverged], options["lambdaMin"])
+            exhausted = diverged[lamb[diverged] > options["lambdaMax"]]
+            todo[exhausted] = False
+            exhausted_all.extend(exhausted)
+            if final:
+                break
+        return array(exhausted_all, dtype=int)
+
+    for alg_iter in range(options["maxIter"]):
+        if not running.any():
+            break
+
+        # ==== STEP 0: check the time budget, softly as in ilqg()
+        if out_of_time():
+            logger.info("lockstep: time budget of {} seconds exceeded".format(options["maxTime"]))
+            out_of_budget = True
+            break
+
+        # ==== STEP 1: differentiate dynamics along the new trajectories
+        phase_start = time.time()
+        differentiate(flatnonzero(changed & running))
+        time_derivs = time.time() - phase_start
+
+        # ==== STEP 2: backward passes, raising lambda for the starts whose pass diverged
+        phase_start = time.time()
+        running[backward(running.copy())] = False
+        time_backward = time.time() - phase_start
+        if out_of_time():
+            logger.info("lockstep: time budget of {} seconds exceeded".format(options["maxTime"]))
+            out_of_budget = True
+            break
+
+        # check for termination due to small gradient
+        g_norm = mean((abs(l)/(abs(u)+1)).max(2), 1)
+        small = running & (g_norm < options["tolGrad"]) & (lamb < 1e-5)
+        dlamb[small] = minimum(dlamb[small]/f, 1/f)
+        lamb[small] = lamb[small]*dlamb[small]*(lamb[small] > options["lambdaMin"])
+        running &= ~small
+
+        # ==== STEP 3: line-search every start over every Alpha at once
+        phase_start = time.time()
+        z = flatnonzero(running)
+        if z.size == 0:
+            break
+        xnew, unew, costnew = forward_pass_batch(dynamics_fun, cost_fun, x0, u[z], L[z], x[z, :N], l[z], Alpha, options["lims"])
+        dcost = cost[z].sum(1)[:, None] - costnew.sum(0)
+        w = argmax(dcost, 1)
+        dcost = dcost[arange(z.size), w]
+        alpha = Alpha[w]
+        expected = -alpha*(dV[z, 0] + alpha*dV[z, 1])
+        with errstate(divide='ignore', invalid='ignore'):
+            ratio = where(expected > 0, dcost/expected, sign(dcost))
+        time_forward = time.time() - phase_start
+
+        # ==== STEP 4: accept (or not)
+        for j, s in enumerate(z):
+            if ratio[j] > options["zMin"]:
+                dlamb[s] = min(dlamb[s]/f, 1/f)
+                lamb[s] = lamb[s]*dlamb[s]*(lamb[s] > options["lambdaMin"])
+                u[s] = unew[:, j, w[j]]
+                x[s] = xnew[:, j, w[j]]
+                cost[s] = costnew[:, j, w[j]]
+                changed[s] = True
+                fresh[s] = False
+                traces[s].append([alg_iter, lamb[s], alpha[j], g_norm[s], dcost[j], ratio[j], cost[s].sum(), dlamb[s],
+                                  time_derivs, time_backward, time_forward])
+                total = cost[s].sum()
+                best = min(best, total)
+                if dcost[j] < options["tolFun"]:
+                    running[s] = False
+                elif options["pruneIter"] is not None and alg_iter >= options["pruneIter"] and \
+                        total > best + options["pruneMargin"]*abs(best):
+                    logger.info("lockstep: pruned start #{} at cost {}".format(s, total))
+                    running[s] = False
+                elif options["callback"] is not None and options["callback"](alg_iter, x[s], u[s], cost[s]):
+                    logger.info("lockstep: start #{} stopped by callback".format(s))
+                    running[s] = False
+            else:
+                dlamb[s] = max(dlamb[s]*f, f)
+                lamb[s] = max(lamb[s]*dlamb[s], options["lambdaMin"])
+                traces[s].append([alg_iter, lamb[s], nan, g_norm[s], dcost[j], ratio[j], cost[s].sum(), dlamb[s],
+                                  time_derivs, time_backward, time_forward])
+                if lamb[s] > options["lambdaMax"]:
+                    running[s] = False
+
+    if out_of_budget:
+        # The budget ran out before the backward passes about the last accepted trajectories
+        stale = running & ~fresh
+        differentiate(flatnonzero(stale & changed))
+        backward(stale.copy(), final=True)
+        # no gain about the trajectory of a start whose pass diverged
+        L[stale & ~fresh] = 0
+
+    for s in range(S):
+        if results[s] is None:
+            results[s] = (x[s], u[s], L[s], Vx[s], Vxx[s], cost[s], array(traces[s]).reshape(-1, 11))
+    return results
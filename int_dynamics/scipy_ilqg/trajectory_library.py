@@ -0,0 +1,94 @@
+from numpy import *
+from numpy.lib.format import open_memmap
+from scipy.spatial import cKDTree
+from os.path import join, exists
+from os import makedirs
+from .ilqg import ilqg
+import logging
+logger = logging.getLogger("iLQG")
+
+
+class TrajectoryLibrary:
+    """
+    A library of precomputed ilqg() solutions stored as memory-mapped numpy arrays,
+    indexed by a key vector (usually the start state and goal) with a KD-tree.
+
+    The directory holds keys.npy (P * k), x.npy (P * N+1 * n), u.npy (P * N * m) and L.npy (P * N * m * n).
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.keys = load(join(directory, "keys.npy"))
+        self.x = load(join(directory, "x.npy"), mmap_mode='r')
+        self.u = load(join(directory, "u.npy"), mmap_mode='r')
+        self.L = load(join(directory, "L.npy"), mmap_mode='r')
+        self.tree = cKDTree(self.keys)
+
+    def __len__(self):
+        return self.keys.shape[0]
+
+    def nearest(self, key):
+        """
+        :return The distance to and index of the trajectory whose key is nearest to the given key.
+        """
+        distance, index = self.tree.query(key)
+        return distance, index
+
+    def get(self, index):
+        """
+        :return The x, u and L arrays of a trajectory, as read-only views into the library files.
+        """
+        return self.x[index], self.u[index], self.L[index]
+
+    def lookup(self, key):
+        """
+        :return The x, u and L arrays of the trajectory whose key is nearest to the given key.
+        """
+        return self.get(self.nearest(key)[1])
+
+    @classmethod
+    def build(cls, directory, dynamics_fun, make_cost_fun, starts, goals, u0, options_in={}, dtype=float32):
+        """
+        Solve ilqg() from every start to every goal and save the results as a library.
+
+        :param directory: Where to write the library files, created if it does not exist.
+        :param dynamics_fun: The dynamics function, as for ilqg().
+        :param make_cost_fun: Called with a goal, returns the cost function for ilqg() reaching that goal.
+        :param starts: Initial states, size(starts)==[S n].
+        :param goals: Goals, size(goals)==[G k-n]. Each trajectory's key is hstack((start, goal)).
+        :param u0: The initial control sequence used for every solve, size(u0)==[N m].
+        :param options_in: ilqg() options.
+        :param dtype: The dtype the trajectories are stored as.
+
+        :return The new TrajectoryLibrary.
+        """
+        if not exists(directory):
+            makedirs(directory)
+        starts = atleast_2d(starts)
+        goals = atleast_2d(goals)
+        count = starts.shape[0]*goals.shape[0]
+        N, m = u0.shape
+        n = starts.shape[1]
+
+        keys = zeros((count, n + goals.shape[1]))
+        x_file = open_memmap(join(directory, "x.npy"), 'w+', dtype, (count, N+1, n))
+        u_file = open_memmap(join(directory, "u.npy"), 'w+', dtype, (count, N, m))
+        L_file = open_memmap(join(directory, "L.npy"), 'w+', dtype, (count, N, m, n))
+        index = 0
+        for goal in goals:
+            cost_fun = make_cost_fun(goal)
+            for start in starts:
+                x, u, L, Vx, Vxx, cost, trace = ilqg(dynamics_fun, cost_fun, start, u0.copy(), options_in)
+                if L is None:
+                    raise ValueError("Initial controls diverged from start {} to goal {}".format(start, goal))
+                keys[index] = hstack((start, goal))
+                x_file[index] = x
+                u_file[index] = u
+                L_file[index] = L
+                logger.info("trajectory library: solved {} of {} with cost {}".format(index+1, count, cost.sum()))
+                index += 1
+        save(join(directory, "keys.npy"), keys)
+        for array_file in [x_file, u_file, L_file]:
+            array_file.flush()
+        del x_file, u_file, L_file
+        return cls(directory)
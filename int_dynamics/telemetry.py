@@ -0,0 +1,694 @@
+"""
+Schema-once, values-many telemetry.
+
+A TelemetryLayout names the fields of a flat float64 frame. A TelemetryServer sends the layout to each
+subscriber once, when it subscribes, and then one packed frame per tick. A TelemetryClient subscribes to
+a server and decodes the frames. Every datagram starts with HEADER: a magic number, the message kind,
+the id of the layout and a sequence number. This module does not depend on theano, so dashboards can use it.
+"""
+import json
+import socket
+import struct
+import threading
+import time
+import traceback
+import zlib
+from collections import deque, OrderedDict
+from os import makedirs
+from os.path import join, exists
+import numpy as np
+from numpy.lib.format import open_memmap
+
+MAGIC = b"IDT1"
+HEADER = struct.Struct("<4sBII")
+KIND_SUBSCRIBE = 0
+KIND_LAYOUT = 1
+KIND_FRAME = 2
+FRAME_DTYPE = np.dtype("<f8")
+
+
+class TelemetryLayout:
+    """
+    The names and sizes of the fields of a telemetry frame, in frame order.
+    Names are "/" separated paths, like the keys that sink_state_data publishes to NetworkTables.
+    """
+
+    def __init__(self, fields):
+        self.fields = [(str(name), int(size)) for name, size in fields]
+        self.slices = {}
+        index = 0
+        for name, size in self.fields:
+            self.slices[name] = slice(index, index+size)
+            index += size
+        self.size = index
+        self.layout_id = zlib.crc32(self.to_json().encode("utf-8"))
+
+    def __len__(self):
+        return self.size
+
+    def get_slice(self, name):
+        return self.slices[name]
+
+    def new_frame(self):
+        return np.zeros(self.size, dtype=FRAME_DTYPE)
+
+    def to_json(self):
+        return json.dumps({"fields": self.fields})
+
+    @classmethod
+    def from_json(cls, text):
+        return cls(json.loads(text)["fields"])
+
+    def to_dict(self, frame):
+        """
+        :returns the frame as nested dictionaries split on "/", with arrays for fields larger than one value.
+        """
+        dictionary = {}
+        for name, size in self.fields:
+            keys = name.split("/")
+            level = dictionary
+            for key in keys[:-1]:
+                level = level.setdefault(key, {})
+            value = frame[self.slices[name]]
+            level[keys[-1]] = value[0] if size == 1 else value
+        return dictionary
+
+
+def pack_message(kind, layout_id, sequence, payload=b""):
+    return HEADER.pack(MAGIC, kind, layout_id, sequence) + payload
+
+
+def unpack_message(data):
+    """
+    :returns kind, layout_id, sequence and payload of a datagram, or None if it is not a telemetry message.
+    """
+    if len(data) < HEADER.size:
+        return None
+    magic, kind, layout_id, sequence = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        return None
+    return kind, layout_id, sequence, data[HEADER.size:]
+
+
+class TelemetryServer:
+    """
+    Sends telemetry frames to every subscriber of a UDP port, without ever blocking the caller.
+    Subscribers that have not renewed their subscription within subscription_timeout seconds are dropped.
+    """
+
+    def __init__(self, port, layout, subscription_timeout=5.0):
+        self.port = port
+        self.layout = layout
+        self.subscription_timeout = subscription_timeout
+        self.subscribers = {}
+        self.sequence = 0
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("", port))
+        self.socket.setblocking(False)
+        self.layout_message = pack_message(KIND_LAYOUT, layout.layout_id, 0, layout.to_json().encode("utf-8"))
+
+    def _poll_subscriptions(self):
+        now = time.time()
+        while True:
+            try:
+                data, address = self.socket.recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                # ICMP port unreachable from a departed subscriber surfaces here on some platforms
+                continue
+            message = unpack_message(data)
+            if message is None or message[0] != KIND_SUBSCRIBE:
+                continue
+            # Subscribers send the id of the layout they hold, so a lost layout message is resent
+            if message[1] != self.layout.layout_id:
+                self._send(self.layout_message, address)
+            self.subscribers[address] = now
+        for address in [address for address, last_time in self.subscribers.items()
+                        if now - last_time > self.subscription_timeout]:
+            del self.subscribers[address]
+
+    def _send(self, message, address):
+        try:
+            self.socket.sendto(message, address)
+        except OSError:
+            pass
+
+    def send_frame(self, frame):
+        self._poll_subscriptions()
+        self.sequence = (self.sequence + 1) & 0xffffffff
+        if len(self.subscribers) == 0:
+            return
+        message = pack_message(KIND_FRAME, self.layout.layout_id, self.sequence,
+                               np.asarray(frame, dtype=FRAME_DTYPE).tobytes())
+        for address in self.subscribers:
+            self._send(message, address)
+
+    def close(self):
+        self.socket.close()
+
+
+class TelemetryClient:
+    """
+    Subscribes to a TelemetryServer and decodes its frames.
+    Call poll() regularly; it renews the subscription every resubscribe_interval seconds and
+    returns the frames received since the last call.
+    """
+
+    def __init__(self, host, port, resubscribe_interval=1.0):
+        self.address = (host, port)
+        self.resubscribe_interval = resubscribe_interval
+        self.last_subscribe_time = 0
+        self.layout = None
+        self.last_frame = None
+        self.last_sequence = None
+        self.dropped_frames = 0
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(("", 0))
+        self.socket.setblocking(False)
+
+    def subscribe(self):
+        try:
+            layout_id = 0 if self.layout is None else self.layout.layout_id
+            self.socket.sendto(pack_message(KIND_SUBSCRIBE, layout_id, 0), self.address)
+        except OSError:
+            pass
+        self.last_subscribe_time = time.time()
+
+    def set_layout(self, layout):
+        """
+        Replaces the layout, or drops it with None, along with the last frame and sequence number of the old one.
+        """
+        self.layout = layout
+        self.last_frame = None
+        self.last_sequence = None
+
+    def poll(self):
+        """
+        :returns a list of the frames received since the last poll, as float64 arrays laid out by self.layout.
+        """
+        if time.time() - self.last_subscribe_time > self.resubscribe_interval:
+            self.subscribe()
+        frames = []
+        while True:
+            try:
+                data = self.socket.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                continue
+            message = unpack_message(data)
+            if message is None:
+                continue
+            kind, layout_id, sequence, payload = message
+            if kind == KIND_LAYOUT:
+                if self.layout is None or layout_id != self.layout.layout_id:
+                    self.set_layout(TelemetryLayout.from_json(payload.decode("utf-8")))
+                    del frames[:]
+            elif kind == KIND_FRAME and (self.layout is None or layout_id != self.layout.layout_id):
+                # The server's layout is unknown or has changed, ask for it again
+                self.set_layout(None)
+                del frames[:]
+                if time.time() - self.last_subscribe_time > .1:
+                    self.subscribe()
+            elif kind == KIND_FRAME:
+                if self.last_sequence is not None and sequence > self.last_sequence + 1:
+                    self.dropped_frames += sequence - self.last_sequence - 1
+                self.last_sequence = sequence
+                frames.append(np.frombuffer(payload, dtype=FRAME_DTYPE))
+        if len(frames) > 0:
+            self.last_frame = frames[-1]
+        return frames
+
+    def get_data(self):
+        """
+        :returns the latest frame as nested dictionaries, like simplestreamer's get_data(), or {} before the first frame.
+        """
+        if self.last_frame is None:
+            return {}
+        return self.layout.to_dict(self.last_frame)
+
+    def close(self):
+        self.socket.close()
+
+
+def match_prefix(name, values, default):
+    """
+    :returns the value of the longest "/" separated prefix of name in values, or default if none match.
+    """
+    keys = name.split("/")
+    for i in range(len(keys), 0, -1):
+        prefix = "/".join(keys[:i])
+        if prefix in values:
+            return values[prefix]
+    return default
+
+
+class NetworkTablesPublisher:
+    """
+    Publishes telemetry frames to a NetworkTable, one number per frame element, only sending an element
+    when it has moved by more than its deadband and its publish period has elapsed.
+
+    Rates (publishes per second) and deadbands are looked up by the longest matching prefix of the field
+    name, so {"loads": 50, "sensors/encoder": 10} applies to every load state and one sensor.
+    A rate of None publishes every frame. Entry handles are resolved once, when the publisher is made.
+    """
+
+    def __init__(self, table, layout, prefix, rates=None, default_rate=None, deadbands=None, default_deadband=0.0):
+        self.layout = layout
+        setters = []
+        periods = []
+        element_deadbands = []
+        for name, size in layout.fields:
+            rate = match_prefix(name, rates or {}, default_rate)
+            deadband = match_prefix(name, deadbands or {}, default_deadband)
+            for i in range(size):
+                key = "/".join((prefix, name)) if size == 1 else "/".join((prefix, name, str(i)))
+                setters.append(self._get_setter(table, key))
+                periods.append(0.0 if rate is None else 1/rate)
+                element_deadbands.append(deadband)
+        self.setters = setters
+        self.periods = np.array(periods)
+        self.deadbands = np.array(element_deadbands)
+        self.last_values = np.full(layout.size, np.nan)
+        self.last_times = np.full(layout.size, -np.inf)
+        self.publish_count = 0
+
+    @staticmethod
+    def _get_setter(table, key):
+        if hasattr(table, "getEntry"):
+            return table.getEntry(key).setDouble
+        return lambda value: table.putNumber(key, value)
+
+    def publish(self, frame, now=None):
+        """
+        :returns the number of values sent.
+        """
+        if now is None:
+            now = time.time()
+        # Comparisons against the initial nans are false, so every element is sent the first time
+        unchanged = np.abs(frame - self.last_values) <= self.deadbands
+        due = np.flatnonzero(~unchanged & (now - self.last_times >= self.periods))
+        for index in due:
+            self.setters[index](float(frame[index]))
+        self.last_values[due] = frame[due]
+        self.last_times[due] = now
+        self.publish_count += len(due)
+        return len(due)
+
+
+class BackgroundSink:
+    """
+    Hands items to consumer(item) on a daemon thread, so slow I/O never stalls the caller.
+    The queue holds at most max_size items; when it is full the oldest item is dropped and counted.
+    """
+
+    def __init__(self, consumer, max_size=4, name="telemetry sink"):
+        self.consumer = consumer
+        self.queue = deque(maxlen=max_size)
+        self.condition = threading.Condition()
+        self.dropped_frames = 0
+        self.sent_frames = 0
+        self.failed_frames = 0
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        with self.condition:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped_frames += 1
+            self.queue.append(item)
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.running and len(self.queue) == 0:
+                    self.condition.wait()
+                if len(self.queue) == 0:
+                    return
+                item = self.queue.popleft()
+            try:
+                self.consumer(item)
+                self.sent_frames += 1
+            except Exception:
+                self.failed_frames += 1
+                if self.failed_frames == 1:
+                    traceback.print_exc()
+
+    def get_state(self):
+        return {
+            "queued": len(self.queue),
+            "sent_frames": self.sent_frames,
+            "dropped_frames": self.dropped_frames,
+            "failed_frames": self.failed_frames
+        }
+
+    def stop(self, timeout=None):
+        """
+        Stop the thread once the items already queued are consumed.
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join(timeout)
+
+
+class StateRecorder:
+    """
+    Records telemetry frames at full rate into preallocated memory-mapped numpy ring files, one per group of
+    fields, so a write is a handful of row copies into the page cache. Once capacity frames are written the
+    oldest are overwritten. The directory holds layout.json, index.npy (the count of frames written) and
+    <group>.npy of shape [capacity, group size] for every group. Read it back with Recording.
+    """
+
+    def __init__(self, directory, layout, groups, capacity=65536):
+        """
+        :param layout: The TelemetryLayout of the frames.
+        :param groups: An ordered dictionary of group names to lists of field names, each contiguous in the layout.
+        """
+        if not exists(directory):
+            makedirs(directory)
+        self.directory = directory
+        self.capacity = capacity
+        self.groups = []
+        for group, names in groups.items():
+            if len(names) == 0:
+                continue
+            group_slice = slice(layout.get_slice(names[0]).start, layout.get_slice(names[-1]).stop)
+            group_file = open_memmap(join(directory, group + ".npy"), 'w+', FRAME_DTYPE,
+                                     (capacity, group_slice.stop - group_slice.start))
+            self.groups.append((group_slice, group_file))
+        with open(join(directory, "layout.json"), 'w') as f:
+            json.dump({
+                "fields": layout.fields,
+                "groups": OrderedDict((group, names) for group, names in groups.items() if len(names) > 0),
+                "capacity": capacity
+            }, f)
+        self.index = open_memmap(join(directory, "index.npy"), 'w+', np.int64, (1,))
+        self.count = 0
+
+    def record(self, frame):
+        row = self.count % self.capacity
+        for group_slice, group_file in self.groups:
+            group_file[row] = frame[group_slice]
+        self.count += 1
+        self.index[0] = self.count
+
+    def flush(self):
+        for group_slice, group_file in self.groups:
+            group_file.flush()
+        self.index.flush()
+
+    def close(self):
+        self.flush()
+        self.groups = []
+        self.index = None
+
+
+class Recording:
+    """
+    A recording made by StateRecorder, with every group as an array of frames in the order they were recorded.
+    Unless the ring wrapped around, the arrays are read-only memory maps of the files.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(join(directory, "layout.json")) as f:
+            description = json.load(f)
+        self.layout = TelemetryLayout(description["fields"])
+        self.groups = description["groups"]
+        self.capacity = description["capacity"]
+        count = int(np.load(join(directory, "index.npy"))[0])
+        self.count = min(count, self.capacity)
+        self.arrays = {}
+        self.field_slices = {}
+        for group, names in self.groups.items():
+            array = np.load(join(directory, group + ".npy"), mmap_mode='r')
+            if count <= self.capacity:
+                array = array[:count]
+            else:
+                start = count % self.capacity
+                array = np.concatenate((array[start:], array[:start]))
+            self.arrays[group] = array
+            offset = self.layout.get_slice(names[0]).start
+            for name in names:
+                field_slice = self.layout.get_slice(name)
+                self.field_slices[name] = (group, slice(field_slice.start - offset, field_slice.stop - offset))
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, group):
+        return self.arrays[group]
+
+    def get(self, name):
+        """
+        :returns the values of a field in every frame, size==[N] for single values and [N size] otherwise.
+        """
+        group, field_slice = self.field_slices[name]
+        values = self.arrays[group][:, field_slice]
+        if field_slice.stop - field_slice.start == 1:
+            return values[:, 0]
+        return values
+
+
+class NormalizedErrorStatistics:
+    """
+    Exponentially weighted averages of a stream of errors and their normalized squares (the squared error over the
+    variance the filter claims for it), for a set of channels, over about window frames.
+
+    For a consistent filter the normalized squares have a chi-squared distribution with one degree of freedom, so
+    their average is 1 and, were the frames independent, would be distributed as chi2(n)/n for n frames. Successive
+    frames are correlated, which widens the spread of the average, so the lag one autocorrelation rho of each
+    channel's normalized squares is tracked as well. Taking the stream as AR(1), the variance of the weighted
+    average grows by (1 + lambda*rho)/(1 - lambda*rho), lambda = 1 - alpha, and the confidence interval is the
+    chi-squared interval of that many fewer effective independent frames.
+    """
+
+    def __init__(self, size, window=200, confidence=0.99):
+        self.window = window
+        self.alpha = 2/(window + 1)
+        self.confidence = confidence
+        self.count = 0
+        self.mean_error = np.zeros(size)
+        self.mean_squared_error = np.zeros(size)
+        self.mean = np.ones(size)
+        self.mean_square = np.full(size, 3.0)
+        self.mean_lag_product = np.ones(size)
+        self.last = np.ones(size)
+
+    def add(self, errors, normalized):
+        """
+        :param errors: The errors of some frames, size==[frames channels]
+        :param normalized: Their normalized squares, size==[frames channels]
+        """
+        for error, value in zip(errors, normalized):
+            # Start from a plain average, so the first frames are not dominated by the initial values
+            alpha = max(self.alpha, 1/(self.count + 1))
+            self.mean_error += alpha*(error - self.mean_error)
+            self.mean_squared_error += alpha*(error**2 - self.mean_squared_error)
+            self.mean += alpha*(value - self.mean)
+            self.mean_square += alpha*(value**2 - self.mean_square)
+            if self.count > 0:
+                self.mean_lag_product += max(self.alpha, 1/self.count)*(value*self.last - self.mean_lag_product)
+            self.last = value
+            self.count += 1
+
+    def get_correlation(self):
+        """
+        :returns the lag one autocorrelation of each channel's normalized squares, clipped to [0, .99].
+        """
+        if self.count < 3:
+            return np.zeros(len(self.mean))
+        variance = self.mean_square - self.mean**2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rho = np.where(variance > 0, (self.mean_lag_product - self.mean**2)/variance, 0)
+        return np.clip(np.nan_to_num(rho), 0, .99)
+
+    def get_effective_samples(self):
+        """
+        :returns the number of independent frames the average of each channel is worth.
+        """
+        rho = self.get_correlation()
+        if self.count < self.window:
+            # Still a plain average of count frames
+            return self.count*(1 - rho)/(1 + rho)
+        weight = (1 - self.alpha)*rho
+        return self.window*(1 - weight)/(1 + weight)
+
+    def get_bounds(self):
+        """
+        :returns the lower and upper bound of the confidence interval of each channel's average normalized square.
+        """
+        from scipy.stats import chi2
+        samples = self.get_effective_samples()
+        if self.count == 0:
+            return np.zeros(len(self.mean)), np.full(len(self.mean), np.inf)
+        samples = np.maximum(samples, 1e-3)
+        lower = chi2.ppf((1 - self.confidence)/2, samples)/samples
+        upper = chi2.ppf((1 + self.confidence)/2, samples)/samples
+        return lower, upper
+
+    def get_status(self):
+        """
+        :returns "consistent", "overconfident" (variance too small) or "underconfident" (variance too large)
+        for every channel.
+        """
+        lower, upper = self.get_bounds()
+        status = np.full(len(self.mean), "consistent", dtype=object)
+        status[self.mean > upper] = "overconfident"
+        status[self.mean < lower] = "underconfident"
+        return status
+
+
+class DivergenceMonitor:
+    """
+    Checks the consistency of an estimation telemetry stream, from its normalized innovation squared (NIS) and, given
+    the simulation stream it is estimating, from its normalized estimation error squared (NEES).
+
+    The NIS of every sensor value is its innovation squared over the innovation variance the filter predicted, taken
+    from the "innovations/" and "innovation_variances/" fields of the estimation stream alone, so it also works on a
+    real robot. For the NEES, the simulation is treated as the truth: estimation frames are time-aligned to it by
+    linear interpolation on the frames' "time" field and held back until the simulation has caught up with them.
+    Each state's NEES is its squared error over its estimated variance. Both are averaged and checked by
+    NormalizedErrorStatistics.
+    """
+
+    def __init__(self, window=200, confidence=0.99, history=1000):
+        self.window = window
+        self.confidence = confidence
+        self.history = history
+        self.channels = []
+        self.innovation_channels = []
+        self.simulation_layout_id = None
+        self.estimation_layout_id = None
+        self.simulation_indices = np.zeros(0, dtype=int)
+        self.estimation_indices = np.zeros(0, dtype=int)
+        self.variance_indices = np.zeros(0, dtype=int)
+        self.innovation_indices = np.zeros(0, dtype=int)
+        self.innovation_variance_indices = np.zeros(0, dtype=int)
+        self.reset()
+
+    def reset(self):
+        self.simulation_times = np.zeros(0)
+        self.simulation_values = np.zeros((0, len(self.channels)))
+        self.pending = []
+        self.nees = NormalizedErrorStatistics(len(self.channels), self.window, self.confidence)
+        self.nis = NormalizedErrorStatistics(len(self.innovation_channels), self.window, self.confidence)
+
+    def set_layouts(self, simulation_layout, estimation_layout):
+        """
+        Match the states of both streams by name, and find the innovations of the estimation stream.
+        Called again whenever either layout changes.
+        :param simulation_layout: The layout of the simulation stream, or None to only check the NIS.
+        """
+        simulation_layout_id = None if simulation_layout is None else simulation_layout.layout_id
+        if (simulation_layout_id, estimation_layout.layout_id) == \
+                (self.simulation_layout_id, self.estimation_layout_id):
+            return
+        self.simulation_layout_id = simulation_layout_id
+        self.estimation_layout_id = estimation_layout.layout_id
+        self.channels = []
+        self.innovation_channels = []
+        simulation_indices = []
+        estimation_indices = []
+        variance_indices = []
+        innovation_indices = []
+        innovation_variance_indices = []
+        for name, size in estimation_layout.fields:
+            if name.startswith("innovations/"):
+                variance_name = "innovation_variances/" + name[len("innovations/"):]
+                if variance_name in estimation_layout.slices:
+                    self.innovation_channels.append(name)
+                    innovation_indices.append(estimation_layout.slices[name].start)
+                    innovation_variance_indices.append(estimation_layout.slices[variance_name].start)
+                continue
+            variance_name = "variances/" + name
+            if simulation_layout is None or variance_name not in estimation_layout.slices or \
+                    name not in simulation_layout.slices:
+                continue
+            simulation_slice = simulation_layout.slices[name]
+            if simulation_slice.stop - simulation_slice.start != size:
+                continue
+            self.channels.extend([name] if size == 1 else ["{}/{}".format(name, i) for i in range(size)])
+            simulation_indices.extend(range(simulation_slice.start, simulation_slice.stop))
+            estimation_indices.extend(range(estimation_layout.slices[name].start, estimation_layout.slices[name].stop))
+            variance_indices.extend(range(estimation_layout.slices[variance_name].start,
+                                          estimation_layout.slices[variance_name].stop))
+        self.simulation_indices = np.array(simulation_indices, dtype=int)
+        self.estimation_indices = np.array(estimation_indices, dtype=int)
+        self.variance_indices = np.array(variance_indices, dtype=int)
+        self.innovation_indices = np.array(innovation_indices, dtype=int)
+        self.innovation_variance_indices = np.array(innovation_variance_indices, dtype=int)
+        self.reset()
+
+    def add_simulation(self, frames):
+        if len(frames) == 0 or len(self.channels) == 0:
+            return
+        frames = np.array(frames)
+        self.simulation_times = np.concatenate((self.simulation_times, frames[:, 0]))[-self.history:]
+        self.simulation_values = np.vstack((self.simulation_values, frames[:, self.simulation_indices]))[-self.history:]
+        self._process()
+
+    def add_estimation(self, frames):
+        if len(frames) == 0:
+            return
+        if len(self.innovation_channels) > 0:
+            frames = np.array(frames)
+            innovations = frames[:, self.innovation_indices]
+            variances = np.maximum(frames[:, self.innovation_variance_indices], 1e-12)
+            self.nis.add(innovations, innovations**2/variances)
+        if len(self.channels) > 0:
+            self.pending.extend(np.array(frame) for frame in frames)
+            self._process()
+
+    def _process(self):
+        if len(self.simulation_times) < 2 or len(self.pending) == 0:
+            return
+        pending = np.array(self.pending)
+        times = pending[:, 0]
+        ready = times <= self.simulation_times[-1]
+        # Estimates from before the simulation history can never be aligned
+        usable = ready & (times >= self.simulation_times[0])
+        self.pending = [frame for frame, is_ready in zip(self.pending, ready) if not is_ready]
+        if not usable.any():
+            return
+        pending = pending[usable]
+        times = times[usable]
+        upper = np.clip(np.searchsorted(self.simulation_times, times), 1, len(self.simulation_times) - 1)
+        lower = upper - 1
+        span = self.simulation_times[upper] - self.simulation_times[lower]
+        fraction = np.where(span > 0, (times - self.simulation_times[lower])/np.where(span > 0, span, 1), 0)[:, None]
+        truth = self.simulation_values[lower]*(1 - fraction) + self.simulation_values[upper]*fraction
+
+        errors = pending[:, self.estimation_indices] - truth
+        self.nees.add(errors, errors**2/np.maximum(pending[:, self.variance_indices], 1e-12))
+
+    def get_status(self):
+        """
+        :returns the NormalizedErrorStatistics.get_status() of every state channel, then every innovation channel.
+        """
+        return np.concatenate((self.nees.get_status(), self.nis.get_status()))
+
+    def get_summary(self):
+        """
+        :returns columns of per-channel statistics, ready for a bokeh ColumnDataSource. The normalized column is
+        the average NEES of states and the average NIS of innovations, between lower and upper when consistent.
+        """
+        summary = {
+            "channel": list(self.channels) + list(self.innovation_channels),
+            "statistic": ["NEES"]*len(self.channels) + ["NIS"]*len(self.innovation_channels),
+        }
+        for key, values in [
+            ("mean_error", lambda stats: stats.mean_error),
+            ("rms_error", lambda stats: np.sqrt(stats.mean_squared_error)),
+            ("normalized", lambda stats: stats.mean),
+            ("lower", lambda stats: stats.get_bounds()[0]),
+            ("upper", lambda stats: stats.get_bounds()[1]),
+            ("status", lambda stats: stats.get_status()),
+        ]:
+            summary[key] = np.concatenate((values(self.nees), values(self.nis))).tolist()
+        return summary
@@ -1,8 +1,11 @@
 import math
 import numpy as np
+import scipy.linalg
 import theano
 import warnings
 import sys
+import time
+import inspect
 from theano import tensor as T
 from theano.tensor import slinalg
 from theano.tensor.shared_randomstreams import RandomStreams
@@ -99,6 +102,41 @@ def get_covariance_matrix(covariance_sources):
     return sum(components)
 
 
+class ExpmFrechetGrad(theano.Op):
+    """
+    Gradient of the matrix exponential, from the Frechet derivative of expm at A.T in the direction of the output
+    gradient. slinalg.ExpmGrad goes through an eigendecomposition instead, which gives nans for matrices with
+    repeated eigenvalues, like the state matrix of any load whose positions integrate its velocities.
+    """
+
+    __props__ = ()
+
+    def make_node(self, A, gw):
+        A = T.as_tensor_variable(A)
+        gw = T.as_tensor_variable(gw)
+        return theano.Apply(self, [A, gw], [T.matrix(dtype=A.dtype)])
+
+    def infer_shape(self, node, shapes):
+        return [shapes[0]]
+
+    def perform(self, node, inputs, outputs):
+        A, gw = inputs
+        outputs[0][0] = scipy.linalg.expm_frechet(A.T, gw, compute_expm=False).astype(A.dtype)
+
+
+class Expm(slinalg.Expm):
+    """
+    slinalg.Expm with a gradient that stays finite, see ExpmFrechetGrad.
+    """
+
+    def grad(self, inputs, outputs_gradients):
+        (A,) = inputs
+        (gw,) = outputs_gradients
+        return [ExpmFrechetGrad()(A, gw)]
+
+expm = Expm()
+
+
 def sample_covariance_theano(mean, covariance):
     # http://scicomp.stackexchange.com/q/22111/19265
     srng = RandomStreams(seed=481)
@@ -123,28 +161,58 @@ def replace_nans(tensor, value=0):
 
 
 class DebugTensorLogger:
+    """
+    Watches tensors of a compiled function for nans and huge values.
 
-    def __init__(self, verbosity_level=0):
+    Tensors up to verbosity_level are copied out every call, along with their values from the call before,
+    so both can be printed when something goes wrong. Tensors up to check_verbosity are also reduced inside
+    the function to a single flag, so do_checkup only has to read one scalar per tick and reads the copies
+    once the flag is set. With a check_interval above one, do_checkup only looks every Nth call.
+    """
+
+    def __init__(self, verbosity_level=0, check_verbosity=None, check_interval=1, max_magnitude=10**10):
         self.verbosity_level = verbosity_level
+        self.check_verbosity = verbosity_level if check_verbosity is None else check_verbosity
+        self.check_interval = max(1, check_interval)
+        self.max_magnitude = max_magnitude
         self.tensors = []
         self.updates = []
-        self.last_values = []
+        self.checks = []
+        self.checkup_count = 0
+        self.flag = theano.shared(np.int8(0), name="debug flag")
 
     def add_tensor(self, tensor, name=None, verbosity=1):
+        if verbosity <= self.check_verbosity:
+            invalid = T.any(T.isnan(tensor))
+            if self.max_magnitude > 0:
+                invalid = T.or_(invalid, T.any(abs(tensor) > self.max_magnitude))
+            self.checks.append(invalid)
         if verbosity > self.verbosity_level:
             return
         default_val = 0
         while np.ndim(default_val) < tensor.ndim:
             default_val = np.array([default_val], dtype=tensor.dtype)
         shared_var = theano.shared(default_val, name=name, strict=False)
-        self.tensors.append((shared_var, name))
+        last_var = theano.shared(default_val, name=name, strict=False)
+        self.tensors.append((shared_var, last_var, name))
+        # Updates read the shared values from before the call, so last_var gets the previous value of shared_var
+        self.updates.append((last_var, shared_var))
         self.updates.append((shared_var, T.unbroadcast(tensor, *range(tensor.ndim))))
 
     def get_updates(self):
-        return self.updates
+        if len(self.checks) == 0:
+            return self.updates
+        return self.updates + [(self.flag, T.cast(T.any(T.stack(self.checks)), 'int8'))]
 
-    def do_checkup(self, check_nans=True, max_magnitude=10**10, raise_exception=True):
-        current_values = [(shared_var.get_value(), name) for shared_var, name in self.tensors]
+    def do_checkup(self, check_nans=True, max_magnitude=None, raise_exception=True):
+        self.checkup_count += 1
+        if self.checkup_count % self.check_interval != 0:
+            return
+        if max_magnitude is None:
+            max_magnitude = self.max_magnitude
+        if len(self.checks) > 0 and not self.flag.get_value():
+            return
+        current_values = [(shared_var.get_value(), name) for shared_var, _, name in self.tensors]
         for value, name in current_values:
             if check_nans and (np.isnan(value)).any():
                 print("Warning: Nan encountered in debug tensor '{}'.".format(name))
@@ -153,13 +221,167 @@ class DebugTensorLogger:
                 print("Warning: Too big of a value encountered in debug tensor '{}'.".format(name))
                 break
         else:
-            self.last_values = current_values
+            if len(self.checks) == 0:
+                return
+            # The flag was raised by a tensor that is checked but not copied out
+            print("Warning: Invalid value encountered in a debug tensor, raise DEBUG_VERBOSITY to see which one.")
+            if raise_exception:
+                raise ValueError("Invalid value encountered in a debug tensor.")
             return
         np.set_printoptions(precision=2, suppress=True)
         bad_name = name
         for value, name in current_values:
             print("Current value of {}: \n {}".format(name, value))
-        for value, name in self.last_values:
-            print("Last value of {}: \n {}".format(name, value))
+        for _, last_var, name in self.tensors:
+            print("Last value of {}: \n {}".format(name, last_var.get_value()))
         if raise_exception:
             raise ValueError("Invalid value encountered in debug tensor '{}'.".format(bad_name))
+
+
+class TickProfiler:
+    """
+    Times the phases of an update tick into log-spaced histograms.
+
+    Call start() at the beginning of a tick and mark(phase) at the end of each phase. Recording a
+    phase costs a timer read and a few arithmetic operations, so it can stay on in competition.
+    """
+
+    def __init__(self, min_time=1e-6, max_time=1.0, bins_per_decade=10):
+        self.log_min_time = math.log10(min_time)
+        self.bins_per_decade = bins_per_decade
+        self.bin_count = int(round((math.log10(max_time) - self.log_min_time)*bins_per_decade)) + 1
+        # Upper edge of each bin in seconds, the last bin also holds everything slower than max_time
+        self.bin_edges = 10**(self.log_min_time + (np.arange(self.bin_count) + 1)/bins_per_decade)
+        self.histograms = {}
+        self.totals = {}
+        self.maximums = {}
+        self.last_times = {}
+        self.last_mark = 0
+
+    def start(self):
+        self.last_mark = time.perf_counter()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        elapsed = now - self.last_mark
+        self.last_mark = now
+        if phase not in self.histograms:
+            self.histograms[phase] = np.zeros(self.bin_count, dtype=np.int64)
+            self.totals[phase] = 0.0
+            self.maximums[phase] = 0.0
+        if elapsed > 0:
+            index = int((math.log10(elapsed) - self.log_min_time)*self.bins_per_decade)
+            index = min(max(index, 0), self.bin_count - 1)
+        else:
+            index = 0
+        self.histograms[phase][index] += 1
+        self.totals[phase] += elapsed
+        if elapsed > self.maximums[phase]:
+            self.maximums[phase] = elapsed
+        self.last_times[phase] = elapsed
+
+    def get_state(self):
+        """
+        :returns the duration in seconds of each phase during the last tick.
+        """
+        return dict(self.last_times)
+
+    def get_summary(self):
+        """
+        :returns a dictionary of statistics for each phase: count, mean, max, and p50, p90 and p99 as
+        histogram bin upper edges, all in seconds.
+        """
+        summary = {}
+        for phase, histogram in self.histograms.items():
+            count = int(histogram.sum())
+            cumulative = np.cumsum(histogram)
+            stats = {
+                "count": count,
+                "mean": self.totals[phase]/count,
+                "max": self.maximums[phase],
+            }
+            for percentile in [50, 90, 99]:
+                index = int(np.searchsorted(cumulative, count*percentile/100))
+                stats["p{}".format(percentile)] = float(self.bin_edges[min(index, self.bin_count - 1)])
+            summary[phase] = stats
+        return summary
+
+    def reset(self):
+        self.histograms = {}
+        self.totals = {}
+        self.maximums = {}
+        self.last_times = {}
+
+
+def get_method_line_ranges(classes):
+    """
+    :returns a list of (filename, first line, last line, class name) for every method defined by the given classes.
+    """
+    ranges = []
+    for cls in classes:
+        for attribute in cls.__dict__.values():
+            if not inspect.isfunction(attribute):
+                continue
+            try:
+                lines, first_line = inspect.getsourcelines(attribute)
+                filename = inspect.getsourcefile(attribute)
+            except (OSError, TypeError):
+                continue
+            ranges.append((filename, first_line, first_line + len(lines) - 1, cls.__name__))
+    return ranges
+
+
+def find_node_component(node, method_ranges, default="engine"):
+    """
+    Find the component whose methods created a compiled graph node, from the user stack trace theano
+    keeps in the tag of each output. The innermost component frame wins.
+    """
+    for output in node.outputs:
+        traces = getattr(output.tag, "trace", None) or []
+        for trace in traces:
+            for frame in reversed(trace):
+                filename, line_number = frame[0], frame[1]
+                for range_file, first_line, last_line, name in method_ranges:
+                    if first_line <= line_number <= last_line and filename == range_file:
+                        return name
+    return default
+
+
+def summarize_function_profiles(functions, component_classes, top=20):
+    """
+    Aggregate the op-level profiles of theano functions compiled with profile=True.
+
+    :param functions: A dictionary of names to compiled theano functions.
+    :param component_classes: The classes to attribute graph nodes to.
+    :param top: How many of the slowest nodes to list.
+
+    :returns a dictionary with, for each function, the call count and total time, the time per op type,
+    the time per component, and the slowest nodes with their component. Times are in seconds per call.
+    """
+    method_ranges = get_method_line_ranges(component_classes)
+    report = {}
+    for name, function in functions.items():
+        profile = getattr(function, "profile", None)
+        if function is None or not profile:
+            continue
+        calls = max(profile.fct_callcount, 1)
+        op_times = {}
+        component_times = {}
+        nodes = []
+        for key, apply_time in profile.apply_time.items():
+            # Newer theano keys apply_time by (fgraph, node)
+            node = key[1] if isinstance(key, tuple) else key
+            component = find_node_component(node, method_ranges)
+            op_name = type(node.op).__name__
+            op_times[op_name] = op_times.get(op_name, 0) + apply_time/calls
+            component_times[component] = component_times.get(component, 0) + apply_time/calls
+            nodes.append((apply_time/calls, str(node), component))
+        nodes.sort(reverse=True)
+        report[name] = {
+            "calls": profile.fct_callcount,
+            "time_per_call": profile.fct_call_time/calls,
+            "ops": dict(sorted(op_times.items(), key=lambda item: -item[1])),
+            "components": dict(sorted(component_times.items(), key=lambda item: -item[1])),
+            "nodes": [{"time": t, "node": node, "component": component} for t, node, component in nodes[:top]],
+        }
+    return report
@@ -0,0 +1,2 @@
+# Autogenerated by setup.py
+__version__ = 'master'
\ No newline at end of file
@@ -0,0 +1,55 @@
+import numpy as np
+from int_dynamics.scipy_ilqg.augmented_lagrangian import ilqg_constrained, box_obstacle_constraint
+
+OBSTACLE = ([-.3, 1.5], [.7, 2.5])
+
+
+def point_mass_problem(horizon=40):
+    # x = [x y], u = [vx vy], driving from the origin to (0, 4) with a box in the way
+    dt = .1
+    goal = np.array([0, 4])
+
+    def dynamics(x, u):
+        return x + dt*u
+
+    def cost(x, u):
+        final = np.isnan(u[:, 0])
+        u = np.where(np.isnan(u), 0, u)
+        return .01*np.sum(u*u, axis=1) + final*10*np.sum((x - goal)**2, axis=1)
+
+    options = {
+        "vectorized": True,
+        "lims": np.array([[-2, 2], [-2, 2]]),
+        "maxIter": 50,
+        "tolConstraint": 1e-2,
+    }
+    return dynamics, cost, np.zeros(2), np.zeros((horizon, 2)), options
+
+
+def test_box_obstacle_constraint():
+    constraint = box_obstacle_constraint([OBSTACLE], margin=.1)
+    g = constraint(np.array([[0, 2], [0, 1], [2, 2]]))
+    np.testing.assert_allclose(g[:, 0], [.4, -.4, -1.2])
+
+
+def test_ilqg_constrained_avoids_obstacle():
+    dynamics, cost, x0, u0, options = point_mass_problem()
+    constraint = box_obstacle_constraint([OBSTACLE], margin=.1)
+    x, u, L, Vx, Vxx, costs, trace = ilqg_constrained(dynamics, cost, constraint, x0, u0, options)
+    assert x.shape == (41, 2)
+    assert Vx.shape == (41, 2)
+    assert np.maximum(constraint(x), 0).max() < options["tolConstraint"]
+    assert np.linalg.norm(x[-1] - [0, 4]) < .5
+
+
+def test_ilqg_constrained_out_of_time():
+    # The budget runs out before ilqg() finishes a backward pass, so it returns no Vx or Vxx
+    dynamics, cost, x0, u0, options = point_mass_problem()
+    options["maxTime"] = 0
+    constraint = box_obstacle_constraint([OBSTACLE], margin=.1)
+    x, u, L, Vx, Vxx, costs, trace = ilqg_constrained(dynamics, cost, constraint, x0, u0, options)
+    assert Vx is None and Vxx is None
+    assert x.shape == (41, 2)
+    assert L.shape == (40, 2, 2)
+    assert costs.shape == (41,)
+    assert trace.shape == (0, 11)
@@ -0,0 +1,232 @@
+import numpy as np
+from scipy.linalg import cholesky, expm
+from int_dynamics.scipy_ilqg import boxQP as boxQP_module
+from int_dynamics.scipy_ilqg.boxQP import boxQP, boxQP_batch, cho_solve_batch, choldelete, cholinsert
+from int_dynamics.scipy_ilqg.ilqg import ilqg, back_pass_batch, forward_pass_batch
+from int_dynamics.scipy_ilqg import multistart
+from int_dynamics.scipy_ilqg.multistart import ilqg_lockstep, ilqg_multistart
+
+
+def random_problems(B, n, random):
+    A = random.randn(B, n, n)
+    H = np.matmul(A, A.transpose(0, 2, 1)) + .1*np.eye(n)
+    g = 3*random.randn(B, n)
+    lower = -np.abs(random.randn(B, n))
+    upper = np.abs(random.randn(B, n))
+    return H, g, lower, upper
+
+
+def test_cholesky_updates():
+    random = np.random.RandomState(4)
+    H = random_problems(1, 6, random)[0][0]
+    keep = np.array([True, False, True, True, False, True])
+    R = cholesky(H[keep][:, keep])
+    # drop the second kept dimension, then border the fifth dimension in
+    R = choldelete(R, 1)
+    keep[2] = False
+    np.testing.assert_allclose(R, cholesky(H[keep][:, keep]), atol=1e-12)
+    keep[4] = True
+    R = cholinsert(R, 2, H[4, keep])
+    np.testing.assert_allclose(R, cholesky(H[keep][:, keep]), atol=1e-12)
+
+
+def test_boxQP_updates_the_factor_when_the_clamped_set_changes(monkeypatch):
+    random = np.random.RandomState(5)
+    factorizations = []
+
+    def counting_cholesky(*args, **kwargs):
+        factorizations.append(args[0].shape)
+        return cholesky(*args, **kwargs)
+    monkeypatch.setattr(boxQP_module, "cholesky", counting_cholesky)
+
+    H, g, lower, upper = random_problems(30, 5, random)
+    for b in range(30):
+        del factorizations[:]
+        x, result, Hfree, free = boxQP(H[b], g[b], lower[b], upper[b], np.zeros(5))
+        if free.any():
+            np.testing.assert_allclose(Hfree, cholesky(H[b][free][:, free]), atol=1e-10)
+        # factorized once, every change of the clamped set after that was an update
+        assert len(factorizations) <= 1
+
+
+def test_cho_solve_batch():
+    random = np.random.RandomState(6)
+    H = random_problems(10, 4, random)[0]
+    R = np.array([cholesky(h) for h in H])
+    b = random.randn(10, 4, 3)
+    np.testing.assert_allclose(cho_solve_batch(R, b), np.linalg.solve(H, b), atol=1e-10)
+    np.testing.assert_allclose(cho_solve_batch(R, b[:, :, 0]), np.linalg.solve(H, b[:, :, :1])[:, :, 0], atol=1e-10)
+
+
+def test_boxQP_batch_matches_serial():
+    random = np.random.RandomState(0)
+    for n in [1, 2, 5]:
+        H, g, lower, upper = random_problems(50, n, random)
+        x0 = np.zeros((50, n))
+        x, result, Hfree, free = boxQP_batch(H, g, lower, upper, x0)
+        for b in range(50):
+            x_serial, _, _, free_serial = boxQP(H[b], g[b], lower[b], upper[b], x0[b])
+            np.testing.assert_allclose(x[b], x_serial, atol=1e-9)
+            np.testing.assert_array_equal(free[b], free_serial)
+        assert ((x >= lower) & (x <= upper)).all()
+        assert (result > 0).all()
+
+
+def test_boxQP_batch_warm_start_and_unbounded():
+    random = np.random.RandomState(1)
+    H, g, lower, upper = random_problems(20, 3, random)
+    x0 = random.randn(20, 3)
+    x, result, _, _ = boxQP_batch(H, g, lower, upper, x0)
+    for b in range(20):
+        np.testing.assert_allclose(x[b], boxQP(H[b], g[b], lower[b], upper[b], x0[b])[0], atol=1e-9)
+
+    # without bounds the solution is the Newton point
+    x, result, _, free = boxQP_batch(H, g, np.full(3, -np.inf), np.full(3, np.inf))
+    np.testing.assert_allclose(x, -np.linalg.solve(H, g[:, :, None])[:, :, 0], atol=1e-9)
+    assert free.all()
+
+
+def test_boxQP_batch_flags_indefinite_hessian():
+    H = np.array([np.eye(2), -np.eye(2)])
+    g = np.ones((2, 2))
+    x, result, _, _ = boxQP_batch(H, g, np.full(2, -1.0), np.full(2, 1.0), x0=np.zeros((2, 2)))
+    assert result[0] > 0
+    assert result[1] == -1
+    np.testing.assert_allclose(x[0], [-1, -1])
+
+
+def linear_problem(random, horizon=40):
+    h, n, m = .01, 3, 2
+    A = random.randn(n, n)
+    A = expm(h*(A - A.T))
+    B = h*random.randn(m, n)
+    Q = h*np.eye(n)
+    R = .1*h*np.eye(m)
+
+    def dynamics(x, u):
+        return np.dot(x, A) + np.dot(u, B)
+
+    def cost(x, u):
+        u = np.where(np.isnan(u), 0, u)
+        return 0.5*np.sum(x*np.dot(x, Q), axis=1) + 0.5*np.sum(u*np.dot(u, R), axis=1)
+
+    def dynamics_derivatives(x, u):
+        K = x.shape[0]
+        return np.tile(A, [K, 1, 1]), np.tile(B, [K, 1, 1]), None, None, None
+
+    def cost_derivatives(x, u):
+        K = x.shape[0]
+        u = np.where(np.isnan(u), 0, u)
+        return np.dot(x, Q), np.dot(u, R), np.tile(Q, [K, 1, 1]), np.zeros((K, n, m)), np.tile(R, [K, 1, 1])
+
+    options = {
+        "lims": np.array([[-.6, .6], [-.6, .6]]),
+        "vectorized": True,
+        "maxIter": 30,
+        "dynamics_derivatives": dynamics_derivatives,
+        "cost_derivatives": cost_derivatives,
+    }
+    return dynamics, cost, random.randn(n), options
+
+
+def test_lockstep_matches_ilqg():
+    random = np.random.RandomState(2)
+    dynamics, cost, x0, options = linear_problem(random)
+    u0s = .3*random.randn(3, 40, 2)
+    results = ilqg_lockstep(dynamics, cost, x0, u0s, options)
+    for u0, lockstep in zip(u0s, results):
+        serial = ilqg(dynamics, cost, x0, u0, options)
+        np.testing.assert_allclose(lockstep[1], serial[1], atol=1e-9)
+        np.testing.assert_allclose(lockstep[5], serial[5], atol=1e-12)
+        np.testing.assert_allclose(lockstep[2], serial[2], atol=1e-9)
+        assert lockstep[6].shape == serial[6].shape
+        assert (np.abs(lockstep[1]) <= .6).all()
+
+
+def test_multistart_lockstep_returns_best():
+    random = np.random.RandomState(3)
+    dynamics, cost, x0, options = linear_problem(random)
+    u0s = .3*random.randn(3, 40, 2)
+    best = ilqg_multistart(dynamics, cost, x0, u0s, options, lockstep=True)
+    totals = [result[5].sum() for result in ilqg_lockstep(dynamics, cost, x0, u0s, options)]
+    assert best[5].sum() == min(totals)
+
+
+def test_multistart_chains_the_user_callback():
+    random = np.random.RandomState(7)
+    dynamics, cost, x0, options = linear_problem(random)
+    u0s = .3*random.randn(2, 40, 2)
+    for lockstep in [False, True]:
+        calls = []
+
+        def callback(alg_iter, x, u, c):
+            calls.append(alg_iter)
+            return alg_iter >= 2
+        options["callback"] = callback
+        best = ilqg_multistart(dynamics, cost, x0, u0s, options, processes=1, lockstep=lockstep)
+        # every start was stopped by the callback after its third accepted iteration
+        assert len(calls) > 0
+        assert len(best[6]) <= 3
+
+
+class FakeClock:
+    """
+    Stands in for the time module in multistart, advanced by hand.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+
+def test_lockstep_checks_the_budget_between_backward_passes(monkeypatch):
+    random = np.random.RandomState(8)
+    dynamics, cost, x0, options = linear_problem(random)
+    clock = FakeClock()
+    calls = []
+
+    def diverging_back_pass_batch(*args):
+        u = args[-1]
+        calls.append(u)
+        clock.now += 10
+        B, N, m = u.shape
+        n = x0.shape[0]
+        return np.ones(B, dtype=bool), np.zeros((B, N+1, n)), np.zeros((B, N+1, n, n)), np.zeros((B, N, m)), \
+            np.ones((B, N, m, n)), np.zeros((B, 2))
+    monkeypatch.setattr(multistart, "time", clock)
+    monkeypatch.setattr(multistart, "back_pass_batch", diverging_back_pass_batch)
+    options["maxTime"] = 15
+    results = ilqg_lockstep(dynamics, cost, x0, .3*random.randn(2, 40, 2), options)
+    # two passes use up the budget, then one final pass, instead of raising lambda up to lambdaMax
+    assert len(calls) == 3
+    for result in results:
+        np.testing.assert_array_equal(result[2], 0)
+
+
+def test_lockstep_gains_match_the_returned_trajectory(monkeypatch):
+    random = np.random.RandomState(9)
+    dynamics, cost, x0, options = linear_problem(random)
+    clock = FakeClock()
+    passes = []
+
+    def recording_back_pass_batch(*args):
+        outputs = back_pass_batch(*args)
+        passes.append((args[-1].copy(), outputs[4].copy()))
+        return outputs
+
+    def slow_forward_pass_batch(*args):
+        clock.now += 10
+        return forward_pass_batch(*args)
+    monkeypatch.setattr(multistart, "time", clock)
+    monkeypatch.setattr(multistart, "back_pass_batch", recording_back_pass_batch)
+    monkeypatch.setattr(multistart, "forward_pass_batch", slow_forward_pass_batch)
+    options["maxTime"] = 15
+    results = ilqg_lockstep(dynamics, cost, x0, .3*random.randn(2, 40, 2), options)
+    # the budget ran out right after the second line-search was accepted
+    assert all(np.isfinite(result[6][-1, 2]) for result in results)
+    u, L = passes[-1]
+    for j, result in enumerate(results):
+        np.testing.assert_array_equal(u[j], result[1])
+        np.testing.assert_array_equal(L[j], result[2])
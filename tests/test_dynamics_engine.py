@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+
+theano = pytest.importorskip("theano")
+from int_dynamics import dynamics, telemetry
+
+
+class LiftDynamics(dynamics.DynamicsEngine):
+    SINK_IN_SIMULATION = False
+    SINK_TO_SIMPLESTREAMER = False
+    SINK_TO_NT = False
+    SINK_TO_TELEMETRY = False
+
+    def build_loads(self):
+        motor = dynamics.CIMMotor()
+        self.gearbox = dynamics.GearBox([motor], 20, 0)
+        wheel = dynamics.SimpleWheels(self.gearbox, 3)
+        self.loads["lift"] = dynamics.OneDimensionalLoad([wheel], 30)
+        self.controllers["lift"] = dynamics.SpeedController(motor)
+        self.sensors["encoder"] = dynamics.Encoder(self.gearbox)
+
+
+def test_simulation_flushes_sensor_predictions():
+    engine = LiftDynamics("simulation")
+    encoder = engine.sensors["encoder"]
+    assert set(engine.sensor_value_list) == {encoder.position, encoder.velocity}
+    engine.controllers["lift"].set_percent_vbus(1)
+    for _ in range(10):
+        engine.simulation_update(.05, resolve_error=False)
+    # The encoder reads the gearbox the lift is driving
+    assert encoder.position.get_value() > 0
+    assert encoder.velocity.get_value() > 0
+
+
+def test_estimation_is_corrected_by_sensors():
+    engine = LiftDynamics("estimation")
+    encoder = engine.sensors["encoder"]
+    assert set(engine.sensor_value_list) == {encoder.position, encoder.velocity}
+    initial_state = engine.get_state_vector().copy()
+    # The filter only moves the states it is uncertain about
+    engine.state_covariance.set_value(np.eye(len(initial_state)))
+    # With no power the prediction alone keeps the lift still, so any movement comes from the encoder
+    encoder.position.set_value(5.0)
+    for _ in range(10):
+        engine.estimation_update(.05, use_devices=False)
+    assert not np.allclose(engine.get_state_vector(), initial_state)
+
+
+
+def test_estimation_is_a_kalman_update():
+    engine = LiftDynamics("estimation")
+    encoder = engine.sensors["encoder"]
+    position = engine.get_state_slice(engine.gearbox.position)
+    state_count = len(engine.get_state_vector())
+    engine.state_covariance.set_value(np.eye(state_count))
+    encoder.position.set_value(5.0)
+    engine.estimation_update(.05, use_devices=False)
+
+    assert engine.state_mean.get_value().shape == (state_count, 1)
+    covariance = engine.state_covariance.get_value()
+    assert covariance.shape == (state_count, state_count)
+    assert np.all(np.isfinite(covariance))
+    np.testing.assert_allclose(covariance, covariance.T, atol=1e-9)
+    # The estimate lands between the prediction, which stayed still, and the measurement, and is more certain
+    # than either
+    estimate = engine.get_state_vector()[position]
+    assert 0 < estimate < 5
+    assert covariance[position, position] < encoder.variance
+
+
+def run_filter(engine, noise_scale, ticks=600):
+    """
+    Estimate a lift at rest whose gearbox position is drawn from the filter's prior, from encoder readings with
+    noise_scale times the noise the filter expects.
+    :returns the telemetry frame after every tick
+    """
+    random = np.random.RandomState(0)
+    encoder = engine.sensors["encoder"]
+    position = engine.get_state_slice(engine.gearbox.position)
+    state_count = len(engine.get_state_vector())
+    engine.state_mean.set_value(np.zeros((state_count, 1)))
+    covariance = np.zeros((state_count, state_count))
+    covariance[position, position] = 1
+    engine.state_covariance.set_value(covariance)
+    true_position = random.randn()
+    deviation = noise_scale*np.sqrt(encoder.variance)
+    frames = []
+    for _ in range(ticks):
+        encoder.position.set_value(true_position + deviation*random.randn())
+        encoder.velocity.set_value(deviation*random.randn())
+        engine.estimation_update(.05, use_devices=False)
+        frames.append(engine.get_telemetry_frame().copy())
+    return frames
+
+
+def test_innovations_are_consistent():
+    engine = LiftDynamics("estimation")
+    layout = engine.get_telemetry_layout()
+    for name in ["sensors/encoder/position", "sensors/encoder/velocity"]:
+        assert "innovations/" + name in layout.slices
+        assert "innovation_variances/" + name in layout.slices
+
+    monitor = telemetry.DivergenceMonitor()
+    monitor.set_layouts(None, layout)
+    monitor.add_estimation(run_filter(engine, 1))
+    assert list(monitor.get_status()) == ["consistent"]*2
+
+    # A filter that underestimates its sensor noise is caught
+    monitor.reset()
+    monitor.add_estimation(run_filter(engine, 3))
+    assert list(monitor.get_status()) == ["overconfident"]*2
@@ -0,0 +1,57 @@
+import pytest
+
+theano = pytest.importorskip("theano")
+from int_dynamics import dynamics
+from int_dynamics.dynamics.headless import make_hal_data
+
+
+class HalLiftDynamics(dynamics.DynamicsEngine):
+    SINK_IN_SIMULATION = False
+    SINK_TO_SIMPLESTREAMER = False
+    SINK_TO_NT = False
+    SINK_TO_TELEMETRY = False
+
+    def build_loads(self):
+        lift_motor = dynamics.CIMMotor()
+        lift_gearbox = dynamics.GearBox([lift_motor], 20, 0)
+        self.loads["lift"] = dynamics.OneDimensionalLoad([dynamics.SimpleWheels(lift_gearbox, 3)], 30)
+        self.controllers["lift"] = dynamics.PWMSpeedController(lift_motor, 0)
+        self.sensors["lift_encoder"] = dynamics.Encoder(lift_gearbox, 0, 1)
+
+        arm_motor = dynamics.CIMMotor()
+        arm_gearbox = dynamics.GearBox([arm_motor], 20, 0)
+        self.loads["arm"] = dynamics.OneDimensionalLoad([dynamics.SimpleWheels(arm_gearbox, 3)], 30)
+        self.controllers["arm"] = dynamics.CANTalonSpeedController(arm_motor, 1)
+        self.sensors["arm_encoder"] = dynamics.CANTalonEncoder(arm_gearbox)
+        self.controllers["arm"].add_encoder(self.sensors["arm_encoder"])
+
+
+def reset_hal_data(hal_data, engine):
+    """
+    Like pyfrc's reset_hal_data(), refill the same dictionary with new entries.
+    """
+    fresh = make_hal_data(engine)
+    hal_data.clear()
+    hal_data.update(fresh)
+
+
+def test_entries_are_bound_again_after_a_reset():
+    engine = HalLiftDynamics("simulation")
+    hal_data = make_hal_data(engine)
+    engine.controllers["lift"].set_hal_percent_vbus(hal_data, 1)
+    engine.controllers["arm"].set_hal_percent_vbus(hal_data, 1)
+    for _ in range(5):
+        engine.simulation_update(.05, hal_data, resolve_error=False)
+    assert hal_data['encoder'][0]['count'] > 0
+    assert hal_data['CAN'][1]['sensor_position'] > 0
+
+    reset_hal_data(hal_data, engine)
+    # Robot code now commands through the new entries, the old ones would still say full power
+    engine.controllers["lift"].set_hal_percent_vbus(hal_data, -.5)
+    engine.controllers["arm"].set_hal_percent_vbus(hal_data, -.5)
+    engine.simulation_update(.05, hal_data, resolve_error=False)
+    assert engine.controllers["lift"].percent_vbus.get_value() == pytest.approx(-.5)
+    assert engine.controllers["arm"].percent_vbus.get_value() == pytest.approx(-.5)
+    # And the sensors write to the new entries
+    assert hal_data['encoder'][0]['count'] > 0
+    assert hal_data['CAN'][1]['sensor_position'] > 0
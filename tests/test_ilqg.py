@@ -0,0 +1,54 @@
+import time
+import numpy as np
+from int_dynamics.scipy_ilqg.ilqg import ilqg
+
+
+def slow_problem(step_time):
+    n, m = 2, 1
+
+    def dynamics(x, u):
+        time.sleep(step_time)
+        return x + .1*np.hstack((x[:, 1:], u))
+
+    def cost(x, u):
+        u = np.where(np.isnan(u), 0, u)
+        return np.sum(x*x, axis=1) + .1*np.sum(u*u, axis=1)
+
+    def dynamics_derivatives(x, u):
+        K = x.shape[0]
+        A = np.array([[1, 0], [.1, 1]])
+        B = np.array([[0, .1]])
+        return np.tile(A, [K, 1, 1]), np.tile(B, [K, 1, 1]), None, None, None
+
+    def cost_derivatives(x, u):
+        K = x.shape[0]
+        u = np.where(np.isnan(u), 0, u)
+        return 2*x, .2*u, np.tile(2*np.eye(n), [K, 1, 1]), np.zeros((K, n, m)), np.tile(.2*np.eye(m), [K, 1, 1])
+
+    options = {
+        "vectorized": True,
+        "dynamics_derivatives": dynamics_derivatives,
+        "cost_derivatives": cost_derivatives,
+    }
+    return dynamics, cost, np.array([1.0, 0.0]), np.zeros((10, m)), options
+
+
+def test_max_time_is_checked_within_the_line_search():
+    # Every line-search step is rejected, so one iteration runs all 8 forward passes (~0.4s)
+    step_time = .005
+    dynamics, cost, x0, u0, options = slow_problem(step_time)
+    options.update({"parallel": False, "zMin": np.inf, "maxTime": .6})
+    start_time = time.time()
+    x, u, L, Vx, Vxx, costs, trace = ilqg(dynamics, cost, x0, u0, options)
+    elapsed = time.time() - start_time
+    assert elapsed < options["maxTime"] + 3*10*step_time
+    assert np.isfinite(costs).all()
+
+
+def test_max_time_returns_best_trajectory():
+    dynamics, cost, x0, u0, options = slow_problem(0)
+    x, u, L, Vx, Vxx, costs, trace = ilqg(dynamics, cost, x0, u0, options)
+    options["maxTime"] = 0
+    x_timed, u_timed, L, Vx, Vxx, costs_timed, trace = ilqg(dynamics, cost, x0, u0, options)
+    assert trace.shape[0] == 0
+    assert costs_timed.sum() >= costs.sum()
@@ -0,0 +1,86 @@
+import math
+import numpy as np
+import pytest
+
+theano = pytest.importorskip("theano")
+from int_dynamics import dynamics
+
+DT = .1
+
+
+class DrivetrainOptimization(dynamics.DynamicsEngine):
+    SINK_IN_SIMULATION = False
+    SINK_TO_SIMPLESTREAMER = False
+    SINK_TO_NT = False
+    SINK_TO_TELEMETRY = False
+
+    def build_loads(self):
+        self.loads["drivetrain"] = dynamics.TwoDimensionalLoad(120)
+        for name, x_origin, r_origin in [("left", -.5, 0), ("right", .5, math.pi)]:
+            motor = dynamics.CIMMotor()
+            gearbox = dynamics.GearBox([motor], 10, 1)
+            self.loads["drivetrain"].add_wheel(dynamics.SimpleWheels(gearbox, 6), x_origin=x_origin, r_origin=r_origin)
+            self.controllers[name] = dynamics.PWMSpeedController(motor, len(self.controllers))
+
+        drivetrain = self.loads["drivetrain"]
+        self.costs["effort"] = dynamics.ControlEffortCost(list(self.controllers.values()), .4)
+        self.costs["goal"] = dynamics.TerminalPositionalCost(drivetrain, [0, 10, 0], [3, 3, 0])
+        self.costs["speed"] = dynamics.StateLimitCost(drivetrain.velocity, -1, 1, 10)
+
+
+@pytest.fixture(scope="module")
+def engine():
+    return DrivetrainOptimization("optimization")
+
+
+def trajectory(engine, steps=10):
+    """
+    States along a feasible trajectory, and the controls that drove it.
+    """
+    random = np.random.RandomState(0)
+    u = .5 + .5*random.rand(steps, 2)
+    x = [engine.get_state_vector()]
+    for control in u[:-1]:
+        x.append(engine.discrete_dynamics(x[-1][None], control[None], DT)[0])
+    return np.array(x), u
+
+
+def central_difference(fun, x, h=1e-6):
+    """
+    :returns the derivative of fun with respect to each column of x, size==[K x_columns outputs]
+    """
+    columns = []
+    for i in range(x.shape[1]):
+        step = np.zeros(x.shape[1])
+        step[i] = h
+        columns.append((fun(x + step) - fun(x - step))/(2*h))
+    return np.stack(columns, axis=1)
+
+
+def test_dynamics_derivatives_match_finite_differences(engine):
+    x, u = trajectory(engine)
+    fx, fu = engine.discrete_dynamics_derivatives(x, u, DT)
+    assert np.all(np.isfinite(fx))
+    assert np.all(np.isfinite(fu))
+    np.testing.assert_allclose(fx, central_difference(lambda x: engine.discrete_dynamics(x, u, DT), x), atol=1e-6)
+    np.testing.assert_allclose(fu, central_difference(lambda u: engine.discrete_dynamics(x, u, DT), u), atol=1e-6)
+
+
+def test_cost_derivatives_match_finite_differences(engine):
+    x, u = trajectory(engine)
+    # The last row is the end of the trajectory, charged the final cost
+    u[-1] = np.nan
+    speed = engine.get_state_slice(engine.loads["drivetrain"].velocity)
+    # Some states are over the speed limit
+    assert np.any(np.abs(x[:, speed]) > 1)
+    cx, cu, cxx, cxu, cuu = engine.cost_derivatives(x, u)
+    np.testing.assert_allclose(cx, central_difference(lambda x: engine.cost(x, u), x), atol=1e-5)
+    running = slice(0, -1)
+    np.testing.assert_allclose(cu[running], central_difference(lambda u: engine.cost(x[running], u), u[running]),
+                               atol=1e-5)
+
+    def gradient(x):
+        return engine.cost_derivatives(x, u)[0]
+    np.testing.assert_allclose(cxx, central_difference(gradient, x), atol=1e-4)
+    np.testing.assert_allclose(cuu[running], 2*.4*np.eye(2)[None].repeat(len(u) - 1, axis=0))
+    np.testing.assert_allclose(cxu, 0)
@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("theano")
+from int_dynamics.dynamics.components.controllers import TalonBank
+
+DT = .02
+
+
+class ReferenceTalon:
+    """
+    One Talon SRX closed loop, run one firmware loop at a time.
+    """
+
+    def __init__(self, p, i, d, f, izone, ramp_rate):
+        self.p, self.i, self.d, self.f, self.izone, self.ramp_rate = p, i, d, f, izone, ramp_rate
+        self.iaccum = 0
+        self.last_error = None
+        self.output = 0
+
+    def loop(self, setpoint, measurement):
+        error = setpoint - measurement
+        if self.last_error is None:
+            self.last_error = error
+        if self.izone != 0 and abs(error) > self.izone:
+            self.iaccum = 0
+        else:
+            self.iaccum += error
+        output = self.p*error + self.i*self.iaccum + self.d*(error - self.last_error) + self.f*setpoint
+        if self.ramp_rate > 0:
+            output = min(max(output, self.output - self.ramp_rate), self.output + self.ramp_rate)
+        self.output = min(max(output, -1023), 1023)
+        self.last_error = error
+        return self.output
+
+    def tick(self, setpoint, measurement, dt):
+        loops = int(round(dt/TalonBank.LOOP_PERIOD))
+        return np.mean([self.loop(setpoint, measurement) for _ in range(loops)])/1023
+
+
+GAINS = [
+    # p, i, d, f, izone, ramp rate
+    (2.0, 0.0, 0.0, 0.0, 0, 0),
+    (.5, .01, 20.0, .1, 0, 0),
+    (.5, .02, 10.0, 0.0, 30, 0),
+    (1.0, .01, 5.0, .05, 50, 4.0),
+    (3.0, 0.0, 0.0, 0.0, 0, 1.0),
+]
+
+
+def make_bank(mode):
+    bank = TalonBank([None]*len(GAINS))
+    bank.present[:] = True
+    bank.mode[:] = mode
+    bank.gains = np.array(GAINS).T.copy()
+    bank.value[:] = 100
+    return bank
+
+
+@pytest.mark.parametrize("mode", [TalonBank.MODE_POSITION, TalonBank.MODE_SPEED])
+def test_matches_a_per_loop_reference(mode):
+    random = np.random.RandomState(0)
+    bank = make_bank(mode)
+    references = [ReferenceTalon(*gains) for gains in GAINS]
+    measurement = np.zeros(len(GAINS))
+    for tick in range(100):
+        # The measurement approaches the setpoint, with noise that moves the error in and out of the izones
+        measurement += .05*(100 - measurement) + random.randn(len(GAINS))*5
+        if mode == TalonBank.MODE_POSITION:
+            bank.sensor_position[:] = measurement
+        else:
+            bank.sensor_velocity[:] = measurement
+        percent_vbus = bank.step(DT)
+        expected = [reference.tick(100, value, DT) for reference, value in zip(references, measurement)]
+        np.testing.assert_allclose(percent_vbus, expected, rtol=1e-9, atol=1e-12)
+        np.testing.assert_allclose(bank.iaccum, [reference.iaccum for reference in references], rtol=1e-9)
+
+
+def test_per_second_gains_match_the_old_units():
+    firmware = make_bank(TalonBank.MODE_POSITION)
+    firmware.gains[1:3] = [[.001], [10.0]]
+    per_second = TalonBank([None]*len(GAINS), per_second_gains=True)
+    per_second.present[:] = True
+    per_second.mode[:] = TalonBank.MODE_POSITION
+    per_second.value[:] = 100
+    per_second.gains = firmware.gains.copy()
+    per_second.gains[1:3] = [[1.0], [.01]]
+    for measurement in np.linspace(0, 90, 20):
+        firmware.sensor_position[:] = measurement
+        per_second.sensor_position[:] = measurement
+        np.testing.assert_allclose(per_second.step(DT), firmware.step(DT))
+
+
+def test_open_loop_modes_and_disabling():
+    bank = make_bank(TalonBank.MODE_POSITION)
+    bank.mode[:2] = [TalonBank.MODE_PERCENT_VBUS, TalonBank.MODE_VOLTAGE]
+    bank.value[:2] = [.5, 6]
+    bank.present[-1] = False
+    percent_vbus = bank.step(DT)
+    assert percent_vbus[0] == .5
+    assert percent_vbus[1] == .5
+    assert percent_vbus[-1] == 0
+    assert np.all(bank.step(DT, enabled=False) == 0)
+    # Disabling clears the integrators
+    assert np.all(bank.iaccum == 0)
@@ -0,0 +1,165 @@
+import socket
+import time
+import numpy as np
+from int_dynamics.telemetry import TelemetryLayout, TelemetryClient, DivergenceMonitor, NormalizedErrorStatistics, \
+    pack_message, KIND_LAYOUT, KIND_FRAME
+
+FRAMES = 3000
+DT = .01
+
+SIMULATION_LAYOUT = TelemetryLayout([("time", 1), ("tic_time", 1), ("dt", 1), ("x", 2)])
+ESTIMATION_LAYOUT = TelemetryLayout([
+    ("time", 1), ("tic_time", 1), ("dt", 1), ("x", 2), ("variances/x", 2),
+    ("innovations/sensors/encoder/position", 1), ("innovation_variances/sensors/encoder/position", 1)
+])
+
+
+def ar1(random, frames, channels, phi):
+    """
+    Unit variance AR(1) noise, size==[frames channels]
+    """
+    noise = random.randn(frames, channels)*np.sqrt(1 - phi**2)
+    values = np.zeros((frames, channels))
+    values[0] = random.randn(channels)
+    for i in range(1, frames):
+        values[i] = phi*values[i-1] + noise[i]
+    return values
+
+
+def make_streams(random, error_scale=1.0, innovation_scale=1.0, phi=.95):
+    """
+    Frames where the estimate of x is off by correlated noise of variance error_scale**2 and the innovations are white
+    noise of variance innovation_scale**2, while the estimator claims both variances are 1.
+    """
+    times = np.arange(FRAMES)*DT
+    truth = np.stack((np.sin(times), np.cos(times)), axis=1)
+    simulation = np.zeros((FRAMES, SIMULATION_LAYOUT.size))
+    simulation[:, 0] = times
+    simulation[:, 3:5] = truth
+    estimation = np.zeros((FRAMES, ESTIMATION_LAYOUT.size))
+    estimation[:, 0] = times
+    estimation[:, 3:5] = truth + error_scale*ar1(random, FRAMES, 2, phi)
+    estimation[:, 5:7] = 1
+    estimation[:, 7] = innovation_scale*random.randn(FRAMES)
+    estimation[:, 8] = 1
+    return simulation, estimation
+
+
+def run_monitor(simulation, estimation, chunk=10):
+    monitor = DivergenceMonitor(window=200)
+    monitor.set_layouts(SIMULATION_LAYOUT, ESTIMATION_LAYOUT)
+    for start in range(0, FRAMES, chunk):
+        monitor.add_estimation(estimation[start:start+chunk])
+        monitor.add_simulation(simulation[start:start+chunk])
+    return monitor
+
+
+def test_channels_are_matched_by_name():
+    monitor = DivergenceMonitor()
+    monitor.set_layouts(SIMULATION_LAYOUT, ESTIMATION_LAYOUT)
+    assert monitor.channels == ["x/0", "x/1"]
+    assert monitor.innovation_channels == ["innovations/sensors/encoder/position"]
+    summary = monitor.get_summary()
+    assert summary["statistic"] == ["NEES", "NEES", "NIS"]
+    assert all(len(column) == 3 for column in summary.values())
+
+
+def test_consistent_streams_are_consistent():
+    # Correlated errors make the average wander far beyond the bounds of independent frames, so this would raise
+    # false alarms with them
+    false_alarms = 0
+    checks = 0
+    for seed in range(10):
+        simulation, estimation = make_streams(np.random.RandomState(seed))
+        monitor = run_monitor(simulation, estimation)
+        false_alarms += np.sum(monitor.get_status() != "consistent")
+        checks += 3
+    assert false_alarms <= 2
+
+
+def test_estimates_are_time_aligned():
+    simulation, estimation = make_streams(np.random.RandomState(0), error_scale=0)
+    # Estimates between simulation frames are compared against the interpolated truth
+    estimation[:, 0] += DT/2
+    estimation[:, 3:5] = np.stack((np.sin(estimation[:, 0]), np.cos(estimation[:, 0])), axis=1)
+    monitor = run_monitor(simulation, estimation)
+    assert monitor.nees.count == FRAMES - 1
+    assert np.all(np.abs(monitor.nees.mean_error) < 1e-4)
+
+
+def test_overconfident_streams_are_detected():
+    simulation, estimation = make_streams(np.random.RandomState(0), error_scale=3, innovation_scale=2)
+    monitor = run_monitor(simulation, estimation)
+    assert list(monitor.get_status()) == ["overconfident"]*3
+
+
+def test_underconfident_streams_are_detected():
+    simulation, estimation = make_streams(np.random.RandomState(0), error_scale=.2, innovation_scale=.5)
+    monitor = run_monitor(simulation, estimation)
+    assert list(monitor.get_status()) == ["underconfident"]*3
+
+
+def test_innovations_are_checked_without_a_simulation():
+    simulation, estimation = make_streams(np.random.RandomState(0), innovation_scale=2)
+    monitor = DivergenceMonitor()
+    monitor.set_layouts(None, ESTIMATION_LAYOUT)
+    monitor.add_estimation(estimation)
+    assert monitor.channels == []
+    assert list(monitor.get_status()) == ["overconfident"]
+
+
+def test_effective_samples():
+    random = np.random.RandomState(0)
+    white = NormalizedErrorStatistics(1, window=200)
+    values = random.randn(5000, 1)
+    white.add(values, values**2)
+    assert abs(white.get_effective_samples()[0] - 200) < 20
+    correlated = NormalizedErrorStatistics(1, window=200)
+    values = ar1(random, 5000, 1, .95)
+    correlated.add(values, values**2)
+    # The squares of AR(1) noise with coefficient phi are correlated by phi**2
+    rho = .95**2
+    expected = 200*(1 - (1 - 2/201)*rho)/(1 + (1 - 2/201)*rho)
+    assert abs(correlated.get_correlation()[0] - rho) < .05
+    assert abs(correlated.get_effective_samples()[0] - expected) < .5*expected
+
+
+def test_client_forgets_frames_of_a_dropped_layout():
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(("127.0.0.1", 0))
+    client = TelemetryClient("127.0.0.1", server.getsockname()[1], resubscribe_interval=1000)
+    address = ("127.0.0.1", client.socket.getsockname()[1])
+    old_layout = TelemetryLayout([("x", 1)])
+    new_layout = TelemetryLayout([("y", 2)])
+
+    def send(layout, kind, payload):
+        server.sendto(pack_message(kind, layout.layout_id, 1, payload), address)
+
+    def poll():
+        time.sleep(.05)
+        return client.poll()
+
+    try:
+        send(old_layout, KIND_LAYOUT, old_layout.to_json().encode("utf-8"))
+        send(old_layout, KIND_FRAME, np.array([3.0]).tobytes())
+        assert len(poll()) == 1
+        assert client.get_data() == {"x": 3.0}
+
+        # The server restarted with another layout
+        send(new_layout, KIND_FRAME, np.array([1.0, 2.0]).tobytes())
+        assert len(poll()) == 0
+        assert client.layout is None
+        assert client.get_data() == {}
+
+        # Frames that arrived before a new layout in the same poll are not returned as frames of the new one
+        send(old_layout, KIND_LAYOUT, old_layout.to_json().encode("utf-8"))
+        send(old_layout, KIND_FRAME, np.array([3.0]).tobytes())
+        send(new_layout, KIND_LAYOUT, new_layout.to_json().encode("utf-8"))
+        assert len(poll()) == 0
+        assert client.get_data() == {}
+        send(new_layout, KIND_FRAME, np.array([1.0, 2.0]).tobytes())
+        assert len(poll()) == 1
+        np.testing.assert_array_equal(client.get_data()["y"], [1.0, 2.0])
+    finally:
+        client.close()
+        server.close()
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+theano = pytest.importorskip("theano")
+import theano.tensor as T
+from scipy.linalg import expm
+from int_dynamics import utilities
+
+
+def test_expm_gradient_with_repeated_eigenvalues():
+    # The state matrix of a load integrating its velocity: every eigenvalue is zero, and it is not diagonalizable
+    A = np.array([[0.0, 1.0, 0.0], [0.0, 0.0, 1.0], [0.0, 0.0, 0.0]])
+    weights = np.random.RandomState(0).randn(3, 3)
+    A_in = T.dmatrix("A")
+    gradient = theano.function([A_in], T.grad(T.sum(utilities.expm(A_in)*weights), A_in))(A)
+
+    expected = np.zeros_like(A)
+    h = 1e-6
+    for i in range(3):
+        for j in range(3):
+            step = np.zeros_like(A)
+            step[i, j] = h
+            expected[i, j] = (np.sum(expm(A + step)*weights) - np.sum(expm(A - step)*weights))/(2*h)
+    np.testing.assert_allclose(gradient, expected, atol=1e-7)
+
+
+def test_debug_logger_reads_tensors_only_when_the_flag_trips(capsys):
+    x = theano.shared(np.array([1.0, 2.0]))
+    logger = utilities.DebugTensorLogger(verbosity_level=1)
+    logger.add_tensor(T.log(x), "log x")
+    step = theano.function([], [], updates=logger.get_updates())
+
+    reads = []
+    for shared_var, last_var, name in logger.tensors:
+        for var in [shared_var, last_var]:
+            var.get_value = lambda get_value=var.get_value: reads.append(1) or get_value()
+    for value in [1.0, 2.0]:
+        x.set_value(np.array([value, 2.0]))
+        step()
+        logger.do_checkup()
+    assert len(reads) == 0
+
+    x.set_value(np.array([-1.0, 2.0]))
+    step()
+    with pytest.raises(ValueError):
+        logger.do_checkup()
+    shared_var, last_var, name = logger.tensors[0]
+    np.testing.assert_allclose(last_var.get_value(), np.log([2.0, 2.0]))
+    assert "Last value of log x" in capsys.readouterr().out